@@ -1,4 +1,6 @@
 import sys, os
+import time
+import threading
 
 # --- Ajustar path raíz ---
 ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -6,11 +8,14 @@ if ROOT_DIR not in sys.path:
     sys.path.insert(0, ROOT_DIR)
     
 import streamlit as st
-from rag.pipelines import build_index, answer_query
+from rag.client import get_client
 
 # --- Configuración general ---
 st.set_page_config(page_title="RAG | Tickets Soporte Tecno", layout="wide")
 
+# Servidor HTTP (RAG_SERVER_URL, ver rag.server) o ejecución en este proceso
+client = get_client()
+
 # --- Cargar estilos externos ---
 css_path = os.path.join(ROOT_DIR, "assets", "styles", "main.css")
 if os.path.exists(css_path):
@@ -38,6 +43,54 @@ menu = st.sidebar.radio(
     ["Consultar", "Actualizar índice", "Subir nuevos tickets"]
 )
 
+# --- Recursos en memoria (modelos e índice compartidos por el proceso) ---
+with st.sidebar.expander("Recursos cargados"):
+    try:
+        server_stats = client.stats()
+    except RuntimeError as e:
+        server_stats = {"resources": [], "caches": {}, "shards": [], "answers": {}}
+        st.caption(str(e))
+    resource_rows = server_stats["resources"]
+    if resource_rows:
+        for row in resource_rows:
+            rss = row.get("rss_delta_bytes")
+            rss_txt = f"{rss / 2**20:.0f} MB" if rss is not None else "n/d"
+            st.caption(f"{row['component']}: {row['load_seconds']:.2f}s · {rss_txt}")
+    else:
+        st.caption("Aún no se cargó ningún modelo.")
+    for layer, stats in server_stats["caches"].items():
+        st.caption(f"caché {layer}: {stats['hits']} aciertos / {stats['misses']} fallos ({stats['size']}/{stats['maxsize']})")
+    for shard in server_stats["shards"]:
+        mean = f"{shard['mean_ms']:.1f} ms" if shard["mean_ms"] is not None else "sin búsquedas"
+        st.caption(f"shard {shard['shard']}: {shard['vectors']} vectores ({shard['kind']}) · {mean}")
+    answer_stats = server_stats["answers"]
+    if answer_stats:
+        st.caption(
+            f"respuestas sin LLM: {answer_stats['extractive']} de {answer_stats['extractive'] + answer_stats['generative']}"
+            f" ({answer_stats['fast_path_rate']:.0%}) · modo {answer_stats['mode']}"
+        )
+
+# --- Filtros de búsqueda (se aplican dentro de FAISS) ---
+filters = {}
+answer_mode = None
+if menu == "Consultar":
+    # Modo de respuesta: el configurado (RAG_ANSWER_MODE) o forzar uno, ver rag.extractive
+    answer_modes = {"Configurado": None, "Extractivo (sin LLM)": "extractive", "Generativo (LLM)": "generative", "Automático": "auto"}
+    answer_mode = answer_modes[st.sidebar.selectbox("Modo de respuesta", list(answer_modes))]
+    st.sidebar.header("Filtros")
+    try:
+        filter_options = client.filter_options()
+    except (FileNotFoundError, RuntimeError):
+        filter_options = {}
+        st.sidebar.caption("Todavía no hay un índice construido.")
+    if filter_options:
+        filters["project"] = st.sidebar.multiselect("Proyecto", filter_options.get("project", []))
+        filters["category"] = st.sidebar.multiselect("Categoría", filter_options.get("category", []))
+        filters["status"] = st.sidebar.multiselect("Estado", filter_options.get("status", []))
+        date_range = st.sidebar.date_input("Creado entre", value=(), format="DD/MM/YYYY")
+        if len(date_range) == 2:
+            filters["created_from"], filters["created_to"] = date_range
+
 # =====================================================
 # 1️⃣ SUBIR NUEVOS TICKETS
 # =====================================================
@@ -62,10 +115,23 @@ if menu == "Subir nuevos tickets":
 # =====================================================
 elif menu == "Actualizar índice":
     st.subheader("⚙️ Reconstruir índice FAISS")
+    st.caption("Las consultas siguen usando el índice actual hasta que la versión nueva esté lista.")
     if st.button("🔄 Ejecutar Ingesta + Indexado", use_container_width=True):
-        with st.spinner("Procesando archivos y actualizando índice..."):
-            build_index()
-        st.success("✅ Índice actualizado correctamente.")
+        client.start_build()
+
+    status = client.build_status()
+    if status["state"] == "running":
+        # Se sigue el avance del build en segundo plano hasta que termine
+        bar = st.progress(0.0, text="Procesando archivos y actualizando índice...")
+        while status["state"] == "running":
+            bar.progress(min(status["progress"], 1.0), text=f"Etapa: {status['stage']}")
+            time.sleep(1.0)
+            status = client.build_status()
+        bar.progress(1.0)
+    if status["state"] == "done":
+        st.success(f"✅ Índice actualizado correctamente (versión {status['version']}).")
+    elif status["state"] == "failed":
+        st.error(f"❌ La construcción falló y se mantiene el índice anterior: {status['error']}")
 
 # =====================================================
 # 3️⃣ CONSULTAR
@@ -104,12 +170,42 @@ elif menu == "Consultar":
                     unsafe_allow_html=True
                 )
 
-                # Ejecutar consulta
-                answer = answer_query(query)
-
-                # Eliminar spinner al terminar
-                progress_placeholder.empty()
-
-                # Mostrar respuesta debajo del textbox
-                st.markdown("<p class='answer-title'>Respuesta:</p>", unsafe_allow_html=True)
-                st.markdown(f"<div class='answer-text'>{answer}</div>", unsafe_allow_html=True)
\ No newline at end of file
+                # Cancelar la generación anterior si seguía en curso
+                previous_cancel = st.session_state.get("cancel_event")
+                if previous_cancel is not None:
+                    previous_cancel.set()
+                cancel_event = threading.Event()
+                st.session_state["cancel_event"] = cancel_event
+
+                # Ejecutar consulta en modo streaming: primero los tickets, luego la respuesta
+                answer_placeholder = None
+                answer_text = ""
+                for event in client.stream_query(query, filters=filters, cancel_event=cancel_event, answer_mode=answer_mode):
+                    if event["type"] == "docs":
+                        # Eliminar spinner cuando llegan los tickets
+                        progress_placeholder.empty()
+                        with st.expander(f"Tickets recuperados ({len(event['docs'])})"):
+                            for doc in event["docs"]:
+                                similar = doc.get("duplicate_ticket_ids") or []
+                                similar_txt = f" · igual en {', '.join(str(t) for t in similar)}" if similar else ""
+                                st.caption(f"Ticket {doc.get('ticket_id')} · {doc.get('project')} · score {doc.get('score', 0):.3f}{similar_txt}")
+
+                        # Mostrar respuesta debajo del textbox
+                        st.markdown("<p class='answer-title'>Respuesta:</p>", unsafe_allow_html=True)
+                        answer_placeholder = st.empty()
+                    elif event["type"] == "token":
+                        answer_text += event["text"]
+                        answer_placeholder.markdown(f"<div class='answer-text'>{answer_text}▌</div>", unsafe_allow_html=True) # type: ignore
+                    elif event["type"] == "done":
+                        answer_placeholder.markdown(f"<div class='answer-text'>{event['answer']}</div>", unsafe_allow_html=True) # type: ignore
+                        stats = event.get("stats") or {}
+                        if stats.get("mode") == "extractive":
+                            st.caption(f"Respuesta extractiva, sin LLM (score {stats['score']:.2f} · margen {stats['margin']:.2f})")
+                        elif stats.get("tokens"):
+                            st.caption(f"Primer token en {stats['ttft_s']:.2f}s · {stats['tokens_per_s']:.1f} tokens/s")
+
+                # --- Panel de depuración: tiempos por etapa de la última consulta ---
+                last_trace = client.last_trace()
+                if last_trace:
+                    with st.expander(f"Depuración · {last_trace['duration_ms']:.0f} ms en total"):
+                        st.dataframe(last_trace["spans"], use_container_width=True)
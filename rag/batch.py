@@ -0,0 +1,129 @@
+import json
+import time
+import argparse
+from typing import Dict, List
+from rag.extractive import ANSWER_MODES
+from rag.resources import get_registry
+from rag.utils import setup_logger
+
+logger = setup_logger("batch")
+
+
+def answer_batch(
+    queries: List[str],
+    top_k: int = 3,
+    max_new_tokens: int = 200,
+    batch_size: int = 8,
+    answer_mode: str = None, # type: ignore
+) -> List[str]:
+    """
+    Responde una cola de consultas (p. ej. las sugerencias de la mañana) en lotes.
+    answer_mode (opcional) reemplaza el modo configurado, ver rag.extractive.
+    """
+    generator = get_registry().get_generator()
+    return generator.generate_answers(
+        queries, top_k=top_k, max_new_tokens=max_new_tokens, batch_size=batch_size, answer_mode=answer_mode,
+    )
+
+
+def compare_throughput(
+    queries: List[str],
+    top_k: int = 3,
+    max_new_tokens: int = 64,
+    batch_size: int = 8,
+    include_generation: bool = True,
+) -> Dict:
+    """
+    Compara el bucle actual (una consulta por vez) contra las APIs por lotes.
+    Se desactivan los cachés de consultas durante la medición para no favorecer
+    a la segunda pasada.
+    """
+    registry = get_registry()
+    retriever = registry.get_retriever()
+    generator = registry.get_generator() if include_generation else None
+    report: Dict = {"queries": len(queries), "top_k": top_k}
+
+    def _clear_caches():
+        retriever.query_cache.clear()
+        retriever.results_cache.clear()
+        if generator is not None and generator.answer_cache is not None:
+            generator.answer_cache.clear()
+
+    _clear_caches()
+    start = time.perf_counter()
+    for q in queries:
+        retriever.search(q, top_k=top_k)
+    loop_s = time.perf_counter() - start
+
+    _clear_caches()
+    start = time.perf_counter()
+    retriever.search_batch(queries, top_k=top_k)
+    batch_s = time.perf_counter() - start
+    report["search"] = {
+        "loop_qps": len(queries) / loop_s,
+        "batch_qps": len(queries) / batch_s,
+        "speedup": loop_s / batch_s,
+    }
+
+    if generator is not None:
+        _clear_caches()
+        start = time.perf_counter()
+        for q in queries:
+            generator.generate_answer(q, top_k=top_k, max_new_tokens=max_new_tokens, answer_mode="generative")
+        loop_s = time.perf_counter() - start
+
+        _clear_caches()
+        start = time.perf_counter()
+        generator.generate_answers(
+            queries, top_k=top_k, max_new_tokens=max_new_tokens, batch_size=batch_size, answer_mode="generative",
+        )
+        batch_s = time.perf_counter() - start
+        report["generation"] = {
+            "loop_qps": len(queries) / loop_s,
+            "batch_qps": len(queries) / batch_s,
+            "speedup": loop_s / batch_s,
+            "batch_size": batch_size,
+            "max_new_tokens": max_new_tokens,
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Respuestas por lotes y comparación de throughput")
+    parser.add_argument("questions", help="Archivo de texto con una pregunta por línea")
+    parser.add_argument("--output", default=None, help="JSONL de salida con pregunta y respuesta")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=200)
+    parser.add_argument("--compare", action="store_true", help="Medir bucle vs lotes en lugar de responder")
+    parser.add_argument("--search-only", action="store_true", help="Con --compare, medir solo la recuperación")
+    parser.add_argument("--answer-mode", choices=ANSWER_MODES, default=None, help="Modo de respuesta (por defecto el configurado)")
+    args = parser.parse_args()
+
+    with open(args.questions, "r", encoding="utf-8") as f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    if args.compare:
+        report = compare_throughput(
+            queries,
+            max_new_tokens=min(args.max_new_tokens, 64),
+            batch_size=args.batch_size,
+            include_generation=not args.search_only,
+        )
+        print(json.dumps(report, indent=2))
+        return
+
+    answers = answer_batch(
+        queries, max_new_tokens=args.max_new_tokens, batch_size=args.batch_size, answer_mode=args.answer_mode,
+    )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            for q, a in zip(queries, answers):
+                f.write(json.dumps({"query": q, "answer": a}, ensure_ascii=False) + "\n")
+        logger.info(f"{len(answers)} respuestas guardadas en {args.output}")
+    else:
+        for q, a in zip(queries, answers):
+            print(f"\n> {q}\n{a}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,436 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional
+import numpy as np
+from rag.utils import setup_logger, current_index_dir
+
+logger = setup_logger("benchmark")
+
+# Vocabulario del generador sintético (mismo estilo que los exports de Mantis en data/raw)
+PROJECTS = ["Soporte Técnico", "Slots", "Mesas de Juego", "Caja y Tesorería", "Infraestructura"]
+CATEGORIES = ["Incidente", "Requerimiento", "Hardware", "Software", "Red", "Impresoras"]
+STATUSES = ["new", "assigned", "confirmed", "resolved", "closed"]
+RESOLUTIONS = ["open", "fixed", "unable to reproduce", "duplicate", "won't fix"]
+DEVICES = [
+    "pantalla táctil", "impresora de tickets", "billetero", "lector de tarjetas", "terminal de caja",
+    "switch del sector", "servidor de slots", "monitor de mesa", "UPS", "módulo de red", "teclado",
+]
+SYMPTOMS = [
+    "no responde", "se reinicia sola", "muestra un error", "queda congelada", "no imprime",
+    "rechaza billetes", "pierde conexión", "tiene input lag", "no enciende", "hace ruido",
+]
+CAUSES = [
+    "firmware desactualizado", "cable de red dañado", "fuente de alimentación defectuosa",
+    "configuración incorrecta del driver", "sensor sucio", "memoria llena", "certificado vencido",
+    "conflicto de IP", "atasco de papel", "actualización de Windows pendiente",
+]
+ACTIONS = [
+    "Se actualizó el firmware", "Se reemplazó el cable", "Se limpió el sensor", "Se reinstaló el driver",
+    "Se reinició el servicio", "Se cambió la fuente", "Se liberó espacio en disco", "Se renovó el certificado",
+    "Se reasignó la IP", "Se escaló al proveedor",
+]
+FILLER = [
+    "El usuario indica que el problema ocurre en el turno noche.",
+    "Se adjuntaron logs y capturas del evento.",
+    "El técnico verificó el equipo en sala.",
+    "Se coordinó la intervención con el jefe de sector.",
+    "El problema se reproduce de forma intermitente.",
+    "Se revisó el historial de incidencias similares.",
+]
+
+
+def _ticket(ticket_id: int, rng: random.Random, max_notes: int) -> Dict:
+    device, symptom, cause = rng.choice(DEVICES), rng.choice(SYMPTOMS), rng.choice(CAUSES)
+    code = f"ERR-{rng.randint(100, 9999)}"
+    serial = f"SN{rng.randint(10**5, 10**6 - 1):X}"
+    created = datetime(2024, 1, 1, tzinfo=timezone(timedelta(hours=-3))) + timedelta(minutes=rng.randint(0, 900_000))
+    notes = []
+    for n in range(rng.randint(0, max_notes)):
+        text = " ".join(rng.choice(FILLER) for _ in range(rng.randint(1, 6)))
+        if rng.random() < 0.5:
+            text += f" {rng.choice(ACTIONS)} por {cause}."
+        notes.append({"id": n + 1, "text": text, "created_at": (created + timedelta(hours=n + 1)).isoformat()})
+    description = (
+        f"Reporte: {device} {symptom}. Código {code} en el equipo {serial}. "
+        + " ".join(rng.choice(FILLER) for _ in range(rng.randint(1, 8)))
+    )
+    return {
+        "id": ticket_id,
+        "summary": f"{device.capitalize()} {symptom}",
+        "description": description,
+        "project": {"name": rng.choice(PROJECTS)},
+        "category": {"name": rng.choice(CATEGORIES)},
+        "status": {"name": rng.choice(STATUSES)},
+        "resolution": {"name": rng.choice(RESOLUTIONS)},
+        "created_at": created.isoformat(),
+        "updated_at": (created + timedelta(hours=len(notes) + 1)).isoformat(),
+        "notes": notes,
+    }
+
+
+def generate_tickets(n_tickets: int, seed: int = 0, max_notes: int = 8, start_id: int = 1) -> Iterator[Dict]:
+    """
+    Tickets sintéticos con la forma de MantisTicket (determinísticos por seed).
+    Con max_notes=8 salen ~1-3 chunks por ticket; subir max_notes alarga los tickets.
+    """
+    rng = random.Random(seed)
+    for i in range(n_tickets):
+        yield _ticket(start_id + i, rng, max_notes)
+
+
+def write_dataset(raw_dir: str, n_tickets: int, n_files: int = 10, seed: int = 0, max_notes: int = 8) -> List[str]:
+    """
+    Escribe n_tickets repartidos en n_files exports JSON (lista de tickets), sin
+    tenerlos todos en memoria a la vez.
+    """
+    os.makedirs(raw_dir, exist_ok=True)
+    per_file = -(-n_tickets // n_files)
+    paths = []
+    for f in range(n_files):
+        count = min(per_file, n_tickets - f * per_file)
+        if count <= 0:
+            break
+        path = os.path.join(raw_dir, f"synthetic_{f:04d}.json")
+        tickets = generate_tickets(count, seed=seed * 100_003 + f, max_notes=max_notes, start_id=f * per_file + 1)
+        with open(path, "w", encoding="utf-8") as out:
+            out.write("[\n")
+            for i, ticket in enumerate(tickets):
+                out.write(("," if i else "") + json.dumps(ticket, ensure_ascii=False) + "\n")
+            out.write("]\n")
+        paths.append(path)
+    return paths
+
+
+def _percentiles(values: List[float]) -> Dict:
+    arr = np.array(values) * 1000
+    return {"p50_ms": float(np.percentile(arr, 50)), "p99_ms": float(np.percentile(arr, 99)), "mean_ms": float(arr.mean())}
+
+
+def _dir_bytes(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path) if os.path.isfile(os.path.join(path, f)))
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_ingest(workdir: str, workers: Optional[int]) -> Dict:
+    from rag.ingest import ingest_files
+
+    report = ingest_files(
+        os.path.join(workdir, "raw"), os.path.join(workdir, "processed"),
+        os.path.join(workdir, "processed_raw"), workers=workers,
+    )
+    return {k: report[k] for k in ("tickets", "new_tickets", "chunks", "seconds", "tickets_per_s", "chunks_per_s")}
+
+
+def bench_chunking(texts: List[str]) -> Dict:
+    from rag.chunkers import chunk_text, get_chunker
+
+    start = time.perf_counter()
+    legacy = sum(len(chunk_text(t)) for t in texts)
+    legacy_s = time.perf_counter() - start
+
+    chunker = get_chunker()
+    start = time.perf_counter()
+    token_chunks = sum(len(c) for c in chunker.chunk_texts(texts))
+    token_s = time.perf_counter() - start
+    return {
+        "texts": len(texts),
+        "chunk_text": {"chunks": legacy, "seconds": legacy_s, "texts_per_s": len(texts) / legacy_s if legacy_s else 0.0},
+        "token_chunker": {"chunks": token_chunks, "seconds": token_s, "texts_per_s": len(texts) / token_s if token_s else 0.0},
+    }
+
+
+def bench_embedding(embedder, texts: List[str], batch_size: int = 32) -> Dict:
+    embedder.encode(texts[:batch_size], batch_size=batch_size)  # calentamiento
+    start = time.perf_counter()
+    embedder.encode(texts, batch_size=batch_size)
+    elapsed = time.perf_counter() - start
+    return {"texts": len(texts), "batch_size": batch_size, "seconds": elapsed, "texts_per_s": len(texts) / elapsed}
+
+
+def bench_build(
+    processed_path: str, index_dir: str, embedder, index_type: str, shard_by: str = "project", storage: str = "float32",
+    dedup_threshold: float = 0.0,
+) -> Dict:
+    from rag.store_faiss import build_faiss_index
+
+    start = time.perf_counter()
+    index = build_faiss_index(
+        processed_path, index_dir, incremental=False, index_type=index_type, embedder=embedder, shard_by=shard_by,
+        storage=storage, dedup_threshold=dedup_threshold,
+    )
+    elapsed = time.perf_counter() - start
+    return {
+        "seconds": elapsed,
+        "vectors": int(index.ntotal),
+        "kind": index.describe(),
+        "shards": len(index.shards),
+        "collapsed_duplicates": index.duplicates.get("collapsed", 0),
+        "index_bytes": index.size_bytes(),
+        "dir_bytes": _dir_bytes(index_dir),
+    }
+
+
+def make_queries(processed_path: str, n_queries: int, seed: int = 0) -> List[Dict]:
+    """
+    Consultas con respuesta conocida: el título de un ticket con palabras quitadas
+    y el ID del ticket esperado.
+    """
+    titles = {}
+    with open(processed_path, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("chunk_id") == 0:
+                for part in record["content"].split("\n"):
+                    if part.startswith("Título:"):
+                        titles[record["ticket_id"]] = part[len("Título:"):].strip()
+                        break
+    rng = random.Random(seed)
+    ids = rng.sample(sorted(titles, key=str), min(n_queries, len(titles)))
+    queries = []
+    for ticket_id in ids:
+        words = titles[ticket_id].split()
+        if len(words) > 3:
+            words.pop(rng.randrange(len(words)))
+        queries.append({"query": " ".join(words), "ticket_id": ticket_id})
+    return queries
+
+
+def bench_search(retriever, queries: List[Dict], index_dir: str, top_k: int = 5) -> Dict:
+    """
+    Latencia p50/p99 de TicketRetriever.search (sin cachés) y dos recalls:
+    - recall@k: top-k del índice FAISS contra la búsqueda exacta sobre embeddings.npy
+    - ticket_hit@k: el ticket de origen de la consulta aparece entre los resultados
+      (los títulos sintéticos se repiten entre tickets, así que es una cota baja)
+    """
+    version_dir = current_index_dir(index_dir)
+    embeddings = np.load(os.path.join(version_dir, "embeddings.npy")).astype("float32")
+    ids = np.load(os.path.join(version_dir, "vector_ids.npy"))
+
+    retriever.search(queries[0]["query"], top_k=top_k)  # calentamiento
+    latencies, hits, overlap = [], 0, 0.0
+    for q in queries:
+        retriever.results_cache.clear()
+        retriever.query_cache.clear()
+        start = time.perf_counter()
+        results = retriever.search(q["query"], top_k=top_k)
+        latencies.append(time.perf_counter() - start)
+        hits += any(
+            str(q["ticket_id"]) in {str(t) for t in [r["ticket_id"], *r.get("duplicate_ticket_ids", [])]} for r in results
+        )
+
+        query_vec = retriever.embed_query(q["query"])
+        exact = set(ids[np.argsort(-(embeddings @ query_vec[0]))[:top_k]].tolist())
+        _, found = retriever.index.search(query_vec, top_k)
+        overlap += len(exact & set(found[0].tolist())) / max(len(exact), 1)
+    return {
+        "queries": len(queries),
+        "top_k": top_k,
+        f"recall@{top_k}": overlap / len(queries),
+        f"ticket_hit@{top_k}": hits / len(queries),
+        **_percentiles(latencies),
+        "shards": retriever.shard_report(),
+    }
+
+
+def bench_generation(generator, queries: List[Dict], max_new_tokens: int = 64) -> Dict:
+    rows = []
+    for q in queries:
+        for event in generator.stream_answer(q["query"], max_new_tokens=max_new_tokens, answer_mode="generative"):
+            if event["type"] == "done" and event.get("stats", {}).get("tokens"):
+                rows.append(event["stats"])
+    if not rows:
+        return {"queries": 0}
+    return {
+        "queries": len(rows),
+        "max_new_tokens": max_new_tokens,
+        "ttft_p50_ms": float(np.percentile([r["ttft_s"] for r in rows], 50) * 1000),
+        "ttft_p99_ms": float(np.percentile([r["ttft_s"] for r in rows], 99) * 1000),
+        "tokens_per_s": float(np.mean([r["tokens_per_s"] for r in rows])),
+    }
+
+
+def run_benchmark(
+    n_tickets: int = 500,
+    n_files: int = 10,
+    max_notes: int = 8,
+    seed: int = 0,
+    n_queries: int = 100,
+    top_k: int = 5,
+    index_type: str = "auto",
+    shard_by: str = "project",
+    storage: str = "float32",
+    dedup_threshold: float = 0.0,
+    embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2",
+    generation_model: Optional[str] = "Qwen/Qwen2.5-0.5B-Instruct",
+    generation_queries: int = 5,
+    workers: Optional[int] = None,
+    workdir: Optional[str] = None,
+) -> Dict:
+    """
+    Corre todas las etapas sobre un corpus sintético en un directorio de trabajo aislado
+    (no toca data/ ni index/) y devuelve un reporte JSON comparable entre commits.
+    """
+    from rag.embeddings import Embedder
+    from rag.retriever import TicketRetriever
+
+    workdir = workdir or tempfile.mkdtemp(prefix="rag_bench_")
+    report: Dict = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "params": {
+                "tickets": n_tickets, "files": n_files, "max_notes": max_notes, "seed": seed,
+                "queries": n_queries, "top_k": top_k, "index_type": index_type,
+                "shard_by": shard_by, "storage": storage, "dedup_threshold": dedup_threshold,
+                "embedding_model": embedding_model, "generation_model": generation_model,
+            },
+        },
+        "stages": {},
+    }
+    stages = report["stages"]
+
+    start = time.perf_counter()
+    write_dataset(os.path.join(workdir, "raw"), n_tickets, n_files=n_files, seed=seed, max_notes=max_notes)
+    stages["generate_dataset"] = {"seconds": time.perf_counter() - start}
+
+    logger.info("Etapa: ingesta")
+    stages["ingest"] = bench_ingest(workdir, workers)
+    processed_path = os.path.join(workdir, "processed", "tickets_processed.jsonl")
+
+    # Textos completos de una muestra de tickets para chunking
+    from rag.schema import MantisTicket
+    sample = [MantisTicket(**t).canonical_text() for t in generate_tickets(min(n_tickets, 2000), seed=seed + 1, max_notes=max_notes)]
+    logger.info("Etapa: chunking")
+    stages["chunking"] = bench_chunking(sample)
+
+    logger.info("Etapa: embeddings")
+    embedder = Embedder(embedding_model)
+    with open(processed_path, "r", encoding="utf-8") as f:
+        contents = [json.loads(line)["content"] for _, line in zip(range(2000), f)]
+    stages["embedding"] = bench_embedding(embedder, contents)
+
+    logger.info("Etapa: construcción del índice")
+    index_dir = os.path.join(workdir, "index")
+    stages["build_index"] = bench_build(
+        processed_path, index_dir, embedder, index_type, shard_by, storage, dedup_threshold
+    )
+
+    logger.info("Etapa: búsqueda")
+    retriever = TicketRetriever(
+        os.path.join(index_dir, "tickets.index"), os.path.join(index_dir, "metadata.sqlite"), embedder=embedder
+    )
+    queries = make_queries(processed_path, n_queries, seed=seed)
+    stages["search"] = bench_search(retriever, queries, index_dir, top_k=top_k)
+
+    if generation_model and generation_queries:
+        logger.info("Etapa: generación")
+        from rag.generator import TicketAnswerGenerator
+        generator = TicketAnswerGenerator(model_name=generation_model, retriever=retriever)
+        stages["generation"] = bench_generation(generator, queries[:generation_queries])
+
+    report["meta"]["workdir"] = workdir
+    return report
+
+
+def _flatten(data: Dict, prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = float(value)
+    return flat
+
+
+def compare_reports(baseline: Dict, current: Dict) -> Dict[str, Dict]:
+    """
+    Diferencias por métrica entre dos reportes (p. ej. de dos commits).
+    """
+    old, new = _flatten(baseline["stages"]), _flatten(current["stages"])
+    diff = {}
+    for name in sorted(set(old) & set(new)):
+        change = (new[name] - old[name]) / old[name] if old[name] else None
+        diff[name] = {"baseline": old[name], "current": new[name], "change": change}
+    return diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark reproducible de todas las etapas del RAG")
+    parser.add_argument("--tickets", type=int, default=500)
+    parser.add_argument("--files", type=int, default=10)
+    parser.add_argument("--max-notes", type=int, default=8, help="Más notas = tickets más largos = más chunks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--index-type", default="auto")
+    parser.add_argument("--shard-by", default="project", choices=["project", "year", "none"])
+    parser.add_argument("--storage", default="float32", choices=["float32", "float16", "sq8"])
+    parser.add_argument("--dedup-threshold", type=float, default=0.0, help="Colapsar casi duplicados (0 = no, comparable con reportes anteriores)")
+    parser.add_argument("--embedding-model", default="sentence-transformers/all-MiniLM-L6-v2")
+    parser.add_argument("--generation-model", default="Qwen/Qwen2.5-0.5B-Instruct")
+    parser.add_argument("--generation-queries", type=int, default=5, help="0 para omitir la generación")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--workdir", default=None)
+    parser.add_argument("--keep", action="store_true", help="No borrar el directorio de trabajo")
+    parser.add_argument("--online", action="store_true", help="Permitir descargar modelos (por defecto solo caché local)")
+    parser.add_argument("--baseline", default=None, help="Reporte JSON anterior para comparar")
+    parser.add_argument("--output", default="benchmark.json")
+    args = parser.parse_args()
+
+    if not args.online:
+        # Solo modelos ya descargados (o modelos chicos locales pasados por ruta)
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
+        os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+
+    created = args.workdir is None
+    report = run_benchmark(
+        n_tickets=args.tickets,
+        n_files=args.files,
+        max_notes=args.max_notes,
+        seed=args.seed,
+        n_queries=args.queries,
+        top_k=args.top_k,
+        index_type=args.index_type,
+        shard_by=args.shard_by,
+        storage=args.storage,
+        dedup_threshold=args.dedup_threshold,
+        embedding_model=args.embedding_model,
+        generation_model=args.generation_model,
+        generation_queries=args.generation_queries,
+        workers=args.workers,
+        workdir=args.workdir,
+    )
+    if created and not args.keep:
+        shutil.rmtree(report["meta"]["workdir"], ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            report["comparison"] = compare_reports(json.load(f), report)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(json.dumps(report["stages"], indent=2, ensure_ascii=False))
+    logger.info(f"Reporte guardado en {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import re
+import time
+import threading
+import unicodedata
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normaliza una consulta para usarla como clave de caché:
+    minúsculas, espacios colapsados y sin signos de puntuación finales.
+    """
+    text = unicodedata.normalize("NFKC", query).lower().strip()
+    text = re.sub(r"\s+", " ", text)
+    return text.strip(" ?¿!¡.")
+
+
+class TTLCache:
+    """
+    Caché LRU con expiración por tiempo y contadores de aciertos/fallos.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl is not None and time.monotonic() - stored_at > self.ttl
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or self._expired(item[1]):
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: Hashable, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def items(self):
+        """
+        Entradas vigentes (sin contar como acierto ni alterar el orden LRU).
+        """
+        with self._lock:
+            return [(k, v) for k, (v, t) in self._data.items() if not self._expired(t)]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class AnswerCache:
+    """
+    Caché de respuestas generadas. Acierta por coincidencia exacta de la consulta
+    normalizada o, si no, por similitud coseno entre embeddings de consultas
+    por encima de `similarity_threshold`. Se vacía al cambiar la versión del índice.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: Optional[float] = 3600, similarity_threshold: float = 0.95):
+        self.similarity_threshold = similarity_threshold
+        self.near_hits = 0
+        self.version = None
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def _check_version(self, version):
+        if version != self.version:
+            self._cache.clear()
+            self.version = version
+
+    def get(self, version, key: Hashable, query_vec: Optional[np.ndarray] = None):
+        self._check_version(version)
+        hit = self._cache.get(key)
+        if hit is not None:
+            return hit[1]
+
+        if query_vec is None:
+            return None
+        # Búsqueda aproximada: misma configuración (resto de la clave), consulta parecida
+        candidates = [(k, v) for k, v in self._cache.items() if k[1:] == key[1:]]
+        if not candidates:
+            return None
+        vecs = np.stack([v[0] for _, v in candidates])
+        sims = vecs @ query_vec.reshape(-1)
+        best = int(np.argmax(sims))
+        if sims[best] >= self.similarity_threshold:
+            # Se cuenta como acierto y se refresca su posición LRU
+            hit = self._cache.get(candidates[best][0])
+            if hit is not None:
+                self.near_hits += 1
+                return hit[1]
+        return None
+
+    def put(self, version, key: Hashable, query_vec: np.ndarray, answer: str):
+        self._check_version(version)
+        self._cache.put(key, (query_vec.reshape(-1), answer))
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self) -> Dict:
+        stats = self._cache.stats()
+        # Un acierto aproximado registra antes un fallo exacto; se descuenta
+        stats["misses"] -= self.near_hits
+        stats["hits_exact"] = stats["hits"] - self.near_hits
+        stats["hits_near"] = self.near_hits
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / total if total else 0.0
+        return stats
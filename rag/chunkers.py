@@ -1,4 +1,15 @@
-from typing import List, Dict
+import re
+import json
+import argparse
+from typing import List, Dict, Optional, Sequence
+
+# Límite de all-MiniLM-L6-v2 (max_seq_length) sin contar [CLS] y [SEP]
+EMBED_MAX_TOKENS = 256 - 2
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Fin de oración: puntuación seguida de espacio (el texto de Mantis rara vez trae más)
+_SENTENCE_END = re.compile(r"(?<=[.!?;])\s+")
+
 
 def chunk_text(text: str, max_words: int = 300, overlap: int = 50) -> List[Dict]:
     """
@@ -30,3 +41,189 @@ def chunk_text(text: str, max_words: int = 300, overlap: int = 50) -> List[Dict]
             break
 
     return chunks
+
+
+def split_units(text: str) -> List[List[str]]:
+    """
+    Parte el texto en unidades (líneas de canonical_text y oraciones dentro de cada una)
+    como listas de palabras. Concatenadas dan exactamente text.split(), así los
+    offsets start_word/end_word siguen siendo los de siempre.
+    """
+    units = []
+    for line in text.split("\n"):
+        for sentence in _SENTENCE_END.split(line):
+            words = sentence.split()
+            if words:
+                units.append(words)
+    return units
+
+
+class TokenChunker:
+    """
+    Chunker que mide el largo con el tokenizer del modelo de embeddings, para que
+    cada chunk entre completo en la ventana del encoder en lugar de truncarse.
+    Agrupa oraciones/notas enteras hasta max_tokens; solo una oración más larga que
+    el límite se corta por palabras. El solapamiento es de oraciones completas.
+    """
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL, max_tokens: int = EMBED_MAX_TOKENS, overlap_tokens: int = 32):
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+
+    def count_tokens(self, texts: Sequence[str]) -> List[int]:
+        if not texts:
+            return []
+        ids = self.tokenizer(list(texts), add_special_tokens=False)["input_ids"]
+        return [len(i) for i in ids]
+
+    def _split_long_unit(self, words: List[str]) -> List[List[str]]:
+        # Oración más larga que el límite: ventanas de palabras medidas en tokens
+        pieces, current, used = [], [], 0
+        for word, n in zip(words, self.count_tokens(words)):
+            if current and used + n > self.max_tokens:
+                pieces.append(current)
+                current, used = [], 0
+            current.append(word)
+            used += n
+        if current:
+            pieces.append(current)
+        return pieces
+
+    def _pack(self, units: List[List[str]], lengths: List[int]) -> List[Dict]:
+        # Unidades demasiado largas se reemplazan por sus partes
+        flat: List = []
+        for words, n in zip(units, lengths):
+            if n > self.max_tokens:
+                parts = self._split_long_unit(words)
+                flat.extend(zip(parts, self.count_tokens([" ".join(p) for p in parts])))
+            else:
+                flat.append((words, n))
+
+        offsets, pos = [], 0
+        for words, _ in flat:
+            offsets.append(pos)
+            pos += len(words)
+        total_words = pos
+
+        chunks = []
+        i = 0
+        while i < len(flat):
+            j, used = i, 0
+            while j < len(flat) and (j == i or used + flat[j][1] <= self.max_tokens):
+                used += flat[j][1]
+                j += 1
+            start = offsets[i]
+            end = offsets[j] if j < len(flat) else total_words
+            chunks.append({
+                "content": " ".join(w for words, _ in flat[i:j] for w in words),
+                "start_word": start,
+                "end_word": end,
+                "tokens": used,
+            })
+            if j >= len(flat):
+                break
+            # Retroceder oraciones completas mientras quepan en el solapamiento
+            # y dejen lugar a la oración siguiente (si no, el chunk no avanza)
+            back, overlap = j, 0
+            limit = min(self.overlap_tokens, self.max_tokens - flat[j][1])
+            while back - 1 > i and overlap + flat[back - 1][1] <= limit:
+                back -= 1
+                overlap += flat[back][1]
+            i = back
+        return chunks
+
+    def chunk_texts(self, texts: Sequence[str]) -> List[List[Dict]]:
+        """
+        Divide varios textos (p. ej. todos los tickets de un archivo) tokenizando
+        todas sus oraciones en una sola llamada al tokenizer.
+        """
+        all_units = [split_units(t) if t else [] for t in texts]
+        flat = [" ".join(words) for units in all_units for words in units]
+        lengths = self.count_tokens(flat)
+
+        results, pos = [], 0
+        for units in all_units:
+            results.append(self._pack(units, lengths[pos:pos + len(units)]))
+            pos += len(units)
+        return results
+
+    def chunk_text(self, text: str) -> List[Dict]:
+        return self.chunk_texts([text])[0]
+
+
+_chunker: Optional[TokenChunker] = None
+
+
+def get_chunker() -> TokenChunker:
+    """
+    Chunker compartido del proceso (el tokenizer se carga una sola vez por worker).
+    """
+    global _chunker
+    if _chunker is None:
+        _chunker = TokenChunker()
+    return _chunker
+
+
+def truncation_report(contents: Sequence[str], tokenizer, max_tokens: int = EMBED_MAX_TOKENS) -> Dict:
+    """
+    Cuántos chunks superan la ventana del encoder y qué fracción de tokens se pierde
+    (se tokeniza pero el modelo de embeddings la descarta).
+    """
+    lengths = [len(ids) for ids in tokenizer(list(contents), add_special_tokens=False)["input_ids"]] if contents else []
+    total = sum(lengths)
+    lost = sum(max(n - max_tokens, 0) for n in lengths)
+    truncated = sum(1 for n in lengths if n > max_tokens)
+    return {
+        "chunks": len(lengths),
+        "truncated_chunks": truncated,
+        "truncation_rate": truncated / len(lengths) if lengths else 0.0,
+        "tokens": total,
+        "tokens_lost": lost,
+        "tokens_lost_rate": lost / total if total else 0.0,
+        "max_tokens": max_tokens,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tasa de truncamiento de los chunks frente al encoder")
+    parser.add_argument("--processed", default="data/processed/tickets_processed.jsonl")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    from rag.store_faiss import load_latest_chunks
+
+    chunker = get_chunker()
+    contents = [m["content"] for m in load_latest_chunks(args.processed).values()]
+    report = {"current": truncation_report(contents, chunker.tokenizer, chunker.max_tokens)}
+
+    # Cómo quedaría el mismo corpus con el chunker por tokens
+    tickets: Dict = {}
+    with open(args.processed, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("chunk_id") == 0:
+                tickets[str(record["ticket_id"])] = []
+            tickets.setdefault(str(record["ticket_id"]), []).append(record)
+    texts = []
+    for records in tickets.values():
+        # Reconstruir el texto del ticket desde los chunks solapados
+        words: List[str] = []
+        for r in sorted(records, key=lambda r: r.get("start_word") or 0):
+            chunk_words = r["content"].split()
+            skip = len(words) - (r.get("start_word") or 0)
+            words.extend(chunk_words[max(skip, 0):])
+        texts.append(" ".join(words))
+    rechunked = [c["content"] for chunks in chunker.chunk_texts(texts) for c in chunks]
+    report["token_chunker"] = truncation_report(rechunked, chunker.tokenizer, chunker.max_tokens)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import os
+import json
+import urllib.error
+import urllib.request
+from datetime import date
+from typing import Dict, Iterator, List, Optional
+from rag.utils import setup_logger
+
+logger = setup_logger("client")
+
+
+def _jsonable_filters(filters: Optional[Dict]) -> Optional[Dict]:
+    # Las fechas de la UI viajan como ISO (rag.filters las acepta así)
+    if not filters:
+        return None
+    return {k: (v.isoformat() if isinstance(v, date) else v) for k, v in filters.items()}
+
+
+class RAGClient:
+    """
+    Cliente del servidor HTTP (rag.server), con la misma interfaz que LocalClient.
+    """
+
+    def __init__(self, base_url: str = "http://127.0.0.1:8000", timeout: float = 300.0):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, method: str, path: str, payload: Dict = None): # type: ignore
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        request = urllib.request.Request(
+            self.base_url + path, data=data, method=method,
+            headers={"Content-Type": "application/json"} if data else {},
+        )
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read()).get("error", e.reason)
+            except ValueError:
+                message = e.reason
+            raise RuntimeError(f"Servidor RAG ({e.code}): {message}") from e
+        except (urllib.error.URLError, OSError) as e:
+            # Servidor caído, conexión rechazada o timeout: mismo error que una respuesta fallida
+            reason = getattr(e, "reason", e)
+            raise RuntimeError(f"Servidor RAG no disponible en {self.base_url}: {reason}") from e
+
+    def _json(self, method: str, path: str, payload: Dict = None): # type: ignore
+        with self._request(method, path, payload) as response:
+            return json.loads(response.read())
+
+    def search(self, query: str, top_k: int = 5, filters: Dict = None) -> List[Dict]: # type: ignore
+        payload = {"query": query, "top_k": top_k, "filters": _jsonable_filters(filters)}
+        return self._json("POST", "/search", payload)["results"]
+
+    def stream_query(self, query: str, filters: Dict = None, cancel_event=None, answer_mode: str = None) -> Iterator[Dict]: # type: ignore
+        """
+        Eventos NDJSON del servidor (docs, token, done). Si se activa cancel_event
+        se cierra la conexión y el servidor corta la generación.
+        """
+        payload = {"query": query, "filters": _jsonable_filters(filters), "stream": True, "answer_mode": answer_mode}
+        with self._request("POST", "/answer", payload) as response:
+            for line in response:
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+                if line.strip():
+                    event = json.loads(line)
+                    if event["type"] == "error":
+                        raise RuntimeError(f"Servidor RAG: {event['error']}")
+                    yield event
+
+    def filter_options(self) -> Dict[str, list]:
+        return self._json("GET", "/filters")
+
+    def stats(self) -> Dict:
+        """
+        Recursos cargados, cachés, shards y modos de respuesta en una sola consulta a /stats.
+        """
+        return self._json("GET", "/stats")
+
+    def start_build(self) -> Dict:
+        """
+        Lanza la construcción del índice en el servidor (o se suma a la que ya está en curso).
+        """
+        try:
+            return self._json("POST", "/index/build", {})
+        except RuntimeError:
+            status = self.build_status()
+            if status["state"] == "running":
+                return status
+            raise
+
+    def build_status(self) -> Dict:
+        return self._json("GET", "/index/status")
+
+    def last_trace(self, name: str = "answer_query") -> Optional[Dict]:
+        return self._json("GET", f"/traces/last?name={name}")
+
+
+class LocalClient:
+    """
+    Misma interfaz que RAGClient pero ejecutando en este proceso (sin servidor).
+    """
+
+    def search(self, query: str, top_k: int = 5, filters: Dict = None) -> List[Dict]: # type: ignore
+        from rag.resources import get_registry
+        return get_registry().get_retriever().search(query, top_k=top_k, filters=filters)
+
+    def stream_query(self, query: str, filters: Dict = None, cancel_event=None, answer_mode: str = None) -> Iterator[Dict]: # type: ignore
+        from rag.pipelines import stream_query
+        return stream_query(query, filters=filters, cancel_event=cancel_event, answer_mode=answer_mode)
+
+    def filter_options(self) -> Dict[str, list]:
+        from rag.resources import get_registry
+        return get_registry().get_retriever().filter_options()
+
+    def stats(self) -> Dict:
+        from rag.resources import get_registry
+        registry = get_registry()
+        return {
+            "resources": registry.report(),
+            "caches": registry.cache_stats(),
+            "shards": registry.shard_report(),
+            "answers": registry.answer_stats(),
+        }
+
+    def start_build(self) -> Dict:
+        from rag.index_builder import get_index_builder
+        builder = get_index_builder()
+        builder.start()
+        return builder.status()
+
+    def build_status(self) -> Dict:
+        from rag.index_builder import get_index_builder
+        return get_index_builder().status()
+
+    def last_trace(self, name: str = "answer_query") -> Optional[Dict]:
+        from rag.tracing import metrics
+        return metrics.last_trace(name)
+
+
+def get_client():
+    """
+    Cliente del servidor si está definida RAG_SERVER_URL; si no, ejecución local.
+    """
+    url = os.getenv("RAG_SERVER_URL")
+    if url:
+        logger.info(f"Usando el servidor RAG en {url}")
+        return RAGClient(url)
+    return LocalClient()
@@ -0,0 +1,150 @@
+from typing import Dict, List, Tuple
+from rag.utils import setup_logger
+
+logger = setup_logger("context")
+
+# Un recorte parcial solo vale la pena si quedan al menos estos tokens libres
+MIN_PARTIAL_TOKENS = 32
+
+
+def ticket_label(doc: Dict, max_duplicates: int = 3) -> str:
+    """
+    ID del ticket para citarlo, con los tickets casi duplicados que representa (ver rag.dedup).
+    """
+    label = str(doc.get("ticket_id", "N/A"))
+    duplicates = doc.get("duplicate_ticket_ids") or []
+    if duplicates:
+        shown = ", ".join(str(t) for t in duplicates[:max_duplicates])
+        more = f" y {len(duplicates) - max_duplicates} más" if len(duplicates) > max_duplicates else ""
+        label += f" (igual en {shown}{more})"
+    return label
+
+
+def _word_overlap(a: List[str], b: List[str], max_overlap: int = 200) -> int:
+    """
+    Largo del mayor sufijo de a que es prefijo de b (chunks sin offsets).
+    """
+    for n in range(min(len(a), len(b), max_overlap), 0, -1):
+        if a[-n:] == b[:n]:
+            return n
+    return 0
+
+
+def merge_ticket_chunks(docs: List[Dict]) -> List[Dict]:
+    """
+    Une los chunks contiguos o solapados de un mismo ticket (el chunker repite
+    oraciones entre chunks vecinos) en un único pasaje, con el mejor score del grupo.
+    """
+    by_ticket: Dict = {}
+    for d in docs:
+        by_ticket.setdefault(str(d.get("ticket_id", "N/A")), []).append(d)
+
+    passages = []
+    for ticket_docs in by_ticket.values():
+        ticket_docs = sorted(ticket_docs, key=lambda d: (d.get("start_word") or 0, d.get("chunk_id") or 0))
+        current = None
+        for d in ticket_docs:
+            words = (d.get("content") or d.get("text") or "").split()
+            start, end = d.get("start_word"), d.get("end_word")
+            if current is not None:
+                if start is not None and current["end_word"] is not None:
+                    # Offsets conocidos: se descuenta exactamente el solapamiento
+                    contiguous = start <= current["end_word"]
+                    overlap = current["end_word"] - start if contiguous else 0
+                else:
+                    overlap = _word_overlap(current["words"], words)
+                    contiguous = overlap > 0
+                if contiguous:
+                    current["words"] += words[min(overlap, len(words)):]
+                    current["end_word"] = max(current["end_word"], end) if end is not None and current["end_word"] is not None else None
+                    current["score"] = max(current["score"], d.get("score", 0.0))
+                    current["chunks"] += 1
+                    for ticket_id in d.get("duplicate_ticket_ids") or []:
+                        if ticket_id not in current["duplicate_ticket_ids"]:
+                            current["duplicate_ticket_ids"].append(ticket_id)
+                    continue
+                passages.append(current)
+            current = {
+                "ticket_id": d.get("ticket_id", "N/A"),
+                "words": words,
+                "end_word": end,
+                "score": d.get("score", 0.0),
+                "chunks": 1,
+                "duplicate_ticket_ids": list(d.get("duplicate_ticket_ids") or []),
+            }
+        if current is not None:
+            passages.append(current)
+
+    for p in passages:
+        p["content"] = " ".join(p.pop("words"))
+    return passages
+
+
+def dedupe_passages(passages: List[Dict]) -> List[Dict]:
+    """
+    Quita pasajes repetidos (mismo texto o contenido dentro de otro de mejor score).
+    """
+    kept: List[Dict] = []
+    for p in sorted(passages, key=lambda p: -p["score"]):
+        norm = " ".join(p["content"].lower().split())
+        if not norm or any(norm in k["_norm"] for k in kept):
+            continue
+        p["_norm"] = norm
+        kept.append(p)
+    for p in kept:
+        p.pop("_norm")
+    return kept
+
+
+def _truncate_to_tokens(tokenizer, text: str, max_tokens: int) -> str:
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"][:max_tokens]
+    cut = tokenizer.decode(ids, skip_special_tokens=True)
+    # No cortar palabras a la mitad
+    if " " in cut and len(cut) < len(text):
+        cut = cut[:cut.rfind(" ")]
+    return cut.rstrip() + " …"
+
+
+def pack_context(docs: List[Dict], tokenizer, max_tokens: int = 768) -> Tuple[str, Dict]:
+    """
+    Arma el contexto del prompt dentro de un presupuesto de tokens del generador:
+    une chunks solapados del mismo ticket, quita texto duplicado y llena el
+    presupuesto por orden de score. Un pasaje que no entra completo se recorta
+    en un límite de palabra si queda espacio suficiente; si no, se prueba el siguiente.
+    Devuelve (contexto, estadísticas).
+    """
+    raw_lines = [f"- [Ticket {d.get('ticket_id', 'N/A')}] {(d.get('content') or d.get('text') or '').strip()}" for d in docs]
+    passages = dedupe_passages(merge_ticket_chunks(docs))
+    lines = [f"- [Ticket {ticket_label(p)}] {p['content'].strip()}" for p in passages]
+
+    counts = tokenizer(raw_lines + lines, add_special_tokens=False)["input_ids"] if raw_lines else []
+    raw_tokens = sum(len(ids) for ids in counts[:len(raw_lines)])
+    line_tokens = [len(ids) for ids in counts[len(raw_lines):]]
+
+    packed, used = [], 0
+    for line, n_tokens in zip(lines, line_tokens):
+        sep = 1 if packed else 0  # salto de línea entre pasajes
+        remaining = max_tokens - used - sep
+        if n_tokens <= remaining:
+            packed.append(line)
+            used += n_tokens + sep
+        elif remaining >= MIN_PARTIAL_TOKENS:
+            packed.append(_truncate_to_tokens(tokenizer, line, remaining - 2))
+            used = max_tokens
+        if used >= max_tokens:
+            break
+
+    stats = {
+        "chunks": len(docs),
+        "passages": len(passages),
+        "packed_passages": len(packed),
+        "raw_tokens": raw_tokens,
+        "packed_tokens": used,
+        "saved_tokens": max(raw_tokens - used, 0),
+        "budget": max_tokens,
+    }
+    logger.info(
+        f"Contexto: {stats['chunks']} chunks -> {stats['packed_passages']} pasajes, "
+        f"{used}/{max_tokens} tokens (ahorro de {stats['saved_tokens']} tokens)"
+    )
+    return "\n".join(packed), stats
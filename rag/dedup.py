@@ -0,0 +1,525 @@
+import os
+import re
+import json
+import time
+import zlib
+import hashlib
+import argparse
+import numpy as np
+from typing import Callable, Dict, List, Tuple
+from rag.utils import setup_logger
+
+logger = setup_logger("dedup")
+
+# Similitud de Jaccard (sobre shingles de palabras) a partir de la cual dos chunks de
+# tickets distintos se colapsan en un solo vector (p. ej. 0.9); desactivado por defecto
+DEDUP_THRESHOLD = float(os.getenv("RAG_DEDUP_THRESHOLD", "0"))
+NUM_PERM = 128
+SHINGLE_WORDS = 3
+# Solo se colapsan chunks con los mismos valores en estos campos; el resto de los
+# metadatos (estado, fecha) se guarda por miembro y los filtros lo siguen respetando
+GROUP_FIELDS = ("project", "category")
+# Firmas y grupos del último build, en el directorio de la versión (ver load_dedup_state)
+DEDUP_STATE = "minhash.npz"
+# Primo de Mersenne 2^31 - 1: a * x + b entra en uint64 con shingles de 32 bits
+_PRIME = (1 << 31) - 1
+_WORD = re.compile(r"\w+")
+
+
+def lsh_params(threshold: float, num_perm: int = NUM_PERM) -> Tuple[int, int]:
+    """
+    Bandas y filas por banda del LSH: la combinación cuyo punto de corte
+    (1/bandas)^(1/filas) queda más cerca del umbral sin pasarlo, así casi todos
+    los pares que lo superan caen juntos en algún bucket (los falsos positivos
+    se descartan después comparando firmas).
+    """
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        if (1 / bands) ** (1 / rows) <= threshold:
+            best = (bands, rows)
+    return best
+
+
+class MinHasher:
+    """
+    Firmas MinHash de textos sobre shingles de SHINGLE_WORDS palabras, vectorizadas
+    con numpy por bloques de documentos. Los hashes son estables entre procesos.
+    """
+
+    def __init__(self, num_perm: int = NUM_PERM, shingle_words: int = SHINGLE_WORDS, seed: int = 1):
+        self.num_perm = num_perm
+        self.shingle_words = shingle_words
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _PRIME, size=num_perm, dtype="uint64")
+        self._b = rng.integers(0, _PRIME, size=num_perm, dtype="uint64")
+        self._vocab: Dict[str, int] = {}
+
+    def _word_ids(self, text: str) -> np.ndarray:
+        ids = []
+        for word in _WORD.findall(text.lower()):
+            wid = self._vocab.get(word)
+            if wid is None:
+                wid = self._vocab[word] = zlib.crc32(word.encode("utf-8"))
+            ids.append(wid)
+        return np.array(ids, dtype="uint64")
+
+    def shingles(self, text: str) -> np.ndarray:
+        """
+        Hashes de 32 bits de los shingles del texto (sin repetir); un texto más corto
+        que un shingle cuenta como uno solo.
+        """
+        words = self._word_ids(text)
+        k = self.shingle_words
+        if len(words) < k:
+            return np.array([zlib.crc32(" ".join(_WORD.findall(text.lower())).encode("utf-8"))], dtype="uint64")
+        mask = np.uint64(0xFFFFFFFF)
+        hashes = words[:len(words) - k + 1].copy()
+        for i in range(1, k):
+            hashes = (hashes * np.uint64(1000003) + words[i:len(words) - k + 1 + i]) & mask
+        return np.unique(hashes)
+
+    def signatures(self, texts: List[str], block: int = 128) -> np.ndarray:
+        """
+        Firmas (n_textos, num_perm) en uint32: el mínimo de cada permutación sobre los shingles.
+        """
+        out = np.empty((len(texts), self.num_perm), dtype="uint32")
+        for start in range(0, len(texts), block):
+            shingles = [self.shingles(t) for t in texts[start:start + block]]
+            offsets = np.cumsum([0] + [len(s) for s in shingles[:-1]])
+            values = (self._a[:, None] * np.concatenate(shingles)[None, :] + self._b[:, None]) % np.uint64(_PRIME)
+            out[start:start + len(shingles)] = np.minimum.reduceat(values, offsets, axis=1).T
+        return out
+
+
+def _order_key(meta: Dict):
+    # El representante es el chunk del ticket más antiguo
+    return (meta.get("created_at") or "", str(meta["ticket_id"]), meta["chunk_id"], meta["vector_id"])
+
+
+def band_keys(signatures: np.ndarray, bands: int, rows: int) -> np.ndarray:
+    """
+    Clave de 64 bits (FNV-1a) de cada banda de cada firma: (n_firmas, bandas).
+    Una colisión solo agrega un candidato, que se descarta al comparar las firmas.
+    """
+    keys = np.full((len(signatures), bands), 14695981039346656037, dtype="uint64")
+    with np.errstate(over="ignore"):
+        for r in range(rows):
+            keys = (keys ^ signatures[:, r::rows][:, :bands].astype("uint64")) * np.uint64(1099511628211)
+    return keys
+
+
+def chunk_signatures(
+    chunks: Dict[int, Dict],
+    hasher: MinHasher,
+    previous: Dict = None, # type: ignore
+) -> Dict[int, np.ndarray]:
+    """
+    {vector_id: firma} de los chunks; las del build anterior (previous, ver
+    load_dedup_state) se reutilizan si el contenido no cambió.
+    """
+    previous = previous or {}
+    known, hashes = previous.get("signatures", {}), previous.get("hashes", {})
+    signatures = {
+        vid: known[vid] for vid, meta in chunks.items()
+        if vid in known and hashes.get(vid) == meta["content_hash"] and len(known[vid]) == hasher.num_perm
+    }
+    missing = [vid for vid in chunks if vid not in signatures]
+    if missing:
+        signatures.update(zip(missing, hasher.signatures([chunks[vid]["content"] for vid in missing])))
+    return signatures
+
+
+def _star_clusters(
+    vids: List[int],
+    chunks: Dict[int, Dict],
+    signatures: Dict[int, np.ndarray],
+    threshold: float,
+    group_of: Callable[[Dict], Tuple],
+) -> Dict[int, List[int]]:
+    """
+    Agrupa los vids entre sí: candidatos por LSH y confirmación con la similitud
+    estimada; cada miembro se parece al representante (no hay cadenas A~B~C).
+    """
+    if len(vids) < 2:
+        return {}
+    order = sorted(vids, key=lambda vid: _order_key(chunks[vid]))
+    matrix = np.stack([signatures[vid] for vid in order])
+    bands, rows = lsh_params(threshold, matrix.shape[1])
+    keys = band_keys(matrix, bands, rows)
+    groups_of = [group_of(chunks[vid]) for vid in order]
+
+    buckets: Dict[Tuple, List[int]] = {}
+    for pos in range(len(order)):
+        for band in range(bands):
+            buckets.setdefault((groups_of[pos], band, int(keys[pos, band])), []).append(pos)
+
+    assigned = np.zeros(len(order), dtype=bool)
+    groups: Dict[int, List[int]] = {}
+    for pos in range(len(order)):
+        if assigned[pos]:
+            continue
+        assigned[pos] = True
+        candidates = set()
+        for band in range(bands):
+            candidates.update(buckets[(groups_of[pos], band, int(keys[pos, band]))])
+        ticket = str(chunks[order[pos]]["ticket_id"])
+        candidates = sorted(
+            c for c in candidates if not assigned[c] and str(chunks[order[c]]["ticket_id"]) != ticket
+        )
+        if not candidates:
+            continue
+        similarity = (matrix[candidates] == matrix[pos]).mean(axis=1)
+        members = [c for c, sim in zip(candidates, similarity) if sim >= threshold]
+        if members:
+            assigned[members] = True
+            groups[order[pos]] = [order[c] for c in members]
+    return groups
+
+
+def _match_anchors(
+    pending: List[int],
+    anchors: List[int],
+    chunks: Dict[int, Dict],
+    signatures: Dict[int, np.ndarray],
+    threshold: float,
+    group_of: Callable[[Dict], Tuple],
+) -> Dict[int, int]:
+    """
+    {vid pendiente: vid ya indexado al que se une}. Las claves de banda de los chunks
+    ya indexados se ordenan una vez por banda y cada pendiente las busca con
+    searchsorted: el trabajo en Python es solo el de los pendientes.
+    """
+    if not pending or not anchors:
+        return {}
+    anchor_sigs = np.stack([signatures[vid] for vid in anchors])
+    pending_sigs = np.stack([signatures[vid] for vid in pending])
+    bands, rows = lsh_params(threshold, anchor_sigs.shape[1])
+    anchor_keys = band_keys(anchor_sigs, bands, rows)
+    order = np.argsort(anchor_keys, axis=0, kind="stable")
+    sorted_keys = np.take_along_axis(anchor_keys, order, axis=0)
+    pending_keys = band_keys(pending_sigs, bands, rows)
+    lo = np.stack([np.searchsorted(sorted_keys[:, b], pending_keys[:, b], side="left") for b in range(bands)], axis=1)
+    hi = np.stack([np.searchsorted(sorted_keys[:, b], pending_keys[:, b], side="right") for b in range(bands)], axis=1)
+
+    matches = {}
+    for i, vid in enumerate(pending):
+        meta = chunks[vid]
+        group, ticket = group_of(meta), str(meta["ticket_id"])
+        candidates = sorted(
+            c for c in {int(c) for b in range(bands) for c in order[lo[i, b]:hi[i, b], b]}
+            if str(chunks[anchors[c]]["ticket_id"]) != ticket and group_of(chunks[anchors[c]]) == group
+        )
+        if not candidates:
+            continue
+        similarity = (anchor_sigs[candidates] == pending_sigs[i]).mean(axis=1)
+        best = int(np.argmax(similarity))
+        if similarity[best] >= threshold:
+            matches[vid] = anchors[candidates[best]]
+    return matches
+
+
+def find_duplicates(
+    chunks: Dict[int, Dict],
+    threshold: float = DEDUP_THRESHOLD,
+    hasher: MinHasher = None, # type: ignore
+    signatures: Dict[int, np.ndarray] = None, # type: ignore
+    previous_groups: Dict[int, List[int]] = None, # type: ignore
+    unchanged: set = None, # type: ignore
+    partition: Callable[[Dict], object] = None, # type: ignore
+) -> Dict[int, List[int]]:
+    """
+    Grupos de chunks casi idénticos {vector_id representante: [vector_ids miembros]}.
+    El representante es el chunk del ticket más antiguo. Solo se agrupan chunks de
+    tickets distintos con los mismos GROUP_FIELDS (y la misma partition, p. ej. el
+    shard, así la poda de shards por filtro no deja afuera a un miembro).
+
+    Con previous_groups (los del build anterior, con el mismo umbral) y unchanged
+    (los chunks cuyo contenido no cambió) los grupos vigentes se conservan y solo se
+    ubican los chunks nuevos o modificados y los que quedaron sin representante:
+    primero contra los chunks ya indexados y después entre sí. signatures evita
+    recalcular las firmas conocidas (ver chunk_signatures).
+    """
+    if threshold <= 0 or len(chunks) < 2:
+        return {}
+    hasher = hasher or MinHasher()
+    signatures = signatures if signatures is not None else chunk_signatures(chunks, hasher)
+
+    def group_of(meta: Dict) -> Tuple:
+        key = tuple(meta.get(f) for f in GROUP_FIELDS)
+        return key + (partition(meta),) if partition is not None else key
+
+    if previous_groups is None:
+        return _star_clusters(list(chunks), chunks, signatures, threshold, group_of)
+
+    unchanged = unchanged or set()
+    groups: Dict[int, List[int]] = {}
+    for rep, members in previous_groups.items():
+        if rep not in chunks or rep not in unchanged:
+            continue
+        kept = [
+            m for m in members
+            if m in chunks and m in unchanged and group_of(chunks[m]) == group_of(chunks[rep])
+        ]
+        if kept:
+            groups[rep] = kept
+    grouped = {m for members in groups.values() for m in members}
+    released = {m for members in previous_groups.values() for m in members} - grouped
+    pending = [vid for vid in chunks if vid not in unchanged or vid in released]
+    pending.sort(key=lambda vid: _order_key(chunks[vid]))
+    pending_set = set(pending)
+    anchors = [vid for vid in chunks if vid not in grouped and vid not in pending_set]
+
+    matches = _match_anchors(pending, anchors, chunks, signatures, threshold, group_of)
+    for vid, anchor in matches.items():
+        groups.setdefault(anchor, []).append(vid)
+    groups.update(_star_clusters([vid for vid in pending if vid not in matches], chunks, signatures, threshold, group_of))
+    return groups
+
+
+def collapse_near_duplicates(
+    chunks: Dict[int, Dict],
+    threshold: float = DEDUP_THRESHOLD,
+    previous: Dict = None, # type: ignore
+    partition: Callable[[Dict], object] = None, # type: ignore
+) -> Tuple[Dict[int, Dict], Dict[int, List[Dict]], Dict]:
+    """
+    Deja un solo chunk por grupo de casi duplicados.
+    Devuelve (chunks a indexar, {vector_id representante: [metadatos de los miembros]},
+    estado para el próximo build); los miembros quedan solo en el store de metadatos
+    con sus propios campos, apuntando a su representante.
+    previous es el estado del build anterior (ver load_dedup_state): sus firmas se
+    reutilizan siempre y sus grupos solo si trae reuse_groups (mismo umbral y partición).
+    """
+    if threshold <= 0 or len(chunks) < 2:
+        return chunks, {}, None # type: ignore
+    previous = previous or {}
+    hasher = MinHasher()
+    signatures = chunk_signatures(chunks, hasher, previous)
+    hashes = previous.get("hashes", {})
+    unchanged = {vid for vid, meta in chunks.items() if hashes.get(vid) == meta["content_hash"]}
+    groups = find_duplicates(
+        chunks, threshold, hasher=hasher, signatures=signatures,
+        previous_groups=previous.get("groups") if previous.get("reuse_groups") else None,
+        unchanged=unchanged, partition=partition,
+    )
+    collapsed = {vid for members in groups.values() for vid in members}
+    kept = {vid: meta for vid, meta in chunks.items() if vid not in collapsed}
+    members = {
+        rep: [{k: v for k, v in chunks[vid].items() if k != "content"} for vid in vids]
+        for rep, vids in groups.items()
+    }
+    if groups:
+        logger.info(
+            f"Casi duplicados (Jaccard >= {threshold}): {len(collapsed)} chunks colapsados en "
+            f"{len(groups)} representantes ({len(kept)} de {len(chunks)} chunks se indexan, "
+            f"{len(chunks) - len(unchanged)} firmados de nuevo)."
+        )
+    state = {
+        "signatures": signatures,
+        "hashes": {vid: meta["content_hash"] for vid, meta in chunks.items()},
+        "groups": groups,
+    }
+    return kept, members, state
+
+
+def load_dedup_state(index_dir: str) -> Dict:
+    """
+    Firmas MinHash, content_hash y grupos del build guardado en index_dir ({} si no hay).
+    """
+    path = os.path.join(index_dir, DEDUP_STATE)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with np.load(path) as data:
+            ids = data["ids"].tolist()
+            state = {
+                "signatures": dict(zip(ids, data["signatures"])),
+                "hashes": dict(zip(ids, data["hashes"].tolist())),
+                "groups": {},
+            }
+            for rep, member in zip(data["reps"].tolist(), data["members"].tolist()):
+                state["groups"].setdefault(rep, []).append(member)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"No se pudo leer {path} ({e}); se recalculan las firmas.")
+        return {}
+    return state
+
+
+def save_dedup_state(index_dir: str, state: Dict):
+    ids = sorted(state["signatures"])
+    pairs = [(rep, m) for rep, members in state["groups"].items() for m in members]
+    np.savez(
+        os.path.join(index_dir, DEDUP_STATE),
+        ids=np.array(ids, dtype="int64"),
+        hashes=np.array([state["hashes"][vid] for vid in ids], dtype="U40"),
+        signatures=np.stack([state["signatures"][vid] for vid in ids]).astype("uint32"),
+        reps=np.array([rep for rep, _ in pairs], dtype="int64"),
+        members=np.array([m for _, m in pairs], dtype="int64"),
+    )
+
+
+def groups_digest(groups: Dict[int, List[Dict]]) -> str:
+    """
+    Huella de los grupos (representante -> miembros, con el contenido de cada miembro):
+    si cambia hay que publicar una versión nueva aunque no cambie ningún vector.
+    """
+    pairs = sorted(
+        (int(rep), int(m["vector_id"]), m.get("content_hash")) for rep, members in groups.items() for m in members
+    )
+    return hashlib.sha1(json.dumps(pairs).encode("utf-8")).hexdigest()
+
+
+def _redundant_hits(found: np.ndarray, rep_of: Dict[int, int]) -> float:
+    # Fracción de posiciones del top-k ocupadas por un casi duplicado de un resultado anterior
+    redundant, total = 0, 0
+    for row in found:
+        seen = set()
+        for vid in row:
+            if vid < 0:
+                continue
+            key = rep_of.get(int(vid), int(vid))
+            redundant += key in seen
+            seen.add(key)
+            total += 1
+    return redundant / total if total else 0.0
+
+
+def _search_ms(index, queries: np.ndarray, k: int) -> Tuple[float, np.ndarray]:
+    latencies, found = [], []
+    for q in queries:
+        start = time.perf_counter()
+        _, ids = index.search(q[None, :], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found.append(ids[0])
+    return float(np.percentile(latencies, 50)), np.array(found)
+
+
+def savings_report(
+    processed_path: str,
+    thresholds: List[float],
+    index_dir: str = "index/faiss",
+    n_queries: int = 200,
+    k: int = 10,
+    seed: int = 0,
+) -> Dict:
+    """
+    Cuánto índice y tiempo de búsqueda ahorra colapsar casi duplicados con cada
+    umbral, contra indexar todos los chunks: vectores, bytes del índice FAISS,
+    p50 de búsqueda, posiciones del top-k ocupadas por duplicados y qué fracción
+    de los tickets del top-k completo sigue cubierta (representantes + miembros).
+    Los embeddings salen del caché del build; los que falten se codifican y se guardan.
+    """
+    import faiss
+    from rag.embedding_cache import EmbeddingCache, encoder_signature
+    from rag.embeddings import Embedder
+    from rag.index_factory import auto_index_kind, make_index
+    from rag.store_faiss import load_latest_chunks
+    from rag.vector_storage import VECTOR_STORAGE, embedding_dtype
+
+    chunks = load_latest_chunks(processed_path)
+    if not chunks:
+        raise ValueError(f"No hay chunks en {processed_path}")
+    ids = np.array(sorted(chunks), dtype="int64")
+    metas = [chunks[int(vid)] for vid in ids]
+    embedder = Embedder()
+    cache = EmbeddingCache(
+        os.path.join(index_dir, "embedding_cache.npz"), dtype=embedding_dtype(VECTOR_STORAGE),
+        signature=encoder_signature(embedder),
+    )
+    try:
+        vectors = cache.get_or_encode([m["content_hash"] for m in metas], [m["content"] for m in metas], embedder)
+    finally:
+        embedder.close()
+    cache.save()
+
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(ids), size=min(n_queries, len(ids)), replace=False)]
+    full = make_index(auto_index_kind(len(ids)), vectors, ids)
+    full_ms, full_found = _search_ms(full, queries, k)
+    ticket_of = {int(vid): str(chunks[int(vid)]["ticket_id"]) for vid in ids}
+    report: Dict = {
+        "chunks": len(ids),
+        "k": k,
+        "queries": len(queries),
+        "full": {"vectors": len(ids), "index_bytes": int(faiss.serialize_index(full).nbytes), "search_p50_ms": full_ms},
+        "thresholds": [],
+    }
+
+    # Las firmas no dependen del umbral: se calculan una vez
+    start = time.perf_counter()
+    signatures = chunk_signatures(chunks, MinHasher())
+    report["signature_seconds"] = time.perf_counter() - start
+    for threshold in thresholds:
+        start = time.perf_counter()
+        groups = find_duplicates(chunks, threshold, signatures=signatures)
+        dedup_seconds = time.perf_counter() - start
+        rep_of = {m: rep for rep, members in groups.items() for m in members}
+        keep = np.array([int(vid) not in rep_of for vid in ids])
+        index = make_index(auto_index_kind(int(keep.sum())), vectors[keep], ids[keep])
+        ms, found = _search_ms(index, queries, k)
+
+        coverage = []
+        for full_row, row in zip(full_found, found):
+            expected = {ticket_of[int(v)] for v in full_row if v >= 0}
+            covered = set()
+            for vid in row:
+                if vid < 0:
+                    continue
+                covered.add(ticket_of[int(vid)])
+                covered.update(ticket_of[m] for m in groups.get(int(vid), []))
+            coverage.append(len(expected & covered) / len(expected) if expected else 1.0)
+
+        index_bytes = int(faiss.serialize_index(index).nbytes)
+        report["thresholds"].append({
+            "threshold": threshold,
+            "groups": len(groups),
+            "vectors": int(keep.sum()),
+            "index_bytes": index_bytes,
+            "index_saved": 1 - index_bytes / report["full"]["index_bytes"],
+            "search_p50_ms": ms,
+            "search_saved": 1 - ms / full_ms if full_ms else 0.0,
+            "redundant_hits_before": _redundant_hits(full_found, rep_of),
+            "redundant_hits_after": _redundant_hits(found, rep_of),
+            "ticket_coverage": float(np.mean(coverage)),
+            "dedup_seconds": dedup_seconds,
+        })
+        logger.info(f"Umbral {threshold}: {len(ids)} -> {int(keep.sum())} vectores en {dedup_seconds:.1f}s.")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ahorro de índice y de búsqueda al colapsar chunks casi duplicados")
+    parser.add_argument("--processed", default="data/processed/tickets_processed.jsonl")
+    parser.add_argument("--index-dir", default="index/faiss")
+    parser.add_argument("--thresholds", default="1.0,0.9,0.8,0.7")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--output", default=None, help="Ruta opcional para guardar el reporte en JSON")
+    args = parser.parse_args()
+
+    report = savings_report(
+        args.processed, [float(t) for t in args.thresholds.split(",")],
+        index_dir=args.index_dir, n_queries=args.queries, k=args.k,
+    )
+
+    full = report["full"]
+    print(f"\nSin colapsar: {full['vectors']} vectores · {full['index_bytes'] / 2**20:.1f} MB · p50 {full['search_p50_ms']:.2f} ms")
+    print(f"\n{'umbral':>7}{'grupos':>9}{'vectores':>10}{'índice MB':>11}{'ahorro':>8}{'p50 ms':>9}{'ahorro':>8}"
+          f"{'dup. antes':>12}{'dup. después':>14}{'cobertura':>11}")
+    for row in report["thresholds"]:
+        print(
+            f"{row['threshold']:>7.2f}{row['groups']:>9}{row['vectors']:>10}{row['index_bytes'] / 2**20:>11.1f}"
+            f"{row['index_saved']:>8.1%}{row['search_p50_ms']:>9.2f}{row['search_saved']:>8.1%}"
+            f"{row['redundant_hits_before']:>12.1%}{row['redundant_hits_after']:>14.1%}{row['ticket_coverage']:>11.1%}"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
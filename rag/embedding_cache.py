@@ -0,0 +1,161 @@
+import os
+import re
+import glob
+import json
+import hashlib
+import numpy as np
+from typing import Dict, Iterable, List
+from rag.chunkers import EMBED_MAX_TOKENS
+from rag.utils import setup_logger
+
+logger = setup_logger("embedding_cache")
+
+# Cada save agrega un segmento con las entradas nuevas en vez de reescribir el caché;
+# se compacta en un solo archivo con demasiados segmentos o entradas de chunks borrados
+MAX_SEGMENTS = 8
+COMPACT_STALE_FRACTION = 0.25
+_SEGMENT = re.compile(r"\.seg-(\d+)\.npz$")
+
+
+def content_hash(text: str) -> str:
+    """
+    Hash estable del texto de un chunk (clave del caché y detección de cambios).
+    """
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def encoder_signature(embedder) -> Dict:
+    """
+    Qué produjo los embeddings: modelo, backend y largo máximo de los chunks.
+    Si cambia cualquiera, los vectores guardados ya no sirven aunque el texto sea el mismo.
+    """
+    return {
+        "model": getattr(embedder, "model_name", type(embedder).__name__),
+        "backend": getattr(embedder, "backend", None),
+        "max_tokens": EMBED_MAX_TOKENS,
+    }
+
+
+class EmbeddingCache:
+    """
+    Caché persistente texto -> embedding, indexado por content_hash.
+    Garantiza que el texto de un chunk no se codifique dos veces entre builds.
+    dtype "float16" lo guarda a la mitad de tamaño (ver rag.vector_storage).
+    signature (ver encoder_signature) se guarda junto a los vectores: un caché de
+    otro modelo, backend o largo de chunk se descarta al cargarlo.
+    En disco es path más segmentos path.seg-NNNNN.npz con lo agregado por cada save,
+    así un build incremental escribe solo sus embeddings nuevos.
+    """
+
+    def __init__(
+        self,
+        path: str = "index/faiss/embedding_cache.npz",
+        dtype: str = "float32",
+        signature: Dict = None, # type: ignore
+    ):
+        self.path = path
+        self.dtype = dtype
+        self.signature = json.dumps(signature or {}, sort_keys=True)
+        self._vectors: Dict[str, np.ndarray] = {}
+        self._new: set = set()  # entradas que todavía no están en disco
+        self._segments = self._segment_paths()
+        # Sin archivo base (o de otro encoder o precisión) la próxima save() lo reescribe entero
+        self._rewrite = True
+
+        if os.path.exists(path):
+            self._rewrite = False
+            for file in [path] + self._segments:
+                with np.load(file) as data:
+                    stored = str(data["signature"]) if "signature" in data.files else None
+                    if stored != self.signature:
+                        logger.warning(
+                            f"El caché de embeddings {file} es de otro encoder ({stored or 'sin firma'}), se descarta."
+                        )
+                        self._vectors, self._rewrite = {}, True
+                        return
+                    keys, vecs = data["keys"], data["vectors"]
+                self._vectors.update(zip(keys.tolist(), vecs))
+                # Un caché guardado con otra precisión se reescribe en la próxima save()
+                self._rewrite = self._rewrite or vecs.dtype != np.dtype(dtype)
+            logger.info(f"Caché de embeddings cargado: {len(self._vectors)} entradas ({len(self._segments)} segmentos).")
+
+    def _segment_paths(self) -> List[str]:
+        # Sin los .tmp.npz de una escritura interrumpida
+        return sorted(p for p in glob.glob(glob.escape(self.path) + ".seg-*.npz") if _SEGMENT.search(p))
+
+    def __len__(self):
+        return len(self._vectors)
+
+    def __contains__(self, key: str):
+        return key in self._vectors
+
+    def get(self, key: str):
+        return self._vectors.get(key)
+
+    def get_or_encode(self, hashes: List[str], texts: List[str], embedder) -> np.ndarray:
+        """
+        Devuelve los embeddings de los textos pedidos, codificando solo los que faltan.
+        """
+        missing = {}
+        for h, t in zip(hashes, texts):
+            if h not in self._vectors and h not in missing:
+                missing[h] = t
+
+        if missing:
+            logger.info(f"Codificando {len(missing)} textos nuevos ({len(hashes) - len(missing)} desde caché)...")
+            vecs = embedder.encode(list(missing.values())).astype("float32")
+            for h, v in zip(missing.keys(), vecs):
+                self._vectors[h] = v
+            self._new.update(missing)
+        else:
+            logger.info(f"Todos los embeddings ({len(hashes)}) salieron del caché.")
+
+        return np.stack([self._vectors[h] for h in hashes]).astype("float32")
+
+    def save(self, live: Iterable[str] = None): # type: ignore
+        """
+        Guarda el caché: las entradas nuevas van a un segmento aparte. Con live (los
+        content_hash del corpus actual) se descartan antes las entradas de chunks que
+        ya no existen; en disco se quitan al compactar.
+        """
+        stored = len(self._vectors) - len(self._new)
+        stale_stored = 0
+        if live is not None:
+            live = set(live)
+            stale = [k for k in self._vectors if k not in live]
+            for k in stale:
+                del self._vectors[k]
+                if k in self._new:
+                    self._new.discard(k)
+                else:
+                    stale_stored += 1
+            if stale:
+                logger.info(f"Caché de embeddings: {len(stale)} entradas de chunks que ya no existen descartadas.")
+        if not self._vectors:
+            return
+
+        compact = (
+            self._rewrite
+            or (self._new and len(self._segments) >= MAX_SEGMENTS)
+            or stale_stored > COMPACT_STALE_FRACTION * max(stored, 1)
+        )
+        if compact:
+            self._write(self.path, list(self._vectors))
+            for segment in self._segments:
+                os.remove(segment)
+            self._segments = []
+            logger.info(f"Caché de embeddings compactado ({len(self._vectors)} entradas) en {self.path}")
+        elif self._new:
+            number = int(_SEGMENT.search(self._segments[-1]).group(1)) + 1 if self._segments else 1 # type: ignore
+            segment = f"{self.path}.seg-{number:05d}.npz"
+            self._write(segment, list(self._new))
+            self._segments.append(segment)
+            logger.info(f"Caché de embeddings: {len(self._new)} entradas nuevas guardadas en {segment}")
+        self._new = set()
+        self._rewrite = False
+
+    def _write(self, path: str, keys: List[str]):
+        vecs = np.stack([self._vectors[k] for k in keys]).astype(self.dtype)
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, keys=np.array(keys), vectors=vecs, signature=np.array(self.signature))
+        os.replace(tmp_path, path)
@@ -1,28 +1,311 @@
-from sentence_transformers import SentenceTransformer
+import os
+import json
+import time
+import argparse
+import multiprocessing
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
 from rag.utils import setup_logger
 
 logger = setup_logger("embeddings")
 
+# Backends del encoder: pesos fp32, cuantización dinámica int8 (CPU) u ONNX Runtime
+EMBED_BACKENDS = ("fp32", "int8", "onnx")
+EMBED_BACKEND = os.getenv("RAG_EMBED_BACKEND", "fp32")
+# Procesos para codificar lotes grandes (build del índice); 0 = en este proceso
+EMBED_WORKERS = int(os.getenv("RAG_EMBED_WORKERS", "0"))
+# Tokens (con padding) por lote de referencia: con textos cortos entran más textos por lote
+TOKENS_PER_TEXT = 128
+# Por debajo de esta cantidad de textos no conviene repartir entre procesos
+MIN_TEXTS_PER_WORKER = 64
+
+
+def load_sentence_model(model_name: str, backend: str = "fp32"):
+    """
+    Carga el SentenceTransformer con el backend pedido:
+    - fp32: pesos tal cual
+    - int8: cuantización dinámica int8 de las capas Linear (CPU)
+    - onnx: modelo exportado a ONNX y ejecutado con ONNX Runtime
+      (requiere sentence-transformers>=3.2 y optimum[onnxruntime])
+    torch y sentence-transformers se importan recién acá (importar rag.embeddings es liviano).
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    if backend not in EMBED_BACKENDS:
+        raise ValueError(f"Backend de embeddings desconocido: {backend} (opciones: {', '.join(EMBED_BACKENDS)})")
+    if backend == "onnx":
+        try:
+            return SentenceTransformer(model_name, backend="onnx", device="cpu")
+        except (ImportError, TypeError) as e:
+            raise ImportError("El backend onnx requiere sentence-transformers>=3.2 y 'optimum[onnxruntime]'") from e
+    if backend == "int8":
+        model = SentenceTransformer(model_name, device="cpu")
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return SentenceTransformer(model_name)
+
+
+def length_buckets(lengths: List[int], batch_size: int, batch_tokens: int) -> List[List[int]]:
+    """
+    Agrupa posiciones de textos de largo parecido (orden descendente) en lotes de a
+    lo sumo batch_tokens tokens con padding: los cortos viajan en lotes grandes y los
+    largos en lotes chicos, así casi no se calcula sobre padding.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    max_items = batch_size * 8
+    batches, current = [], []
+    for i in order:
+        # El primero del lote es el más largo: fija el padding de todo el lote
+        longest = lengths[current[0]] if current else lengths[i]
+        if current and ((len(current) + 1) * longest > batch_tokens or len(current) >= max_items):
+            batches.append(current)
+            current = []
+        current.append(i)
+    if current:
+        batches.append(current)
+    return batches
+
+
+_worker_embedder = None
+
+
+def _init_worker(model_name: str, backend: str, threads: int):
+    # Cada proceso carga su propia copia del modelo con una parte de los núcleos
+    global _worker_embedder
+    import torch
+    torch.set_num_threads(threads)
+    _worker_embedder = Embedder(model_name, backend=backend)
+
+
+def _encode_in_worker(texts: List[str]) -> np.ndarray:
+    return _worker_embedder._encode_batch(texts) # type: ignore
+
+
 class Embedder:
     """
     Crea embeddings (vectores numéricos) a partir de texto.
+    - encode(lista): lotes armados por largo (mínimo padding) y, con num_workers > 1,
+      repartidos entre procesos (para el build del índice en CPUs con muchos núcleos)
+    - encode_query(texto): camino directo de baja latencia para una sola consulta
     """
-    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2"):
-        logger.info(f"Cargando modelo de embeddings: {model_name}")
-        self.model = SentenceTransformer(model_name)
+    def __init__(
+        self,
+        model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+        backend: str = EMBED_BACKEND,
+        num_workers: int = 0,
+        batch_tokens: int = None, # type: ignore
+    ):
+        logger.info(f"Cargando modelo de embeddings: {model_name} (backend {backend})")
+        self.model_name = model_name
+        self.backend = backend
+        self.model = load_sentence_model(model_name, backend)
+        self.num_workers = num_workers
+        self.batch_tokens = batch_tokens
+        self._pool = None
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(
+            texts,
+            batch_size=len(texts),
+            show_progress_bar=False,
+            convert_to_numpy=True,
+            normalize_embeddings=True  # normaliza para búsquedas más precisas
+        )
+
+    def _token_lengths(self, texts: List[str]) -> List[int]:
+        tokenizer = getattr(self.model, "tokenizer", None)
+        if tokenizer is None:
+            return [len(t) // 4 + 2 for t in texts]  # ~4 caracteres por token
+        encoded = tokenizer(texts, truncation=True, max_length=self.model.max_seq_length)
+        return [len(ids) for ids in encoded["input_ids"]]
 
     def encode(self, texts, batch_size: int = 32):
         """
-        Convierte uno o varios textos en embeddings.
+        Convierte uno o varios textos en embeddings (filas en el mismo orden que texts).
+        batch_size es la cantidad de textos por lote de largo típico (TOKENS_PER_TEXT tokens).
         """
         if isinstance(texts, str):
-            texts = [texts]
-        embeddings = self.model.encode(
-            texts,
-            batch_size=batch_size,
-            show_progress_bar=True,
-            convert_to_numpy=True,
-            normalize_embeddings=True  # normaliza para búsquedas más precisas
+            return self.encode_query(texts)
+        texts = list(texts)
+        if not texts:
+            return np.zeros((0, self.model.get_sentence_embedding_dimension()), dtype="float32")
+
+        start = time.perf_counter()
+        batch_tokens = self.batch_tokens or batch_size * TOKENS_PER_TEXT
+        batches = length_buckets(self._token_lengths(texts), batch_size, batch_tokens)
+        batch_texts = [[texts[i] for i in batch] for batch in batches]
+
+        if self.num_workers > 1 and len(texts) >= self.num_workers * MIN_TEXTS_PER_WORKER:
+            outputs = list(self._get_pool().map(_encode_in_worker, batch_texts))
+        else:
+            outputs = [self._encode_batch(b) for b in batch_texts]
+
+        embeddings = np.zeros((len(texts), outputs[0].shape[1]), dtype=outputs[0].dtype)
+        for batch, vecs in zip(batches, outputs):
+            embeddings[batch] = vecs
+        elapsed = time.perf_counter() - start
+        if len(texts) > batch_size:
+            logger.info(
+                f"{len(texts)} textos codificados en {elapsed:.2f}s ({len(texts) / elapsed:.0f}/s, "
+                f"{len(batches)} lotes, {max(self.num_workers, 1)} proceso(s))."
+            )
+        return embeddings
+
+    def encode_query(self, text: str) -> np.ndarray:
+        """
+        Embedding (1, dim) de una sola consulta: sin ordenar, sin lotes ni barra de progreso.
+        """
+        import torch
+
+        if self.backend == "onnx":
+            return self._encode_batch([text])
+        features = self.model.tokenize([text])
+        device = self.model.device
+        features = {k: v.to(device) if hasattr(v, "to") else v for k, v in features.items()}
+        with torch.inference_mode():
+            vec = self.model(features)["sentence_embedding"]
+            vec = torch.nn.functional.normalize(vec, p=2, dim=1)
+        return vec.cpu().numpy()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            threads = max(1, (os.cpu_count() or 1) // self.num_workers)
+            logger.info(f"Iniciando {self.num_workers} procesos de embeddings ({threads} hilos c/u)...")
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.model_name, self.backend, threads),
+            )
+        return self._pool
+
+    def close(self):
+        """
+        Cierra el pool de procesos (si se inició).
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+def _agreement(vectors: np.ndarray, reference: np.ndarray) -> Dict:
+    # Vectores normalizados: el coseno es el producto interno fila a fila
+    cosines = np.sum(vectors.astype("float32") * reference.astype("float32"), axis=1)
+    return {"cosine_mean": float(cosines.mean()), "cosine_min": float(cosines.min())}
+
+
+def compare_modes(
+    texts: List[str],
+    model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+    modes: List[str] = None, # type: ignore
+    num_workers: int = None, # type: ignore
+    batch_size: int = 32,
+    n_queries: int = 50,
+) -> Dict:
+    """
+    Chunks/seg de cada modo de codificación y coincidencia (coseno) de sus vectores
+    con los del modo anterior ("baseline": SentenceTransformer.encode en un proceso).
+    También la latencia de una consulta suelta por encode_query frente al camino anterior.
+    """
+    modes = modes or ["baseline", "bucketed", "workers", "int8", "onnx"]
+    num_workers = num_workers or max(2, (os.cpu_count() or 2) // 2)
+    report: Dict = {"texts": len(texts), "batch_size": batch_size, "modes": {}}
+    reference = None
+    base = Embedder(model_name, backend="fp32")
+
+    for mode in modes:
+        try:
+            if mode in ("baseline", "bucketed"):
+                embedder = base
+            elif mode == "workers":
+                embedder = Embedder(model_name, backend="fp32", num_workers=num_workers)
+                embedder.encode(texts[:num_workers * MIN_TEXTS_PER_WORKER], batch_size=batch_size)  # arranque del pool
+            else:
+                embedder = Embedder(model_name, backend=mode)
+        except Exception as e:
+            logger.error(f"No se pudo cargar el modo {mode}: {e}")
+            report["modes"][mode] = {"error": str(e)}
+            continue
+
+        start = time.perf_counter()
+        if mode == "baseline":
+            vectors = base.model.encode(
+                texts, batch_size=batch_size, show_progress_bar=False, convert_to_numpy=True, normalize_embeddings=True,
+            )
+        else:
+            vectors = embedder.encode(texts, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        reference = vectors if reference is None else reference
+
+        row = {"chunks_per_s": len(texts) / elapsed, "seconds": elapsed}
+        if mode == "workers":
+            row["workers"] = num_workers
+        row.update(_agreement(vectors, reference))
+        report["modes"][mode] = row
+        if embedder is not base:
+            embedder.close()
+
+    base_rate = report["modes"].get("baseline", {}).get("chunks_per_s")
+    for row in report["modes"].values():
+        if base_rate and "chunks_per_s" in row:
+            row["speedup"] = row["chunks_per_s"] / base_rate
+
+    # Consulta suelta: camino anterior (encode con lotes y barra) contra encode_query
+    queries = [t[:200] for t in texts[:n_queries]]
+    latencies: Dict[str, List[float]] = {"encode": [], "encode_query": []}
+    for query in queries:
+        start = time.perf_counter()
+        old = base.model.encode([query], batch_size=32, show_progress_bar=True, convert_to_numpy=True, normalize_embeddings=True)
+        latencies["encode"].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        new = base.encode_query(query)
+        latencies["encode_query"].append(time.perf_counter() - start)
+        if query is queries[0]:
+            report["single_query_agreement"] = _agreement(new, old)
+    report["single_query_ms_p50"] = {k: float(np.median(v) * 1000) for k, v in latencies.items() if v}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara los modos de codificación del embedder (chunks/seg y coseno)")
+    parser.add_argument("--processed-path", default="data/processed/tickets_processed.jsonl")
+    parser.add_argument("--limit", type=int, default=2000, help="Cantidad de chunks a codificar")
+    parser.add_argument("--modes", default="baseline,bucketed,workers,int8,onnx")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    parser.add_argument("--output", default=None, help="Ruta opcional para guardar el reporte en JSON")
+    args = parser.parse_args()
+
+    texts: List[str] = []
+    with open(args.processed_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                texts.append(json.loads(line)["content"])
+            if len(texts) >= args.limit:
+                break
+    if not texts:
+        raise ValueError(f"No hay chunks en {args.processed_path}")
+
+    report = compare_modes(
+        texts, model_name=args.model, modes=args.modes.split(","), num_workers=args.workers, batch_size=args.batch_size,
+    )
+    print(f"\n{'modo':<12}{'chunks/s':>10}{'speedup':>10}{'coseno medio':>14}{'coseno mín':>12}")
+    for mode, row in report["modes"].items():
+        if "error" in row:
+            print(f"{mode:<12}  error: {row['error']}")
+            continue
+        print(
+            f"{mode:<12}{row['chunks_per_s']:>10.1f}{row.get('speedup', 1.0):>10.2f}"
+            f"{row['cosine_mean']:>14.4f}{row['cosine_min']:>12.4f}"
         )
-        return np.array(embeddings)
+    print(f"\nConsulta suelta (p50 ms): {report['single_query_ms_p50']}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+import os
+import re
+import json
+import time
+import argparse
+import threading
+import numpy as np
+from typing import Dict, List
+from rag.chunkers import split_units
+from rag.context import ticket_label
+from rag.utils import setup_logger
+
+logger = setup_logger("extractive")
+
+# Modo de respuesta: "generative" (siempre el LLM), "extractive" (nunca el LLM) o
+# "auto" (oraciones extraídas si la recuperación es confiable, si no el LLM). Por defecto el LLM:
+# auto solo toma el camino rápido con umbrales calibrados sobre el corpus (ver main)
+ANSWER_MODES = ("generative", "extractive", "auto")
+ANSWER_MODE = os.getenv("RAG_ANSWER_MODE", "generative")
+# Umbrales calibrados offline (ver main); fuera del directorio versionado porque no dependen del build
+THRESHOLDS_PATH = os.getenv("RAG_ANSWER_THRESHOLDS", "index/faiss/answer_thresholds.json")
+# Umbrales sin calibrar: solo informativos, sin calibración el modo auto va siempre al LLM
+DEFAULT_THRESHOLDS = {"min_score": 0.80, "min_margin": 0.05}
+
+# Etiquetas de sección de canonical_text (ver rag.schema). Los chunkers unen las palabras
+# con espacios, así que las secciones se separan por etiqueta y no por línea
+SECTION_LABELS = (
+    "Proyecto:", "Categoría:", "Título:", "Descripción:", "Notas / Comentarios:", "Estado actual:", "Resolución:",
+)
+# Secciones que son metadatos y no sirven como respuesta
+SKIP_SECTIONS = ("Proyecto:", "Categoría:", "Título:", "Estado actual:", "Resolución:")
+MIN_SENTENCE_WORDS = 4
+# Caminos de recuperación cuyo score es el coseno denso (ver rag.retriever)
+COSINE_RETRIEVALS = ("dense", "hybrid")
+# Respuesta del modo extractivo cuando ninguna oración de los tickets recuperados responde
+NO_ANSWER = "Sin respuesta: ninguna oración de los tickets recuperados responde la consulta."
+_SECTION = re.compile("(" + "|".join(re.escape(label) for label in SECTION_LABELS) + ")")
+
+
+def check_answer_mode(mode: str) -> str:
+    if mode not in ANSWER_MODES:
+        raise ValueError(f"Modo de respuesta desconocido: {mode} (opciones: {', '.join(ANSWER_MODES)})")
+    return mode
+
+
+def load_thresholds(path: str = THRESHOLDS_PATH) -> Dict:
+    """
+        Umbrales de score y margen para el modo auto: los calibrados si existen, si no los por
+    defecto con calibrated=False (auto no los usa y pasa siempre al LLM).
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return {**data, "calibrated": True}
+    except FileNotFoundError:
+        return {**DEFAULT_THRESHOLDS, "calibrated": False}
+    except (OSError, ValueError) as e:
+        logger.warning(f"No se pudieron leer los umbrales de {path} ({e}); se usan los por defecto.")
+        return {**DEFAULT_THRESHOLDS, "calibrated": False}
+
+
+def candidate_sentences(content: str) -> List[str]:
+    """
+    Oraciones de un chunk que pueden responder (descripción y notas), sin las
+    secciones de metadatos ni fragmentos demasiado cortos. El texto previo a la
+    primera etiqueta es la continuación de una sección que empezó en otro chunk.
+    """
+    parts = _SECTION.split(content)
+    sections = [(None, parts[0])] + list(zip(parts[1::2], parts[2::2]))
+    sentences = []
+    for label, text in sections:
+        if label in SKIP_SECTIONS:
+            continue
+        for words in split_units(text):
+            if len(words) >= MIN_SENTENCE_WORDS:
+                sentences.append(" ".join(words))
+    return sentences
+
+
+class ExtractiveAnswerer:
+    """
+    Respuesta sin LLM: las oraciones de los tickets recuperados más cercanas a la
+    consulta, ordenadas por coseno y citando el ticket de cada una.
+    El score es el coseno denso contra cada chunk y el margen la diferencia contra
+    el mejor chunk de otro ticket. prescreen los toma del coseno que ya trae la
+    recuperación, para descartar sin codificar; evaluate recodifica chunks y oraciones.
+    """
+
+    def __init__(
+        self,
+        embedder,
+        thresholds: Dict = None, # type: ignore
+        max_sentences: int = 3,
+        max_tickets: int = 3,
+    ):
+        self.embedder = embedder
+        self.thresholds = thresholds or load_thresholds()
+        self.max_sentences = max_sentences
+        self.max_tickets = max_tickets
+
+    def prescreen(self, docs: List[Dict]) -> Dict:
+        """
+        Score y margen con el coseno de la recuperación, sin llamar al embedder.
+        None si los resultados no traen coseno (búsqueda léxica o por número de ticket).
+        """
+        docs = docs[:self.max_tickets]
+        if not docs or any(doc.get("retrieval") not in COSINE_RETRIEVALS for doc in docs):
+            return None # type: ignore
+        return _score_margin(docs, [doc.get("score", 0.0) for doc in docs])
+
+    def passes(self, scored: Dict) -> bool:
+        return scored["score"] >= self.thresholds["min_score"] and scored["margin"] >= self.thresholds["min_margin"]
+
+    def evaluate(self, query_vec: np.ndarray, docs: List[Dict]) -> Dict:
+        """
+        Score, margen y oraciones candidatas (con su coseno) de los tickets recuperados.
+        Chunks y oraciones se codifican en una sola llamada al embedder.
+        """
+        docs = docs[:self.max_tickets]
+        citations = [ticket_label(doc) for doc in docs]
+        sentences = []
+        for rank, doc in enumerate(docs):
+            for text in candidate_sentences(doc.get("content", "")):
+                sentences.append({"text": text, "ticket_id": doc.get("ticket_id"), "citation": citations[rank], "rank": rank})
+        texts = [doc.get("content", "") for doc in docs] + [s["text"] for s in sentences]
+        if not texts:
+            return {"score": 0.0, "margin": 0.0, "sentences": [], "citations": []}
+
+        vectors = np.asarray(self.embedder.encode(texts), dtype="float32")
+        cosines = vectors @ np.asarray(query_vec, dtype="float32").reshape(-1)
+        doc_scores = cosines[:len(docs)]
+        for sentence, cosine in zip(sentences, cosines[len(docs):]):
+            sentence["score"] = float(cosine)
+
+        sentences.sort(key=lambda s: (-s["score"], s["rank"]))
+        return {**_score_margin(docs, doc_scores), "sentences": sentences, "citations": citations}
+
+    def confident(self, evaluation: Dict) -> bool:
+        return bool(evaluation["sentences"]) and self.passes(evaluation)
+
+    def select(self, evaluation: Dict) -> List[Dict]:
+        chosen, seen = [], set()
+        for sentence in evaluation["sentences"]:
+            key = sentence["text"].lower()
+            if key in seen:
+                continue
+            seen.add(key)
+            chosen.append(sentence)
+            if len(chosen) == self.max_sentences:
+                break
+        return chosen
+
+    def format_answer(self, evaluation: Dict) -> str:
+        """
+        Oraciones elegidas, una por línea, con la cita del ticket de origen (y de sus casi duplicados).
+        Sin oraciones, NO_ANSWER con las citas de los tickets recuperados.
+        """
+        chosen = self.select(evaluation)
+        if not chosen:
+            citations = "; ".join(f"Ticket {c}" for c in evaluation["citations"])
+            return f"{NO_ANSWER} [{citations}]" if citations else NO_ANSWER
+        return "\n".join(f"- {s['text']} [Ticket {s['citation']}]" for s in chosen)
+
+
+def _score_margin(docs: List[Dict], doc_scores) -> Dict:
+    # Mejor chunk y su diferencia contra el mejor chunk de otro ticket
+    top = int(np.argmax(doc_scores))
+    others = [float(s) for doc, s in zip(docs, doc_scores) if doc.get("ticket_id") != docs[top].get("ticket_id")]
+    score = float(doc_scores[top])
+    return {"score": score, "margin": score - max(others) if others else score, "ticket_id": docs[top].get("ticket_id")}
+
+
+class AnswerModeStats:
+    """
+    Cuántas respuestas tomaron el camino rápido (extractivo) y cuántas pasaron por el LLM.
+    no_answer cuenta las extractivas sin oraciones (NO_ANSWER, solo en modo extractivo).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {"extractive": 0, "generative": 0}
+        self.fallbacks = {"forced": 0, "uncalibrated": 0, "low_score": 0, "low_margin": 0, "no_sentences": 0}
+        self.no_answer = 0
+
+    def record(self, path: str, reason: str = None, answered: bool = True): # type: ignore
+        with self._lock:
+            self.counts[path] += 1
+            self.no_answer += not answered
+            if reason is not None:
+                self.fallbacks[reason] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = sum(self.counts.values())
+            return {
+                **self.counts,
+                "no_answer": self.no_answer,
+                "fallbacks": dict(self.fallbacks),
+                "fast_path_rate": self.counts["extractive"] / total if total else 0.0,
+            }
+
+
+def fallback_reason(evaluation: Dict, thresholds: Dict) -> str:
+    # Un resultado de prescreen no trae oraciones: se descartó antes de buscarlas
+    if "sentences" in evaluation and not evaluation["sentences"]:
+        return "no_sentences"
+    if evaluation["score"] < thresholds["min_score"]:
+        return "low_score"
+    return "low_margin"
+
+
+def calibrate(
+    rows: List[Dict],
+    target_precision: float = 0.9,
+    min_support: int = 10,
+) -> Dict:
+    """
+    Elige los umbrales (score, margen) que maximizan la fracción de consultas por el
+    camino rápido manteniendo la precisión objetivo. Cada fila trae score, margin y
+    correct (la oración mejor rankeada cita el ticket esperado).
+    Si ninguna combinación alcanza la precisión, el modo auto queda siempre en el LLM.
+    """
+    if not rows:
+        raise ValueError("No hay consultas para calibrar.")
+    scores = np.array([r["score"] for r in rows])
+    margins = np.array([r["margin"] for r in rows])
+    correct = np.array([r["correct"] for r in rows], dtype=bool)
+
+    score_grid = np.unique(np.quantile(scores, np.linspace(0, 1, 41)))
+    margin_grid = np.unique(np.concatenate([[0.0], np.quantile(margins, np.linspace(0, 0.9, 10))]))
+    best = None
+    for min_score in score_grid:
+        for min_margin in margin_grid:
+            selected = (scores >= min_score) & (margins >= min_margin)
+            n = int(selected.sum())
+            if n < min_support:
+                continue
+            precision = float(correct[selected].mean())
+            if precision < target_precision:
+                continue
+            candidate = (n / len(rows), precision, float(min_score), float(min_margin))
+            if best is None or candidate[:2] > best[:2]:
+                best = candidate
+
+    result = {
+        "target_precision": target_precision,
+        "queries": len(rows),
+        "baseline_precision": float(correct.mean()),
+    }
+    if best is None:
+        logger.warning("Ningún umbral alcanza la precisión objetivo: auto usará siempre el LLM.")
+        return {**result, "min_score": float("inf"), "min_margin": float("inf"), "coverage": 0.0, "precision": None}
+    coverage, precision, min_score, min_margin = best
+    return {**result, "min_score": min_score, "min_margin": min_margin, "coverage": coverage, "precision": precision}
+
+
+def collect_calibration_rows(retriever, queries: List[Dict], top_k: int = 3) -> List[Dict]:
+    """
+    Evalúa cada consulta con respuesta conocida (ver rag.benchmark.make_queries)
+    por el camino extractivo, sin pasar por el LLM.
+    """
+    answerer = ExtractiveAnswerer(retriever.embedder, thresholds=DEFAULT_THRESHOLDS)
+    rows = []
+    for item in queries:
+        docs = retriever.search(item["query"], top_k=top_k)
+        if not docs:
+            continue
+        evaluation = answerer.evaluate(retriever.embed_query(item["query"]), docs)
+        chosen = answerer.select(evaluation)
+        rows.append({
+            "query": item["query"],
+            "score": evaluation["score"],
+            "margin": evaluation["margin"],
+            "correct": bool(chosen) and str(chosen[0]["ticket_id"]) == str(item["ticket_id"]),
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibra los umbrales del modo de respuesta auto (extractivo vs LLM)")
+    parser.add_argument("--processed", default="data/processed/tickets_processed.jsonl")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--target-precision", type=float, default=0.9)
+    parser.add_argument("--min-support", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--thresholds", default=THRESHOLDS_PATH, help="Dónde guardar los umbrales calibrados")
+    parser.add_argument("--dry-run", action="store_true", help="Solo mostrar el resultado, sin guardar")
+    args = parser.parse_args()
+
+    from rag.benchmark import make_queries
+    from rag.resources import get_registry
+
+    retriever = get_registry().get_retriever()
+    queries = make_queries(args.processed, args.queries, seed=args.seed)
+    rows = collect_calibration_rows(retriever, queries, top_k=args.top_k)
+    result = calibrate(rows, target_precision=args.target_precision, min_support=args.min_support)
+    result.update(calibrated_at=time.strftime("%Y-%m-%dT%H:%M:%S"), index_version=retriever.version)
+
+    print(f"\nConsultas: {result['queries']} · precisión sin umbral: {result['baseline_precision']:.3f}")
+    if result["precision"] is None:
+        print(f"Ninguna combinación alcanza precisión {args.target_precision:.2f}: el modo auto usará siempre el LLM.")
+    else:
+        print(
+            f"min_score {result['min_score']:.3f} · min_margin {result['min_margin']:.3f} → "
+            f"{result['coverage']:.1%} de las consultas sin LLM con precisión {result['precision']:.3f}"
+        )
+
+    if not args.dry_run:
+        os.makedirs(os.path.dirname(args.thresholds) or ".", exist_ok=True)
+        with open(args.thresholds, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        logger.info(f"Umbrales guardados en {args.thresholds}")
+
+
+if __name__ == "__main__":
+    main()
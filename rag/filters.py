@@ -0,0 +1,166 @@
+import numpy as np
+import faiss
+from datetime import date, datetime
+from typing import Dict, List, Optional
+from rag.cache import TTLCache
+from rag.metadata_store import MetadataStore
+
+# Campos categóricos filtrables y rango de fechas sobre created_at
+FILTER_FIELDS = ["project", "category", "status"]
+DATE_FILTERS = ("created_from", "created_to")
+
+
+def _timestamp(value, end_of_day: bool = False) -> float:
+    """
+    Convierte fechas (date, datetime o ISO string) a timestamp.
+    Con end_of_day, una fecha sin hora cubre el día completo (para created_to).
+    """
+    if isinstance(value, datetime):
+        return value.timestamp()
+    if isinstance(value, date):
+        value = datetime(value.year, value.month, value.day)
+    else:
+        text = str(value)
+        value = datetime.fromisoformat(text)
+        if len(text) > 10:
+            return value.timestamp()
+    return value.timestamp() + (86400 - 1e-6 if end_of_day else 0)
+
+
+def filters_key(filters: Optional[Dict]):
+    """
+    Representación canónica (hasheable) de un filtro, para claves de caché.
+    """
+    if not filters:
+        return None
+    items = []
+    for field, value in sorted(filters.items()):
+        if value in (None, "", [], ()):
+            continue
+        if isinstance(value, (list, tuple, set)):
+            value = tuple(sorted(str(v) for v in value))
+        items.append((field, str(value)))
+    return tuple(items) or None
+
+
+class FilterIndex:
+    """
+    Conjuntos de IDs precalculados por valor de cada campo (y fechas ordenadas),
+    para armar un IDSelector que FAISS aplica dentro de la búsqueda.
+    Se construye una vez por versión del índice, leyendo solo columnas livianas.
+
+    Los chunks colapsados como casi duplicados (ver rag.dedup) se filtran con sus
+    propios metadatos: si un miembro cumple el filtro, FAISS puede devolver a su
+    representante y resolve lo reemplaza por el miembro.
+    """
+
+    def __init__(self, store: MetadataStore, selector_cache_size: int = 128):
+        fields = FILTER_FIELDS + ["created_at"]
+        members = store.duplicate_rows(fields)
+        rows = store.select_fields(fields) + [(m[0], *m[2:]) for m in members]
+        ids = np.array([r[0] for r in rows], dtype="int64")
+
+        self.values: Dict[str, Dict[str, np.ndarray]] = {}
+        for col, field in enumerate(FILTER_FIELDS, start=1):
+            groups: Dict[str, list] = {}
+            for row, vid in zip(rows, ids):
+                if row[col] is not None:
+                    groups.setdefault(row[col], []).append(vid)
+            self.values[field] = {v: np.sort(np.array(g, dtype="int64")) for v, g in groups.items()}
+
+        dated = [(_timestamp(r[-1]), r[0]) for r in rows if r[-1]]
+        dated.sort()
+        self.dates = np.array([d for d, _ in dated], dtype="float64")
+        self.date_ids = np.array([v for _, v in dated], dtype="int64")
+
+        # Miembros de cada representante, en el orden del store
+        self.members: Dict[int, List[int]] = {}
+        for member_id, rep, *_ in members:
+            self.members.setdefault(rep, []).append(member_id)
+        self.member_ids = np.array([m[0] for m in members], dtype="int64")
+        self.member_reps = np.array([m[1] for m in members], dtype="int64")
+
+        self._selectors = TTLCache(maxsize=selector_cache_size, ttl=None)
+        self._allowed_sets = TTLCache(maxsize=selector_cache_size, ttl=None)
+
+    def options(self) -> Dict[str, list]:
+        return {field: sorted(groups) for field, groups in self.values.items()}
+
+    def allowed_ids(self, filters: Dict) -> Optional[np.ndarray]:
+        """
+        IDs que cumplen todos los criterios (OR dentro de un campo, AND entre campos),
+        incluidos los de chunks colapsados. None si el filtro no restringe nada.
+        """
+        allowed = None
+        for field, value in filters.items():
+            if value in (None, "", [], ()):
+                continue
+            if field in FILTER_FIELDS:
+                wanted = value if isinstance(value, (list, tuple, set)) else [value]
+                parts = [self.values[field].get(v) for v in wanted]
+                parts = [p for p in parts if p is not None]
+                ids = np.unique(np.concatenate(parts)) if parts else np.zeros(0, dtype="int64")
+            elif field in DATE_FILTERS:
+                if field == "created_from":
+                    ids = self.date_ids[np.searchsorted(self.dates, _timestamp(value), side="left"):]
+                else:
+                    ids = self.date_ids[:np.searchsorted(self.dates, _timestamp(value, end_of_day=True), side="right")]
+                ids = np.sort(ids)
+            else:
+                raise ValueError(f"Filtro desconocido: {field} (opciones: {FILTER_FIELDS + list(DATE_FILTERS)})")
+            allowed = ids if allowed is None else np.intersect1d(allowed, ids, assume_unique=True)
+        return allowed
+
+    def searchable_ids(self, filters: Dict) -> np.ndarray:
+        """
+        IDs que FAISS puede devolver para un filtro: los permitidos que están en el
+        índice más los representantes de los miembros permitidos.
+        """
+        ids = self.allowed_ids(filters)
+        if ids is None or not len(self.member_ids):
+            return ids # type: ignore
+        reps = self.member_reps[np.isin(self.member_ids, ids, assume_unique=True)]
+        return np.union1d(ids[~np.isin(ids, self.member_ids, assume_unique=True)], reps)
+
+    def resolve(self, vector_ids, filters: Dict) -> List[int]:
+        """
+        Reemplaza cada ID devuelto por FAISS o por el índice léxico por el chunk que
+        cumple el filtro: el mismo, o el primer miembro de su grupo que lo cumple
+        (-1 si ninguno, p. ej. huecos de FAISS).
+        """
+        vector_ids = [int(v) for v in vector_ids]
+        if not filters_key(filters):
+            return vector_ids
+        allowed = self.allowed_set(filters)
+        resolved = []
+        for vid in vector_ids:
+            if vid not in allowed:
+                vid = next((m for m in self.members.get(vid, ()) if m in allowed), -1)
+            resolved.append(vid)
+        return resolved
+
+    def allowed_set(self, filters: Dict) -> set:
+        """
+        IDs permitidos como set (para filtrar resultados fuera de FAISS), cacheado por filtro.
+        """
+        key = filters_key(filters)
+        cached = self._allowed_sets.get(key)
+        if cached is None:
+            cached = set(self.allowed_ids(filters).tolist()) # type: ignore
+            self._allowed_sets.put(key, cached)
+        return cached
+
+    def selector(self, filters: Dict):
+        """
+        (IDSelector, cantidad de IDs permitidos) para un filtro, cacheado por filtro.
+        Devuelve (None, None) si el filtro no restringe nada.
+        """
+        key = filters_key(filters)
+        if key is None:
+            return None, None
+        cached = self._selectors.get(key)
+        if cached is None:
+            ids = self.searchable_ids(filters)
+            cached = (faiss.IDSelectorBatch(ids), len(ids))
+            self._selectors.put(key, cached)
+        return cached
@@ -1,10 +1,75 @@
+import time
+import threading
 import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from typing import Iterator, List
+from transformers import (
+    AutoTokenizer,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
 from rag.retriever import TicketRetriever
+from rag.cache import AnswerCache, normalize_query
+from rag.filters import filters_key
+from rag.context import pack_context
+from rag.prefix_cache import PrefixKVCache
+from rag.extractive import ANSWER_MODE, AnswerModeStats, ExtractiveAnswerer, check_answer_mode, fallback_reason
+from rag.inference import load_generation_model
+from rag.tracing import record_span, span
 from rag.utils import setup_logger
 
 logger = setup_logger("generator")
 
+# Prefijo constante de todos los prompts (su KV cache se precalcula, ver rag.prefix_cache)
+SYSTEM_PROMPT = (
+    "Eres un experto en soporte técnico de un casino. "
+    "Tu tarea es responder a las consultas **exclusivamente** usando la información "
+    "de los tickets proporcionados a continuación. "
+    "La respuesta tiene que ser creada con información contenida en esos tickets"
+    "En el caso de no poder tener toda la información necesaria en los tickets, responde: "
+    "'No se encontró evidencia suficiente'. "
+    "No inventes información ni uses conocimiento fuera de los tickets, pero siempre trata de dar una respuesta basada en los tickets"
+)
+CONTEXT_HEADER = "--- TICKETS RELEVANTES ---\n"
+
+class _GenerationMonitor(StoppingCriteria):
+    """
+    Se evalúa después de cada token generado: mide time-to-first-token y
+    tokens/seg, y detiene la generación cuando se activa el evento de cancelación.
+    """
+
+    def __init__(self, cancel_event: threading.Event):
+        self.cancel_event = cancel_event
+        self.tokens = 0
+        self.cancelled = False
+        self.started_at = None
+        self.first_token_at = None
+        self.finished_at = None
+
+    def start(self):
+        self.started_at = time.perf_counter()
+
+    def __call__(self, input_ids, scores, **kwargs):
+        now = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self.finished_at = now
+        self.tokens += 1
+        if self.cancel_event.is_set():
+            self.cancelled = True
+        return torch.full((input_ids.shape[0],), self.cancelled, dtype=torch.bool, device=input_ids.device)
+
+    def stats(self) -> dict:
+        ttft = (self.first_token_at - self.started_at) if self.first_token_at and self.started_at else 0.0
+        decode = (self.finished_at - self.first_token_at) if self.first_token_at else 0.0
+        return {
+            "tokens": self.tokens,
+            "ttft_s": ttft,
+            "tokens_per_s": (self.tokens - 1) / decode if decode > 0 else 0.0,
+            "cancelled": self.cancelled,
+        }
+
+
 class TicketAnswerGenerator:
     """
     Genero la respuesta usando el LLM
@@ -14,49 +79,69 @@ class TicketAnswerGenerator:
         self,
         model_name: str = "Qwen/Qwen2.5-0.5B-Instruct",
         device: str = None, # type: ignore
+        retriever: TicketRetriever = None, # type: ignore
+        cache_answers: bool = False,
+        answer_similarity_threshold: float = 0.95,
+        context_tokens: int = 768,
+        use_prefix_cache: bool = True,
+        backend: str = "auto",
+        num_threads: int = None, # type: ignore
+        num_interop_threads: int = None, # type: ignore
+        load_retriever: bool = True,
+        answer_mode: str = ANSWER_MODE,
     ):
         self.device: str = device or ("cuda" if torch.cuda.is_available() else "cpu")
         logger.info(f"Cargando modelo de generación: {model_name} ({self.device})")
 
-        # Cargar tokenizer y modelo
+        # Cargar tokenizer y modelo (dtype / int8 / ONNX según backend, ver rag.inference)
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            torch_dtype=torch.float16,
-            low_cpu_mem_usage=True,
-        ).to(self.device) # type: ignore
-        logger.info(f"Modelo cargado en: {next(self.model.parameters()).device}")
-        self.model.eval()
+        self.model, self.backend = load_generation_model(
+            model_name, backend, self.device, num_threads=num_threads, num_interop_threads=num_interop_threads
+        )
+        logger.info(f"Modelo cargado en: {self.device} (backend {self.backend})")
+
+        # Inicializar el retriever FAISS (o reutilizar uno ya cargado, ver rag.resources);
+        # con load_retriever=False lo asigna después quien lo carga en paralelo
+        self.retriever = retriever or (TicketRetriever() if load_retriever else None) # type: ignore
+
+        # Caché opcional de respuestas (exacto o por consulta casi idéntica)
+        self.answer_cache = AnswerCache(similarity_threshold=answer_similarity_threshold) if cache_answers else None
 
-        # Inicializar el retriever FAISS
-        self.retriever = TicketRetriever()
+        # Modo de respuesta (ver rag.extractive): el extractivo se arma recién cuando hay embedder
+        self.answer_mode = check_answer_mode(answer_mode)
+        self._extractive = None
+        self.answer_mode_stats = AnswerModeStats()
+
+        # Presupuesto de tokens para el contexto de tickets (el prefill en CPU escala con el prompt)
+        self.context_tokens = context_tokens
+
+        # KV cache del prefijo constante (system prompt), reutilizado en cada generación
+        self.prefix_cache = None
+        if use_prefix_cache and self.backend != "onnx":  # ONNX Runtime no acepta un DynamicCache
+            try:
+                self.prefix_cache = PrefixKVCache(
+                    self.model, self.tokenizer, SYSTEM_PROMPT, CONTEXT_HEADER, device=self.device
+                )
+            except Exception as e:
+                logger.warning(f"No se pudo precalcular el KV cache del prefijo, se sigue sin él: {e}")
 
     def build_prompt(self, query: str, retrieved_docs: list) -> list:
         """
         Forza al modelo a responder únicamente en base a los tickets recuperados.
         """
-        # Construir contexto con los tickets más relevantes
-        context_lines = []
-        for d in retrieved_docs:
-            content = d.get("content") or d.get("text") or ""
-            snippet = f"- [Ticket {d.get('ticket_id', 'N/A')}] {content.strip()}"
-            context_lines.append(snippet)
-
-        # Limitar longitud del contexto (previene truncamiento de entrada)
-        context = "\n".join(context_lines)[:2000]
-
-        system_prompt = (
-            "Eres un experto en soporte técnico de un casino. "
-            "Tu tarea es responder a las consultas **exclusivamente** usando la información "
-            "de los tickets proporcionados a continuación. "
-            "La respuesta tiene que ser creada con información contenida en esos tickets"
-            "En el caso de no poder tener toda la información necesaria en los tickets, responde: "
-            "'No se encontró evidencia suficiente'. "
-            "No inventes información ni uses conocimiento fuera de los tickets, pero siempre trata de dar una respuesta basada en los tickets"
-        )
+        return self._prompt(query, retrieved_docs)[0]
+
+    def _prompt(self, query: str, retrieved_docs: list):
+        """
+        (mensajes, stats del contexto). Las stats son de esta consulta: se devuelven en
+        vez de guardarse en el generador, que comparten los hilos de generación.
+        """
+        # Construir contexto con los tickets más relevantes, dentro del presupuesto de tokens
+        # (une chunks solapados del mismo ticket y no corta palabras a la mitad)
+        context, context_stats = pack_context(retrieved_docs, self.tokenizer, self.context_tokens)
 
         user_prompt = (
-            f"--- TICKETS RELEVANTES ---\n"
+            f"{CONTEXT_HEADER}"
             f"{context}\n"
             f"--- FIN DE TICKETS ---\n\n"
             f"PREGUNTA DEL USUARIO:\n{query}\n\n"
@@ -64,50 +149,342 @@ class TicketAnswerGenerator:
         )
 
         messages = [
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": user_prompt},
         ]
-        return messages
+        return messages, context_stats
+
+
+    # Parámetros de muestreo compartidos por todas las generaciones
+    GENERATION_KWARGS = dict(
+        temperature=0.4,                # más estable
+        top_p=0.9,
+        repetition_penalty=1.1,
+        do_sample=True,                 # mejora la naturalidad
+    )
 
+    @property
+    def extractive(self) -> ExtractiveAnswerer:
+        # El embedder puede asignarse después de crear el generador (carga en paralelo)
+        if self._extractive is None or self._extractive.embedder is not self.retriever.embedder:
+            self._extractive = ExtractiveAnswerer(self.retriever.embedder)
+        return self._extractive
 
-    def generate_answer(self, query: str, top_k: int = 3, max_new_tokens: int = 200) -> str:
+    def _extractive_answer(self, query: str, docs: list, mode: str, query_vec=None):
+        """
+        (respuesta, stats) sin LLM según el modo, o None si la respuesta va al LLM.
+        En modo extractivo nunca se pasa al LLM: si ninguna oración responde, la
+        respuesta es NO_ANSWER con las citas de los tickets (ver rag.extractive).
+        """
+        if mode == "generative":
+            self.answer_mode_stats.record("generative", "forced")
+            return None
+        extractive = self.extractive
+        if mode == "auto" and not extractive.thresholds.get("calibrated"):
+            # Sin umbrales calibrados sobre este corpus el camino rápido no es confiable
+            self.answer_mode_stats.record("generative", "uncalibrated")
+            return None
+        with span("extractive") as s:
+            # En auto se descarta primero con el coseno de la recuperación: solo se
+            # codifican chunks y oraciones si ese score y margen pasan los umbrales
+            screened = extractive.prescreen(docs) if mode == "auto" else None
+            if screened is not None and not extractive.passes(screened):
+                evaluation, fast = screened, False
+            else:
+                evaluation = extractive.evaluate(
+                    query_vec if query_vec is not None else self.retriever.embed_query(query), docs
+                )
+                fast = mode == "extractive" or extractive.confident(evaluation)
+            s.set(
+                fast_path=fast, prescreened=evaluation is screened,
+                score=round(evaluation["score"], 4), margin=round(evaluation["margin"], 4),
+            )
+        if not fast:
+            self.answer_mode_stats.record("generative", fallback_reason(evaluation, extractive.thresholds))
+            return None
+        self.answer_mode_stats.record("extractive", answered=bool(evaluation["sentences"]))
+        stats = {"mode": "extractive", "score": evaluation["score"], "margin": evaluation["margin"]}
+        return extractive.format_answer(evaluation), stats
+
+    def generate_answer(
+        self,
+        query: str,
+        top_k: int = 3,
+        max_new_tokens: int = 200,
+        filters: dict = None, # type: ignore
+        answer_mode: str = None, # type: ignore
+    ) -> str:
         """
         Recupera contexto y genera una respuesta textual.
+        filters (opcional) restringe los tickets recuperados, ver TicketRetriever.search.
+        answer_mode (opcional) reemplaza el modo configurado, ver rag.extractive.
+        """
+        answer = ""
+        for event in self.stream_answer(
+            query, top_k=top_k, max_new_tokens=max_new_tokens, filters=filters, answer_mode=answer_mode,
+        ):
+            if event["type"] == "done":
+                answer = event["answer"]
+        return answer
+
+    def stream_answer(
+        self,
+        query: str,
+        top_k: int = 3,
+        max_new_tokens: int = 200,
+        filters: dict = None, # type: ignore
+        cancel_event: threading.Event = None, # type: ignore
+        docs: list = None, # type: ignore
+        answer_mode: str = None, # type: ignore
+    ) -> Iterator[dict]:
         """
-        retrieved = self.retriever.search(query, top_k=top_k)
+        Igual que generate_answer pero por eventos, a medida que se producen:
+        - {"type": "docs", "docs": [...]}: tickets recuperados (siempre primero)
+        - {"type": "token", "text": "..."}: fragmentos de la respuesta
+        - {"type": "done", "answer": "...", "stats": {...}}: respuesta completa y métricas
+          de esta consulta (time-to-first-token, tokens/seg, cancelada, contexto empaquetado)
+        Si se activa cancel_event (o se abandona el iterador) la generación se corta.
+        docs permite pasar tickets ya recuperados (p. ej. por un lote del servidor).
+        En modo extractivo (o auto con recuperación confiable) la respuesta son oraciones
+        de los tickets con su cita, sin pasar por el LLM; stats trae "mode": "extractive".
+        """
+        mode = check_answer_mode(answer_mode or self.answer_mode)
+        cache_key, query_vec = None, None
+        # El caché de respuestas guarda respuestas del LLM: el modo extractivo no lo usa
+        if self.answer_cache is not None and mode != "extractive":
+            cache_key = (normalize_query(query), top_k, max_new_tokens, filters_key(filters))
+            query_vec = self.retriever.embed_query(query)
+            with span("answer_cache") as s:
+                cached = self.answer_cache.get(self.retriever.version, cache_key, query_vec)
+                s.set(hit=cached is not None)
+            if cached is not None:
+                logger.info("Respuesta obtenida del caché.")
+                if docs is None:
+                    docs = self.retriever.search(query, top_k=top_k, filters=filters)
+                yield {"type": "docs", "docs": docs}
+                yield {"type": "token", "text": cached}
+                yield {"type": "done", "answer": cached, "stats": {"cached": True}}
+                return
+
+        retrieved = docs if docs is not None else self.retriever.search(query, top_k=top_k, filters=filters)
+        yield {"type": "docs", "docs": retrieved}
         if not retrieved:
-            return "No se encontraron documentos relevantes."
+            yield {"type": "done", "answer": "No se encontraron documentos relevantes.", "stats": {}}
+            return
+
+        extracted = self._extractive_answer(query, retrieved, mode, query_vec)
+        if extracted is not None:
+            answer, stats = extracted
+            yield {"type": "token", "text": answer}
+            yield {"type": "done", "answer": answer, "stats": stats}
+            return
 
-        messages = self.build_prompt(query, retrieved)
+        with span("build_prompt") as s:
+            messages, context_stats = self._prompt(query, retrieved)
+            s.set(**{k: v for k, v in context_stats.items() if k != "budget"})
 
         logger.info("Generando respuesta...")
+        cancel_event = cancel_event or threading.Event()
+        monitor = _GenerationMonitor(cancel_event)
+        pieces, error = [], None
         try:
-            inputs = self.tokenizer.apply_chat_template(
-                messages,
-                add_generation_prompt=True,
-                tokenize=True,
-                return_dict=True,
-                return_tensors="pt",
+            with span("tokenize") as s:
+                inputs = self.tokenizer.apply_chat_template(
+                    messages,
+                    add_generation_prompt=True,
+                    tokenize=True,
+                    return_dict=True,
+                    return_tensors="pt",
+                ).to(self.device)
+                s.set(prompt_tokens=int(inputs["input_ids"].shape[-1]))
+
+            streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+            generation = {}
+
+            def _run():
+                try:
+                    prefix_kwargs = self.prefix_cache.generate_kwargs(inputs["input_ids"]) if self.prefix_cache else {}
+                    generation["outputs"] = self.model.generate(
+                        **inputs,
+                        max_new_tokens=max_new_tokens,
+                        streamer=streamer,
+                        stopping_criteria=StoppingCriteriaList([monitor]),
+                        **prefix_kwargs,
+                        **self.GENERATION_KWARGS,
+                    )
+                except Exception as e:  # se re-lanza en el hilo del consumidor
+                    generation["error"] = e
+                    streamer.end()
+
+            monitor.start()
+            worker = threading.Thread(target=_run, daemon=True)
+            worker.start()
+            for text in streamer:
+                if text:
+                    pieces.append(text)
+                    yield {"type": "token", "text": text}
+            worker.join()
+            if "error" in generation:
+                raise generation["error"]
+
+        except Exception as e:
+            logger.error(f"Error durante la generación: {e}")
+            error = e
+        finally:
+            # Si el consumidor abandona el iterador (p. ej. rerun de Streamlit) se corta el decode
+            cancel_event.set()
+
+        stats = {**monitor.stats(), "context": context_stats}
+        # Prefill = hasta el primer token; decode = el resto (medidos por el monitor)
+        if monitor.first_token_at is not None:
+            prefix_hit = self.prefix_cache is not None and self.prefix_cache.matches(inputs["input_ids"])
+            record_span("prefill", stats["ttft_s"], start=monitor.started_at, prefix_cache=prefix_hit) # type: ignore
+            record_span(
+                "decode", monitor.finished_at - monitor.first_token_at, start=monitor.first_token_at, # type: ignore
+                tokens=stats["tokens"], cancelled=stats["cancelled"],
+            )
+        logger.info(
+            f"Generación: {stats['tokens']} tokens, TTFT {stats['ttft_s']:.2f}s, "
+            f"{stats['tokens_per_s']:.1f} tokens/s{' (cancelada)' if stats['cancelled'] else ''}"
+        )
+
+        if error is not None:
+            yield {"type": "done", "answer": f"Error al generar la respuesta: {error}", "stats": stats}
+            return
+
+        answer = "".join(pieces).strip()
+        if answer and not stats["cancelled"] and self.answer_cache is not None:
+            self.answer_cache.put(self.retriever.version, cache_key, query_vec, answer) # type: ignore
+        yield {"type": "done", "answer": answer or "No se generó respuesta.", "stats": {**stats, "mode": "generative"}}
+
+    def generate_answers(
+        self,
+        queries: List[str],
+        top_k: int = 3,
+        max_new_tokens: int = 200,
+        filters=None,
+        batch_size: int = 8,
+        answer_mode: str = None, # type: ignore
+    ) -> List[str]:
+        """
+        Versión por lotes de generate_answer para trabajos offline.
+        La recuperación usa TicketRetriever.search_batch y la generación agrupa los
+        prompts ordenados por longitud en lotes con padding a la izquierda.
+        El modo de respuesta y sus umbrales se aplican igual que en stream_answer:
+        solo las consultas que no se responden por el camino extractivo van al LLM.
+        Devuelve una respuesta por consulta; un error en una consulta no afecta al resto.
+        """
+        answers: List = [None] * len(queries)
+        filter_list = filters if isinstance(filters, list) else [filters] * len(queries)
+        mode = check_answer_mode(answer_mode or self.answer_mode)
+
+        # Respuestas ya cacheadas
+        keys, vecs = [None] * len(queries), [None] * len(queries)
+        if self.answer_cache is not None and mode != "extractive":
+            for i, query in enumerate(queries):
+                if not query or not query.strip():
+                    continue
+                keys[i] = (normalize_query(query), top_k, max_new_tokens, filters_key(filter_list[i]))
+                vecs[i] = self.retriever.embed_query(query)
+                answers[i] = self.answer_cache.get(self.retriever.version, keys[i], vecs[i])
+
+        todo = [i for i, a in enumerate(answers) if a is None]
+        retrieved = self.retriever.search_batch(
+            [queries[i] for i in todo], top_k=top_k, filters=[filter_list[i] for i in todo]
+        )
+
+        # Respuestas extractivas y prompts (texto del chat template) de las que van al LLM
+        prompts = {}
+        for i, docs in zip(todo, retrieved):
+            if isinstance(docs, Exception):
+                answers[i] = f"Error al recuperar tickets: {docs}"
+            elif not docs:
+                answers[i] = "No se encontraron documentos relevantes."
+            else:
+                try:
+                    extracted = self._extractive_answer(queries[i], docs, mode, vecs[i])
+                except Exception as e:
+                    answers[i] = f"Error al generar la respuesta: {e}"
+                    continue
+                if extracted is not None:
+                    answers[i] = extracted[0]
+                    continue
+                prompts[i] = self.tokenizer.apply_chat_template(
+                    self.build_prompt(queries[i], docs), add_generation_prompt=True, tokenize=False
+                )
+
+        # Ordenar por longitud en tokens para minimizar el padding de cada lote
+        lengths = {i: len(self.tokenizer(p, add_special_tokens=False)["input_ids"]) for i, p in prompts.items()}
+        order = sorted(prompts, key=lambda i: lengths[i])
+        logger.info(f"Generando {len(order)} respuestas en lotes de {batch_size}...")
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            try:
+                texts = self._generate_batch([prompts[i] for i in batch], max_new_tokens)
+            except Exception as e:
+                # Se aísla el error: se reintenta de a una consulta
+                logger.warning(f"Falló un lote de generación ({e}), reintentando individualmente...")
+                texts = []
+                for i in batch:
+                    try:
+                        texts.append(self._generate_batch([prompts[i]], max_new_tokens)[0])
+                    except Exception as item_error:
+                        logger.error(f"Error durante la generación: {item_error}")
+                        texts.append(item_error)
+            for i, text in zip(batch, texts):
+                if isinstance(text, Exception):
+                    answers[i] = f"Error al generar la respuesta: {text}"
+                    continue
+                answers[i] = text or "No se generó respuesta."
+                if text and self.answer_cache is not None and keys[i] is not None:
+                    self.answer_cache.put(self.retriever.version, keys[i], vecs[i], text) # type: ignore
+
+        return answers
+
+    def _generate_batch(self, prompts: List[str], max_new_tokens: int) -> List[str]:
+        """
+        Genera un lote de prompts (ya con el chat template aplicado), con padding a la izquierda.
+        """
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "left"
+        try:
+            inputs = self.tokenizer(
+                prompts, add_special_tokens=False, padding=True, return_tensors="pt"
             ).to(self.device)
+        finally:
+            self.tokenizer.padding_side = padding_side
 
-            # outputs = self.model.generate(**inputs, max_new_tokens=max_new_tokens)
+        with torch.no_grad():
             outputs = self.model.generate(
                 **inputs,
                 max_new_tokens=max_new_tokens,
-                temperature=0.4,                # más estable
-                top_p=0.9,
-                repetition_penalty=1.1,
-                do_sample=True,                 # mejora la naturalidad
+                pad_token_id=self.tokenizer.pad_token_id,
+                **self.GENERATION_KWARGS,
             )
-            answer = self.tokenizer.decode(
-                outputs[0][inputs["input_ids"].shape[-1]:], skip_special_tokens=True
-            ).strip()
+        prompt_len = inputs["input_ids"].shape[-1]
+        return [
+            self.tokenizer.decode(row[prompt_len:], skip_special_tokens=True).strip()
+            for row in outputs
+        ]
 
-            return answer or "No se generó respuesta."
+    def cache_stats(self) -> dict:
+        stats = self.retriever.cache_stats()
+        if self.answer_cache is not None:
+            stats["answers"] = self.answer_cache.stats()
+        return stats
 
-        except Exception as e:
-            logger.error(f"Error durante la generación: {e}")
-            return f"Error al generar la respuesta: {e}"
+    def answer_stats(self) -> dict:
+        """
+        Fracción de respuestas por el camino extractivo (sin LLM) y motivos de paso al LLM.
+        """
+        thresholds = self.extractive.thresholds if self.retriever.embedder is not None else {}
+        return {
+            "mode": self.answer_mode,
+            **self.answer_mode_stats.stats(),
+            "thresholds": {k: thresholds.get(k) for k in ("min_score", "min_margin", "calibrated")},
+        }
 
 
 if __name__ == "__main__":
@@ -0,0 +1,107 @@
+import time
+import threading
+from typing import Dict
+from rag.utils import setup_logger, read_index_version
+
+logger = setup_logger("index_builder")
+
+
+class IndexBuilder:
+    """
+    Construye el índice en un hilo de fondo (una construcción a la vez) mientras
+    las consultas siguen usando la versión publicada. Al terminar, los retrievers
+    vivos pasan a la versión nueva sin cortar las búsquedas en curso.
+    """
+
+    def __init__(self, index_dir: str = "index/faiss"):
+        self.index_dir = index_dir
+        self._lock = threading.Lock()
+        self._thread = None
+        self._status = self._initial_status()
+
+    def _initial_status(self) -> Dict:
+        return {
+            "state": "idle",
+            "stage": None,
+            "progress": 0.0,
+            "message": "",
+            "started_at": None,
+            "finished_at": None,
+            "version": read_index_version(self.index_dir),
+            "error": None,
+        }
+
+    def _update(self, **fields):
+        with self._lock:
+            self._status.update(fields)
+
+    def _progress(self, stage: str, fraction: float):
+        self._update(stage=stage, progress=round(fraction, 3), message=f"Etapa: {stage}")
+
+    def is_running(self) -> bool:
+        with self._lock:
+            return self._status["state"] == "running"
+
+    def status(self) -> Dict:
+        with self._lock:
+            status = dict(self._status)
+        if status["started_at"] is not None:
+            end = status["finished_at"] or time.time()
+            status["elapsed_s"] = round(end - status["started_at"], 1)
+        return status
+
+    def start(self) -> bool:
+        """
+        Lanza la construcción en segundo plano. Devuelve False si ya hay una en curso.
+        """
+        with self._lock:
+            if self._status["state"] == "running":
+                return False
+            self._status = {
+                **self._initial_status(),
+                "state": "running",
+                "stage": "queued",
+                "message": "Construcción en cola",
+                "started_at": time.time(),
+            }
+            self._thread = threading.Thread(target=self._run, name="index-builder", daemon=True)
+            self._thread.start()
+        return True
+
+    def wait(self, timeout: float = None) -> Dict: # type: ignore
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        return self.status()
+
+    def _run(self):
+        from rag.pipelines import build_index
+
+        try:
+            build_index(progress=self._progress)
+        except Exception as e:
+            logger.exception("Falló la construcción del índice; se mantiene la versión publicada.")
+            self._update(
+                state="failed", error=f"{type(e).__name__}: {e}", message="La construcción falló",
+                finished_at=time.time(),
+            )
+            return
+        self._update(
+            state="done", stage="done", progress=1.0, message="Índice actualizado",
+            finished_at=time.time(), version=read_index_version(self.index_dir),
+        )
+
+
+_builder = None
+_builder_lock = threading.Lock()
+
+
+def get_index_builder() -> IndexBuilder:
+    """
+    Constructor único por proceso (dos builds en paralelo competirían por CURRENT).
+    """
+    global _builder
+    with _builder_lock:
+        if _builder is None:
+            _builder = IndexBuilder()
+        return _builder
@@ -0,0 +1,278 @@
+import os
+import time
+import json
+import argparse
+import numpy as np
+import faiss
+from typing import Dict, List, Optional
+from rag.utils import setup_logger, current_index_dir
+from rag.vector_storage import codec
+
+logger = setup_logger("index_factory")
+
+INDEX_KINDS = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+
+# Umbrales de la selección automática (cantidad de vectores)
+FLAT_MAX_VECTORS = 20_000
+IVF_FLAT_MAX_VECTORS = 1_000_000
+
+DEFAULT_EF_SEARCH = 64
+HNSW_M = 32
+
+
+def auto_index_kind(n_vectors: int) -> str:
+    """
+    Elige el tipo de índice según el tamaño del corpus:
+    exacto para corpus chicos, IVF-Flat en el rango medio e IVF-PQ a partir del millón.
+    """
+    if n_vectors < FLAT_MAX_VECTORS:
+        return "flat"
+    if n_vectors < IVF_FLAT_MAX_VECTORS:
+        return "ivf_flat"
+    return "ivf_pq"
+
+
+def _nlist(n_vectors: int) -> int:
+    # ~4*sqrt(n) listas, con al menos 39 puntos de entrenamiento por centroide
+    nlist = int(4 * np.sqrt(max(n_vectors, 1)))
+    nlist = min(nlist, max(n_vectors // 39, 1))
+    return int(np.clip(nlist, 1, 65536))
+
+
+def _pq_params(dim: int, n_vectors: int):
+    # Subcuantizadores de ~8 dimensiones; menos bits si hay pocos datos de entrenamiento
+    sub_dim = next(d for d in (8, 4, 2, 1) if dim % d == 0)
+    nbits = 8 if n_vectors >= 256 * 39 else max(4, int(np.log2(max(n_vectors // 39, 16))))
+    return dim // sub_dim, nbits
+
+
+def factory_string(kind: str, dim: int, n_vectors: int, storage: str = "float32") -> str:
+    """
+    Descripción para faiss.index_factory, siempre envuelta en IDMap2 (IDs estables).
+    storage elige cómo se guardan los vectores en flat, ivf_flat y hnsw (ver rag.vector_storage);
+    ivf_pq ya los comprime.
+    """
+    vectors = codec(storage)
+    if kind == "flat":
+        return f"IDMap2,{vectors}"
+    if kind == "ivf_flat":
+        return f"IDMap2,IVF{_nlist(n_vectors)},{vectors}"
+    if kind == "ivf_pq":
+        m, nbits = _pq_params(dim, n_vectors)
+        return f"IDMap2,IVF{_nlist(n_vectors)},PQ{m}x{nbits}"
+    if kind == "hnsw":
+        return f"IDMap2,HNSW{HNSW_M},{vectors}"
+    raise ValueError(f"Tipo de índice desconocido: {kind} (opciones: {', '.join(INDEX_KINDS)})")
+
+
+def make_index(kind: str, embeddings: np.ndarray, ids: Optional[np.ndarray] = None, storage: str = "float32"):
+    """
+    Crea, entrena (si corresponde) y llena un índice del tipo pedido.
+    Si kind es "auto" se elige según la cantidad de vectores.
+    """
+    n_vectors, dim = embeddings.shape
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    if kind == "auto":
+        kind = auto_index_kind(n_vectors)
+    description = factory_string(kind, dim, n_vectors, storage=storage)
+    logger.info(f"Creando índice FAISS '{description}' (dim={dim}, n={n_vectors})...")
+
+    index = faiss.index_factory(dim, description, faiss.METRIC_INNER_PRODUCT)
+    if not index.is_trained:
+        start = time.perf_counter()
+        index.train(embeddings)  # type: ignore
+        logger.info(f"Índice entrenado en {time.perf_counter() - start:.2f}s")
+
+    inner = inner_index(index)
+    if isinstance(inner, faiss.IndexIVF):
+        # nprobe por defecto: ~1/16 de las listas (ajustable por consulta)
+        inner.nprobe = max(1, inner.nlist // 16)
+    elif isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = DEFAULT_EF_SEARCH
+
+    if ids is None:
+        ids = np.arange(n_vectors, dtype="int64")
+    if n_vectors:
+        index.add_with_ids(embeddings, ids)  # type: ignore
+    return index
+
+
+def inner_index(index):
+    """
+    Índice real debajo de los envoltorios IDMap/IDMap2.
+    """
+    index = faiss.downcast_index(index)
+    while isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        index = faiss.downcast_index(index.index)
+    return index
+
+
+def index_kind(index) -> str:
+    inner = inner_index(index)
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(inner, (faiss.IndexIVFFlat, faiss.IndexIVFScalarQuantizer)):
+        return "ivf_flat"
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+
+def index_storage(index) -> str:
+    """
+    Cómo guarda los vectores un índice: "float32", "float16", "sq8" o "pq".
+    """
+    inner = inner_index(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        inner = faiss.downcast_index(inner.storage)
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return "pq"
+    if isinstance(inner, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return "float16" if inner.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    return "float32"
+
+
+def supports_removal(index) -> bool:
+    # HNSW no admite remove_ids. En IVF (envuelto en IDMap2) remove_ids compacta el id_map
+    # pero las listas invertidas conservan sus posiciones viejas, y los IDs devueltos
+    # quedan corridos: solo Flat se actualiza en el lugar, el resto se reconstruye
+    # desde los embeddings
+    return index_kind(index) == "flat"
+
+
+def search_params(index, nprobe: Optional[int] = None, ef_search: Optional[int] = None, sel=None):
+    """
+    Parámetros de búsqueda por consulta (None si se usan los del índice).
+    sel es un faiss.IDSelector opcional que se aplica dentro de la búsqueda.
+    """
+    inner = inner_index(index)
+    if isinstance(inner, faiss.IndexIVF) and (nprobe is not None or sel is not None):
+        # SearchParametersIVF pisa el nprobe del índice: se conserva si no se pidió otro
+        params = faiss.SearchParametersIVF(nprobe=int(nprobe or inner.nprobe))
+    elif isinstance(inner, faiss.IndexHNSW) and (ef_search is not None or sel is not None):
+        params = faiss.SearchParametersHNSW(efSearch=int(ef_search or inner.hnsw.efSearch))
+    elif sel is not None:
+        params = faiss.SearchParameters()
+    else:
+        return None
+    if sel is not None:
+        params.sel = sel
+    return params
+
+
+def exhaustive_params(index, top_k: int, sel=None):
+    """
+    Parámetros de búsqueda "amplios" para reintentar cuando un filtro muy selectivo
+    deja menos de k resultados en IVF/HNSW (None si el índice ya es exacto).
+    """
+    inner = inner_index(index)
+    if isinstance(inner, faiss.IndexIVF):
+        return search_params(index, nprobe=inner.nlist, sel=sel)
+    if isinstance(inner, faiss.IndexHNSW):
+        return search_params(index, ef_search=max(1024, 16 * top_k), sel=sel)
+    return None
+
+
+def index_size_bytes(index) -> int:
+    return int(faiss.serialize_index(index).size)
+
+
+def evaluate_index_kinds(
+    embeddings: np.ndarray,
+    kinds: List[str] = None, # type: ignore
+    k: int = 10,
+    n_queries: int = 200,
+    nprobe_values: List[int] = None, # type: ignore
+    ef_search_values: List[int] = None, # type: ignore
+    noise: float = 0.05,
+    seed: int = 0,
+) -> List[Dict]:
+    """
+    Compara cada tipo de índice contra la búsqueda exacta (Flat):
+    recall@k, latencia por consulta, tiempo de construcción y tamaño del índice.
+    Las consultas son embeddings del corpus con ruido gaussiano, renormalizados.
+    """
+    kinds = kinds or list(INDEX_KINDS)
+    nprobe_values = nprobe_values or [1, 4, 16, 64]
+    ef_search_values = ef_search_values or [16, 64, 256]
+    rng = np.random.default_rng(seed)
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    sample = rng.choice(len(embeddings), size=min(n_queries, len(embeddings)), replace=False)
+    queries = embeddings[sample] + rng.normal(0, noise, (len(sample), embeddings.shape[1])).astype("float32")
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    exact = faiss.IndexFlatIP(embeddings.shape[1])
+    exact.add(embeddings)  # type: ignore
+    _, truth = exact.search(queries, k)  # type: ignore
+
+    report = []
+    for kind in kinds:
+        start = time.perf_counter()
+        index = make_index(kind, embeddings)
+        build_seconds = time.perf_counter() - start
+        size = index_size_bytes(index)
+
+        inner = inner_index(index)
+        if isinstance(inner, faiss.IndexIVF):
+            settings = [{"nprobe": p} for p in nprobe_values if p <= inner.nlist]
+        elif isinstance(inner, faiss.IndexHNSW):
+            settings = [{"ef_search": ef} for ef in ef_search_values]
+        else:
+            settings = [{}]
+
+        for setting in settings:
+            params = search_params(index, **setting)
+            latencies, found = [], []
+            for q in queries:
+                t0 = time.perf_counter()
+                _, ids = index.search(q.reshape(1, -1), k, params=params)
+                latencies.append(time.perf_counter() - t0)
+                found.append(ids[0])
+            recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+            latencies = np.array(latencies) * 1000
+            report.append({
+                "kind": kind,
+                **setting,
+                "recall_at_k": float(recall),
+                "k": k,
+                "latency_ms_p50": float(np.percentile(latencies, 50)),
+                "latency_ms_p99": float(np.percentile(latencies, 99)),
+                "build_seconds": build_seconds,
+                "index_bytes": size,
+                "n_vectors": len(embeddings),
+            })
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evalúa tipos de índice FAISS sobre embeddings.npy")
+    parser.add_argument("--embeddings", default=None, help="Por defecto, los de la versión publicada del índice")
+    parser.add_argument("--kinds", default=",".join(INDEX_KINDS))
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--output", default=None, help="Ruta opcional para guardar el reporte en JSON")
+    args = parser.parse_args()
+
+    if args.embeddings is None:
+        args.embeddings = os.path.join(current_index_dir("index/faiss"), "embeddings.npy")
+    if not os.path.exists(args.embeddings):
+        raise FileNotFoundError(f"No se encontraron embeddings en {args.embeddings}")
+    embeddings = np.load(args.embeddings).astype("float32")
+    report = evaluate_index_kinds(embeddings, kinds=args.kinds.split(","), k=args.k, n_queries=args.queries)
+
+    print(f"\n{'tipo':<10}{'param':<16}{'recall@k':>10}{'p50 ms':>10}{'p99 ms':>10}{'build s':>10}{'MB':>10}")
+    for row in report:
+        param = ", ".join(f"{p}={row[p]}" for p in ("nprobe", "ef_search") if p in row)
+        print(
+            f"{row['kind']:<10}{param:<16}{row['recall_at_k']:>10.3f}{row['latency_ms_p50']:>10.3f}"
+            f"{row['latency_ms_p99']:>10.3f}{row['build_seconds']:>10.2f}{row['index_bytes'] / 2**20:>10.2f}"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Reporte guardado en {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import gc
+import json
+import time
+import argparse
+import torch
+from typing import Dict, List, Optional
+from transformers import AutoModelForCausalLM
+from rag.utils import setup_logger
+
+logger = setup_logger("inference")
+
+# Backends de inferencia del generador
+BACKENDS = ("auto", "fp16", "bf16", "fp32", "int8", "onnx")
+_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32}
+
+
+def cpu_supports_bf16() -> bool:
+    """
+    True si la CPU tiene instrucciones bf16 nativas (AVX512-BF16/AMX); si no,
+    bf16 se emula y suele ser más lento que fp32.
+    """
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def resolve_backend(backend: str, device: str) -> str:
+    """
+    Traduce "auto" al backend adecuado para el dispositivo y valida combinaciones.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Backend desconocido: {backend} (opciones: {', '.join(BACKENDS)})")
+    if backend == "auto":
+        if device.startswith("cuda"):
+            return "fp16"
+        return "bf16" if cpu_supports_bf16() else "fp32"
+    if backend in ("int8", "onnx") and not device.startswith("cpu"):
+        raise ValueError(f"El backend {backend} solo está disponible en CPU")
+    if backend == "fp16" and device.startswith("cpu"):
+        logger.warning("float16 en CPU es lento o emulado; conviene bf16 o fp32.")
+    return backend
+
+
+def configure_threads(num_threads: Optional[int] = None, num_interop_threads: Optional[int] = None):
+    """
+    Hilos intra-op (dentro de cada operación) e inter-op (entre operaciones) de torch.
+    El inter-op solo se puede fijar antes del primer trabajo en paralelo del proceso.
+    """
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            logger.warning(f"No se pudo cambiar los hilos inter-op (ya hubo trabajo en paralelo): {e}")
+    logger.info(f"Hilos torch: intra-op={torch.get_num_threads()}, inter-op={torch.get_num_interop_threads()}")
+
+
+def load_generation_model(
+    model_name: str,
+    backend: str,
+    device: str,
+    num_threads: Optional[int] = None,
+    num_interop_threads: Optional[int] = None,
+):
+    """
+    Carga el LLM con el backend pedido:
+    - fp16 / bf16 / fp32: pesos en ese dtype
+    - int8: cuantización dinámica int8 de las capas Linear (CPU)
+    - onnx: modelo exportado a ONNX y ejecutado con ONNX Runtime (requiere optimum[onnxruntime])
+    Devuelve (modelo, backend efectivo).
+    """
+    backend = resolve_backend(backend, device)
+    configure_threads(num_threads, num_interop_threads)
+
+    if backend == "onnx":
+        try:
+            import onnxruntime as ort
+            from optimum.onnxruntime import ORTModelForCausalLM
+        except ImportError as e:
+            raise ImportError("El backend onnx requiere 'optimum[onnxruntime]'") from e
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        if num_interop_threads:
+            options.inter_op_num_threads = num_interop_threads
+        model = ORTModelForCausalLM.from_pretrained(
+            model_name, export=True, use_cache=True, provider="CPUExecutionProvider", session_options=options
+        )
+        return model, backend
+
+    dtype = torch.float32 if backend == "int8" else _DTYPES[backend]
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=dtype,
+        low_cpu_mem_usage=True,
+    ).to(device) # type: ignore
+    model.eval()
+
+    if backend == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model, backend
+
+
+def compare_backends(
+    queries: List[str],
+    backends: List[str] = None, # type: ignore
+    baseline: str = "fp32",
+    max_new_tokens: int = 64,
+    num_threads: Optional[int] = None,
+) -> Dict:
+    """
+    Reporte calidad/latencia por backend: tokens/seg con decodificación greedy y
+    coincidencia de la respuesta contra el backend de referencia (exacta y por token).
+    Los prompts se arman con el retriever real (mismos tickets para todos los backends).
+    """
+    from rag.generator import TicketAnswerGenerator
+    from rag.resources import get_registry
+
+    backends = backends or ["fp32", "bf16", "int8"]
+    retriever = get_registry().get_retriever()
+    order = [baseline] + [b for b in backends if b != baseline]
+    outputs: Dict[str, List[List[int]]] = {}
+    report: Dict = {"baseline": baseline, "max_new_tokens": max_new_tokens, "backends": {}}
+
+    for backend in order:
+        try:
+            start = time.perf_counter()
+            generator = TicketAnswerGenerator(
+                backend=backend, device="cpu", retriever=retriever, num_threads=num_threads, use_prefix_cache=False
+            )
+            load_s = time.perf_counter() - start
+        except Exception as e:
+            logger.error(f"No se pudo cargar el backend {backend}: {e}")
+            report["backends"][backend] = {"error": str(e)}
+            continue
+
+        tokens, elapsed, generated = 0, 0.0, []
+        for query in queries:
+            docs = retriever.search(query, top_k=3)
+            inputs = generator.tokenizer.apply_chat_template(
+                generator.build_prompt(query, docs),
+                add_generation_prompt=True, tokenize=True, return_dict=True, return_tensors="pt",
+            )
+            start = time.perf_counter()
+            with torch.no_grad():
+                out = generator.model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
+            elapsed += time.perf_counter() - start
+            new_tokens = out[0][inputs["input_ids"].shape[-1]:].tolist()
+            tokens += len(new_tokens)
+            generated.append(new_tokens)
+        outputs[backend] = generated
+
+        row = {"load_seconds": load_s, "tokens_per_s": tokens / elapsed if elapsed else 0.0}
+        reference = outputs.get(baseline)
+        if reference is not None:
+            exact = [a == b for a, b in zip(generated, reference)]
+            per_token = [
+                sum(x == y for x, y in zip(a, b)) / max(len(a), len(b), 1)
+                for a, b in zip(generated, reference)
+            ]
+            row["exact_match"] = sum(exact) / len(exact) if exact else 0.0
+            row["token_agreement"] = sum(per_token) / len(per_token) if per_token else 0.0
+        report["backends"][backend] = row
+
+        del generator
+        gc.collect()
+
+    base_tps = report["backends"].get(baseline, {}).get("tokens_per_s")
+    for row in report["backends"].values():
+        if base_tps and "tokens_per_s" in row:
+            row["speedup"] = row["tokens_per_s"] / base_tps
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compara backends de inferencia del generador en CPU")
+    parser.add_argument("queries", nargs="+", help="Consultas de prueba")
+    parser.add_argument("--backends", default="fp32,bf16,int8")
+    parser.add_argument("--baseline", default="fp32")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    report = compare_backends(
+        args.queries,
+        backends=args.backends.split(","),
+        baseline=args.baseline,
+        max_new_tokens=args.max_new_tokens,
+        num_threads=args.threads,
+    )
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,85 +1,381 @@
 import os
 import json
+import time
 import shutil
+import argparse
+import hashlib
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
-from typing import List
+from typing import Dict, Iterator, List
 from rag.schema import MantisTicket
-from rag.chunkers import chunk_text
+from rag.chunkers import get_chunker
 from rag.utils import setup_logger, ensure_dirs
 
 logger = setup_logger("ingest")
 
+STATE_FILE = "ingest_state.json"
+# Tickets que se tokenizan juntos al dividir en chunks
+CHUNK_BATCH = 256
+
+# Estado conocido {ticket_id: versión} que cada worker recibe una sola vez
+_known_versions: Dict[str, str] = {}
+
+
 def load_json_files(raw_dir: str = "data/raw") -> List[str]:
     # Devuelve la lista de archivos .json a procesar
     files = [f for f in os.listdir(raw_dir) if f.endswith(".json")]
     return files
 
-def process_tickets(raw_dir: str = "data/raw", output_dir: str = "data/processed", processed_raw_dir: str = "data/processed_raw"):
+
+class _JSONStream:
     """
-    Lee archivos JSON desde data/raw/,
-    Los valida, los convierte en chunks y exporta a data/processed/tickets_processed.jsonl.
-    Luego mueve los archivos procesados a data/processed_raw/.
+    Lectura incremental de un archivo JSON: un buffer de a chunk_size caracteres
+    del que se decodifican valores sueltos con raw_decode.
+    """
+
+    def __init__(self, f, path: str, chunk_size: int):
+        self.f = f
+        self.path = path
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = f.read(chunk_size).lstrip("\ufeff")
+        self.pos = 0
+
+    def peek(self, skip: str = " \t\r\n") -> str:
+        """
+        Próximo carácter significativo sin consumirlo ("" al final del archivo).
+        """
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in skip:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            more = self.f.read(self.chunk_size)
+            if not more:
+                return ""
+            self.buf, self.pos = more, 0
+
+    def expect(self, char: str):
+        if self.peek() != char:
+            raise ValueError(f"JSON inválido en {self.path}: se esperaba '{char}'")
+        self.pos += 1
+
+    def value(self):
+        """
+        Decodifica el próximo valor. Si el valor llega hasta el final del buffer (un
+        elemento incompleto o un número cortado) se descarta lo ya consumido y se lee más.
+        """
+        self.peek()
+        while True:
+            try:
+                item, end = self.decoder.raw_decode(self.buf, self.pos)
+                complete = end < len(self.buf)
+            except json.JSONDecodeError:
+                item, complete = None, False
+            if not complete:
+                more = self.f.read(self.chunk_size)
+                if more:
+                    self.buf, self.pos = self.buf[self.pos:] + more, 0
+                    continue
+                if item is None:
+                    raise ValueError(f"JSON incompleto en {self.path}")
+            self.pos = end
+            return item
+
+    def array_items(self) -> Iterator:
+        self.expect("[")
+        while True:
+            char = self.peek(" \t\r\n,")
+            if char == "":
+                raise ValueError(f"Lista JSON sin cerrar en {self.path}")
+            if char == "]":
+                self.pos += 1
+                return
+            yield self.value()
+
+
+def iter_json_items(path: str, chunk_size: int = 1 << 20) -> Iterator[dict]:
+    """
+    Recorre los tickets de un export sin cargarlo entero en memoria.
+    Soporta un ticket suelto, una lista de tickets o el formato de la API de
+    Mantis {"issues": [...]}; las listas se leen en streaming.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        stream = _JSONStream(f, path, chunk_size)
+        first = stream.peek()
+        if first == "[":
+            yield from stream.array_items()
+            return
+        if first != "{":
+            raise ValueError(f"Formato JSON no soportado en {path}")
+
+        # Objeto: se recorre clave por clave; la lista "issues" (export de la API) no se carga entera
+        stream.expect("{")
+        fields = {}
+        while True:
+            char = stream.peek(" \t\r\n,")
+            if char == "}":
+                break
+            if char == "":
+                raise ValueError(f"Objeto JSON sin cerrar en {path}")
+            key = stream.value()
+            stream.expect(":")
+            if key == "issues" and stream.peek() == "[":
+                # El resto del export (paginación, etc.) no tiene tickets
+                yield from stream.array_items()
+                return
+            fields[key] = stream.value()
+        yield fields
+
+
+def ticket_version(ticket: MantisTicket) -> str:
+    """
+    Versión de un ticket para la deduplicación: updated_at, o un hash del
+    texto si el export no trae la fecha de actualización.
+    """
+    if ticket.updated_at:
+        return ticket.updated_at.isoformat()
+    return "sha1:" + hashlib.sha1(ticket.canonical_text().encode("utf-8")).hexdigest()
+
+
+def ticket_records(ticket: MantisTicket, chunks: List[dict] = None) -> List[dict]: # type: ignore
+    """
+    Convierte un ticket validado en los registros (chunks) de tickets_processed.jsonl.
+    """
+    if chunks is None:
+        chunks = get_chunker().chunk_text(ticket.canonical_text())
+    records = []
+    for idx, ch in enumerate(chunks):
+        records.append({
+            "ticket_id": ticket.id,
+            "chunk_id": idx,
+            "content": ch["content"],
+            "start_word": ch["start_word"],
+            "end_word": ch["end_word"],
+            "project": ticket.project.get("name") if ticket.project else None,
+            "category": ticket.category.get("name") if ticket.category else None,
+            "status": ticket.status.get("name") if ticket.status else None,
+            "created_at": str(ticket.created_at) if ticket.created_at else None,
+            "updated_at": str(ticket.updated_at) if ticket.updated_at else None,
+        })
+    return records
+
+
+def tombstone_record(ticket_id) -> dict:
+    """
+    Marca de borrado de un ticket en tickets_processed.jsonl (ver rag.store_faiss.load_latest_chunks).
+    """
+    return {"ticket_id": ticket_id, "deleted": True}
+
+
+def is_newer(version: str, known: str = None) -> bool: # type: ignore
+    """
+    True si version reemplaza a la versión conocida del ticket (o no había ninguna).
+    Si ambas son fechas se comparan como fechas; si no, cualquier diferencia cuenta.
+    """
+    if known is None:
+        return True
+    if version == known:
+        return False
+    try:
+        return datetime.fromisoformat(version) > datetime.fromisoformat(known)
+    except (ValueError, TypeError):
+        return True
+
+
+def _init_worker(known_versions: Dict[str, str]):
+    global _known_versions
+    _known_versions = known_versions
+
+
+def process_file(path: str) -> Dict:
+    """
+    Parsea, valida y divide en chunks un archivo (se ejecuta en un worker).
+    Los tickets cuya versión ya fue ingerida se saltean antes de trocear.
+    """
+    start = time.perf_counter()
+    report = {
+        "file": os.path.basename(path), "tickets": 0, "unchanged": 0,
+        "invalid": 0, "warnings": [], "error": None, "tickets_out": [],
+    }
+    pending: List = []
+
+    def _flush():
+        # Todos los tickets pendientes se tokenizan en una sola pasada
+        chunks = get_chunker().chunk_texts([ticket.canonical_text() for ticket, _ in pending])
+        for (ticket, version), ticket_chunks in zip(pending, chunks):
+            report["tickets_out"].append((str(ticket.id), version, ticket_records(ticket, ticket_chunks)))
+        pending.clear()
+
+    try:
+        for item in iter_json_items(path):
+            report["tickets"] += 1
+            try:
+                ticket = MantisTicket(**item)
+                version = ticket_version(ticket)
+                if not is_newer(version, _known_versions.get(str(ticket.id))):
+                    report["unchanged"] += 1
+                    continue
+                pending.append((ticket, version))
+            except Exception as e:
+                report["invalid"] += 1
+                report["warnings"].append(f"Ticket inválido dentro de {report['file']}: {e}")
+            if len(pending) >= CHUNK_BATCH:
+                _flush()
+        _flush()
+    except Exception as e:
+        report["error"] = str(e)
+    report["seconds"] = time.perf_counter() - start
+    return report
+
+
+def _load_state(state_path: str, output_path: str) -> Dict[str, str]:
+    # Sin el archivo de salida el estado no sirve: se vuelve a ingerir todo
+    if not os.path.exists(state_path) or not os.path.exists(output_path):
+        return {}
+    with open(state_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_state(state_path: str, state: Dict[str, str]):
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def ingest_files(
+    raw_dir: str = "data/raw",
+    output_dir: str = "data/processed",
+    processed_raw_dir: str = "data/processed_raw",
+    workers: int = None, # type: ignore
+) -> Dict:
+    """
+    Ingesta en paralelo (un proceso por archivo), en streaming e idempotente:
+    solo se emiten los tickets nuevos o cuyo updated_at cambió.
+    Devuelve un reporte con métricas de throughput y errores por archivo.
     """
     ensure_dirs()
     os.makedirs(processed_raw_dir, exist_ok=True)
 
+    output_path = os.path.join(output_dir, "tickets_processed.jsonl")
+    state_path = os.path.join(output_dir, STATE_FILE)
+    report: Dict = {"output_path": output_path, "files": [], "tickets": 0, "new_tickets": 0, "chunks": 0}
+
     files = load_json_files(raw_dir)
     if not files:
         logger.info("No hay nuevos archivos para procesar en data/raw/")
-        return
+        return report
 
     logger.info(f"{len(files)} archivos encontrados para procesar.")
-    output_path = os.path.join(output_dir, "tickets_processed.jsonl")
+    state = _load_state(state_path, output_path)
+    paths = [os.path.join(raw_dir, f) for f in files]
+    workers = workers or min(len(paths), os.cpu_count() or 1)
+
+    start = time.perf_counter()
+    if workers <= 1:
+        _init_worker(state)
+        results = (process_file(p) for p in paths)
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(state,))
+        results = (f.result() for f in as_completed([pool.submit(process_file, p) for p in paths]))
 
     with open(output_path, "a", encoding="utf-8") as out:  # modo append por si ya existe
-        for file in tqdm(files, desc="Procesando archivos"):
-            path = os.path.join(raw_dir, file)
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                    if isinstance(data, dict):
-                        data = [data]  # convertir a lista si es un solo ticket
-
-                for item in data:
-                    try:
-                        ticket = MantisTicket(**item)
-                        text = ticket.canonical_text()
-                        chunks = chunk_text(text)
-                        for idx, ch in enumerate(chunks):
-                            record = {
-                                "ticket_id": ticket.id,
-                                "chunk_id": idx,
-                                "content": ch["content"],
-                                "start_word": ch["start_word"],
-                                "end_word": ch["end_word"],
-                                "project": ticket.project.get("name") if ticket.project else None,
-                                "category": ticket.category.get("name") if ticket.category else None,
-                                "status": ticket.status.get("name") if ticket.status else None,
-                                "created_at": str(ticket.created_at) if ticket.created_at else None,
-                            }
-                            out.write(json.dumps(record, ensure_ascii=False) + "\n")
-
-                    except Exception as e:
-                        logger.warning(f"Ticket inválido dentro de {file}: {e}")
+        for result in tqdm(results, total=len(paths), desc="Procesando archivos"):
+            for warning in result["warnings"]:
+                logger.warning(warning)
+            file = result["file"]
+            if result["error"]:
+                logger.error(f"Error procesando {file}: {result['error']}")
+            else:
+                for ticket_id, version, records in result["tickets_out"]:
+                    # Puede venir repetido (re-subido o en dos archivos): gana la versión más nueva
+                    if not is_newer(version, state.get(ticket_id)):
+                        result["unchanged"] += 1
+                        continue
+                    for record in records:
+                        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    state[ticket_id] = version
+                    report["new_tickets"] += 1
+                    report["chunks"] += len(records)
 
                 # Mover archivo procesado a processed_raw/
-                shutil.move(path, os.path.join(processed_raw_dir, file))
+                shutil.move(os.path.join(raw_dir, file), os.path.join(processed_raw_dir, file))
                 logger.info(f"Archivo {file} procesado y movido a {processed_raw_dir}/")
 
-            except Exception as e:
-                logger.error(f"Error procesando {file}: {e}")
+            report["tickets"] += result["tickets"]
+            report["files"].append({k: v for k, v in result.items() if k not in ("tickets_out", "warnings")})
 
-    logger.info(f"Todos los archivos fueron procesados y exportados a {output_path}")
-    return output_path
+    if workers > 1:
+        pool.shutdown() # type: ignore
+    _save_state(state_path, state)
+
+    elapsed = time.perf_counter() - start
+    report["seconds"] = elapsed
+    report["tickets_per_s"] = report["tickets"] / elapsed if elapsed else 0.0
+    report["chunks_per_s"] = report["chunks"] / elapsed if elapsed else 0.0
+    logger.info(
+        f"Ingesta: {report['tickets']} tickets ({report['new_tickets']} nuevos o modificados), "
+        f"{report['chunks']} chunks en {elapsed:.2f}s "
+        f"({report['tickets_per_s']:.1f} tickets/s, {report['chunks_per_s']:.1f} chunks/s)"
+    )
+    return report
+
+
+def delete_tickets(ticket_ids: List, output_dir: str = "data/processed") -> Dict:
+    """
+    Registra tickets borrados en Mantis: el archivo procesado solo crece, así que se
+    agrega una marca de borrado por ticket y el próximo build quita sus chunks del
+    índice. Se quitan también del estado, así una nueva exportación del mismo ticket
+    vuelve a ingerirse.
+    """
+    ensure_dirs()
+    output_path = os.path.join(output_dir, "tickets_processed.jsonl")
+    state_path = os.path.join(output_dir, STATE_FILE)
+    state = _load_state(state_path, output_path)
+    unknown = [t for t in ticket_ids if str(t) not in state]
+    if unknown:
+        logger.warning(f"Tickets sin versión ingerida, se marcan igual como borrados: {unknown}")
+
+    with open(output_path, "a", encoding="utf-8") as out:
+        for ticket_id in ticket_ids:
+            out.write(json.dumps(tombstone_record(ticket_id), ensure_ascii=False) + "\n")
+            state.pop(str(ticket_id), None)
+    _save_state(state_path, state)
+
+    logger.info(f"{len(ticket_ids)} tickets marcados como borrados en {output_path}")
+    return {"output_path": output_path, "deleted": len(ticket_ids), "unknown": unknown}
+
+
+def process_tickets(raw_dir: str = "data/raw", output_dir: str = "data/processed", processed_raw_dir: str = "data/processed_raw"):
+    """
+    Lee archivos JSON desde data/raw/,
+    Los valida, los convierte en chunks y exporta a data/processed/tickets_processed.jsonl.
+    Luego mueve los archivos procesados a data/processed_raw/.
+    """
+    report = ingest_files(raw_dir, output_dir, processed_raw_dir)
+    if not report["files"]:
+        return
+    logger.info(f"Todos los archivos fueron procesados y exportados a {report['output_path']}")
+    return report["output_path"]
 
 
 def main():
     """
     Punto de entrada principal del proceso de ingesta.
     """
+    parser = argparse.ArgumentParser(description="Ingesta de tickets de Mantis a data/processed")
+    parser.add_argument(
+        "--delete", type=int, nargs="+", metavar="TICKET_ID",
+        help="Marcar tickets como borrados (el próximo build los quita del índice) en vez de ingerir",
+    )
+    args = parser.parse_args()
+    if args.delete:
+        delete_tickets(args.delete)
+        return
     process_tickets()
 
 
 if __name__ == "__main__":
     main()
-
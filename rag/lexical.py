@@ -0,0 +1,115 @@
+import os
+import re
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+from rag.utils import setup_logger
+
+logger = setup_logger("lexical")
+
+# Constante k de Reciprocal Rank Fusion (valor estándar de la literatura)
+RRF_K = 60
+
+# Consulta que es solo un número de ticket: "1234", "#1234", "ticket 1234", "issue #1234"
+_TICKET_QUERY = re.compile(r"^\s*(?:(?:ticket|issue|incidencia)\s*)?#?\s*(\d{2,})\s*$", re.IGNORECASE)
+# Token con pinta de código: letras y dígitos mezclados (ERR-1042, SN4F22A, 0x80070005) o un número largo
+_CODE_TOKEN = re.compile(r"^(?=.*\d)[\w\-./:]{3,}$")
+_TOKEN = re.compile(r"[\w\-]+", re.UNICODE)
+
+_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
+    content,
+    tokenize = "unicode61 remove_diacritics 2 tokenchars '-_'"
+);
+"""
+
+
+def classify_query(query: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Detecta consultas que son búsquedas exactas y no necesitan embeddings:
+    ("ticket", id) si es un número de ticket, ("code", query) si todos sus tokens
+    (a lo sumo 3) parecen códigos de error, seriales o números. Si no, (None, None).
+    """
+    match = _TICKET_QUERY.match(query)
+    if match:
+        return "ticket", match.group(1)
+    tokens = query.split()
+    if 0 < len(tokens) <= 3 and all(_CODE_TOKEN.match(t) for t in tokens):
+        return "code", query
+    return None, None
+
+
+def fts_query(query: str) -> Optional[str]:
+    """
+    Consulta FTS5 con OR de los términos entre comillas (BM25 pondera por rareza).
+    """
+    terms = {t.lower() for t in _TOKEN.findall(query) if len(t) > 1}
+    if not terms:
+        return None
+    return " OR ".join('"' + t.replace('"', '""') + '"' for t in sorted(terms))
+
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int = RRF_K) -> List[Tuple[int, float]]:
+    """
+    Fusiona listas de IDs ordenadas por relevancia: score = suma de 1 / (k + rank).
+    """
+    scores: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, vid in enumerate(ranking, start=1):
+            scores[vid] = scores.get(vid, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda x: -x[1])
+
+
+class LexicalIndex:
+    """
+    Índice invertido BM25 (SQLite FTS5) del contenido de los chunks, con el ID de
+    FAISS como rowid. Vive junto al índice FAISS y recibe el mismo delta en cada build.
+    """
+
+    def __init__(self, path: str = "index/faiss/lexical.sqlite", readonly: bool = False):
+        self.path = path
+        self._lock = threading.Lock()
+
+        if readonly:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"No se encontró el índice léxico en {path}")
+            uri = f"file:{os.path.abspath(path)}?mode=ro"
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.executescript(_SCHEMA)
+        self._conn.execute("PRAGMA mmap_size=268435456")
+
+    def close(self):
+        self._conn.close()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chunks_fts").fetchone()[0]
+
+    def apply_delta(self, upserts: List[Dict], deletes: Iterable[int]):
+        """
+        Bajas y altas en una sola transacción (mismo delta que el MetadataStore).
+        """
+        deletes = [(int(v),) for v in deletes] + [(int(m["vector_id"]),) for m in upserts]
+        rows = [(int(m["vector_id"]), m["content"]) for m in upserts]
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM chunks_fts WHERE rowid = ?", deletes)
+            self._conn.executemany("INSERT INTO chunks_fts (rowid, content) VALUES (?, ?)", rows)
+
+    def search(self, query: str, top_k: int = 10) -> List[Tuple[int, float]]:
+        """
+        [(vector_id, score BM25)] de mayor a menor relevancia.
+        """
+        match = fts_query(query)
+        if match is None:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT rowid, bm25(chunks_fts) AS rank FROM chunks_fts "
+                "WHERE chunks_fts MATCH ? ORDER BY rank LIMIT ?",
+                (match, top_k),
+            ).fetchall()
+        # FTS5 devuelve bm25 negativo (más chico = mejor)
+        return [(int(vid), -float(rank)) for vid, rank in rows]
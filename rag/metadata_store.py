@@ -0,0 +1,226 @@
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List
+from rag.utils import setup_logger
+
+logger = setup_logger("metadata_store")
+
+# Columnas livianas (se pueden leer completas sin cargar los textos)
+META_FIELDS = [
+    "ticket_id", "chunk_id", "content_hash", "start_word", "end_word",
+    "project", "category", "status", "created_at",
+]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    vector_id INTEGER PRIMARY KEY,
+    ticket_id,
+    chunk_id INTEGER,
+    content_hash TEXT,
+    start_word INTEGER,
+    end_word INTEGER,
+    project TEXT,
+    category TEXT,
+    status TEXT,
+    created_at TEXT,
+    content TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_chunks_ticket ON chunks(ticket_id);
+CREATE TABLE IF NOT EXISTS duplicates (
+    member_id INTEGER PRIMARY KEY,
+    vector_id INTEGER,
+    ticket_id,
+    chunk_id INTEGER,
+    content_hash TEXT,
+    start_word INTEGER,
+    end_word INTEGER,
+    project TEXT,
+    category TEXT,
+    status TEXT,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_duplicates_vector ON duplicates(vector_id);
+CREATE INDEX IF NOT EXISTS idx_duplicates_ticket ON duplicates(ticket_id);
+"""
+
+
+class MetadataStore:
+    """
+    Metadatos de los chunks en SQLite, indexados por el ID de FAISS (rowid).
+    Reemplaza a metadatas.npy: no hay que deserializar todo el corpus al arrancar,
+    el contenido se lee solo para los top-k, el archivo se comparte entre procesos
+    vía la caché de páginas del sistema (mmap) y admite altas y bajas incrementales.
+    """
+
+    def __init__(self, path: str = "index/faiss/metadata.sqlite", readonly: bool = False):
+        self.path = path
+        self.readonly = readonly
+        self._lock = threading.Lock()
+
+        if readonly:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"No se encontró el archivo de metadatos en {path}")
+            uri = f"file:{os.path.abspath(path)}?mode=ro"
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            # La tabla de duplicados sin los metadatos de cada miembro se recrea (replace_duplicates la vuelve a llenar)
+            if self._duplicate_columns() and "status" not in self._duplicate_columns():
+                self._conn.execute("DROP TABLE duplicates")
+            self._conn.executescript(_SCHEMA)
+        # Lecturas vía mmap: las páginas quedan compartidas entre workers
+        self._conn.execute("PRAGMA mmap_size=268435456")
+        # Chunks casi duplicados colapsados en otro (ver rag.dedup); las versiones anteriores no tienen
+        # la tabla, o la tienen sin los metadatos de cada miembro y se ignora
+        self._has_duplicates = set(META_FIELDS) <= self._duplicate_columns()
+
+    def _duplicate_columns(self) -> set:
+        return {row[1] for row in self._conn.execute("PRAGMA table_info(duplicates)")}
+
+    def close(self):
+        self._conn.close()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def content_hashes(self) -> Dict[int, str]:
+        """
+        {vector_id: content_hash} de todo el índice (para calcular el delta).
+        """
+        with self._lock:
+            return dict(self._conn.execute("SELECT vector_id, content_hash FROM chunks"))
+
+    def get_many(self, vector_ids: Iterable[int], with_content: bool = True) -> Dict[int, Dict]:
+        """
+        Metadatos de los IDs pedidos (los inexistentes se omiten). Un chunk colapsado
+        como casi duplicado se devuelve con sus propios metadatos, el contenido de su
+        representante y el ID de este en duplicate_of. Cada resultado de un grupo trae
+        los demás tickets del grupo en duplicate_ticket_ids.
+        """
+        vector_ids = [int(v) for v in vector_ids]
+        if not vector_ids:
+            return {}
+        columns = ["vector_id"] + META_FIELDS + (["content"] if with_content else [])
+        placeholders = ",".join("?" * len(vector_ids))
+        query = f"SELECT {', '.join(columns)} FROM chunks WHERE vector_id IN ({placeholders})"
+        with self._lock:
+            rows = self._conn.execute(query, vector_ids).fetchall()
+        metas = {row[0]: dict(zip(columns, row)) for row in rows}
+        if not self._has_duplicates:
+            return metas
+
+        missing = [v for v in vector_ids if v not in metas]
+        member_rows = []
+        if missing:
+            member_columns = ", ".join(
+                ["d.member_id", "d.vector_id"] + [f"d.{f}" for f in META_FIELDS] + (["c.content"] if with_content else [])
+            )
+            with self._lock:
+                member_rows = self._conn.execute(
+                    f"SELECT {member_columns} FROM duplicates d JOIN chunks c ON c.vector_id = d.vector_id "
+                    f"WHERE d.member_id IN ({','.join('?' * len(missing))})",
+                    missing,
+                ).fetchall()
+        for row in member_rows:
+            metas[row[0]] = {**dict(zip(columns, row[:1] + row[2:])), "duplicate_of": row[1]}
+
+        # Tickets de cada grupo: el del representante y los de sus miembros
+        group_of = {vid: meta.get("duplicate_of", vid) for vid, meta in metas.items()}
+        reps = sorted(set(group_of.values()))
+        if not reps:
+            return metas
+        placeholders = ",".join("?" * len(reps))
+        with self._lock:
+            pairs = self._conn.execute(
+                f"SELECT vector_id, ticket_id FROM duplicates WHERE vector_id IN ({placeholders}) ORDER BY member_id",
+                reps,
+            ).fetchall()
+            if pairs:
+                pairs = self._conn.execute(
+                    f"SELECT vector_id, ticket_id FROM chunks WHERE vector_id IN ({placeholders})", reps,
+                ).fetchall() + pairs
+        tickets: Dict[int, List] = {}
+        for rep, ticket_id in pairs:
+            tickets.setdefault(rep, []).append(ticket_id)
+        for vid, meta in metas.items():
+            others = [t for t in tickets.get(group_of[vid], []) if str(t) != str(meta["ticket_id"])]
+            if others:
+                meta["duplicate_ticket_ids"] = list(dict.fromkeys(others))
+        return metas
+
+    def ticket_vector_ids(self, ticket_id) -> List[int]:
+        """
+        IDs de los chunks de un ticket en orden (el ID puede estar guardado como texto o número).
+        Incluye los chunks colapsados como casi duplicados (ver get_many).
+        """
+        keys = {str(ticket_id)}
+        if str(ticket_id).isdigit():
+            keys.add(int(ticket_id)) # type: ignore
+        placeholders = ",".join("?" * len(keys))
+        query = f"SELECT vector_id, chunk_id FROM chunks WHERE ticket_id IN ({placeholders})"
+        params = list(keys)
+        if self._has_duplicates:
+            query += f" UNION ALL SELECT member_id, chunk_id FROM duplicates WHERE ticket_id IN ({placeholders})"
+            params += list(keys)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY chunk_id", params).fetchall()
+        return [row[0] for row in rows]
+
+    def duplicate_count(self) -> int:
+        if not self._has_duplicates:
+            return 0
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM duplicates").fetchone()[0]
+
+    def duplicate_rows(self, fields: List[str]):
+        """
+        Filas (member_id, vector_id del representante, *fields) de los chunks colapsados.
+        """
+        unknown = set(fields) - set(META_FIELDS)
+        if unknown:
+            raise ValueError(f"Campos desconocidos: {unknown}")
+        if not self._has_duplicates:
+            return []
+        with self._lock:
+            return self._conn.execute(f"SELECT member_id, vector_id, {', '.join(fields)} FROM duplicates").fetchall()
+
+    def replace_duplicates(self, groups: Dict[int, List[Dict]]):
+        """
+        Reemplaza los grupos de casi duplicados: {vector_id representante: [metadatos de los miembros]}.
+        El contenido de cada miembro no se guarda (es el del representante).
+        """
+        columns = ["member_id", "vector_id"] + META_FIELDS
+        rows = [
+            (int(m["vector_id"]), int(rep), *(m.get(f) for f in META_FIELDS))
+            for rep, members in groups.items() for m in members
+        ]
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM duplicates")
+            self._conn.executemany(
+                f"INSERT INTO duplicates ({', '.join(columns)}) VALUES ({','.join('?' * len(columns))})", rows,
+            )
+
+    def select_fields(self, fields: List[str]):
+        """
+        Filas (vector_id, *fields) de todo el índice, sin leer el contenido.
+        """
+        unknown = set(fields) - set(META_FIELDS)
+        if unknown:
+            raise ValueError(f"Campos desconocidos: {unknown}")
+        with self._lock:
+            rows = self._conn.execute(f"SELECT vector_id, {', '.join(fields)} FROM chunks").fetchall()
+        return rows
+
+    def apply_delta(self, upserts: List[Dict], deletes: Iterable[int]):
+        """
+        Bajas y altas en una sola transacción.
+        """
+        columns = ["vector_id"] + META_FIELDS + ["content"]
+        rows = [tuple(m.get(c) for c in columns) for m in upserts]
+        query = f"INSERT OR REPLACE INTO chunks ({', '.join(columns)}) VALUES ({','.join('?' * len(columns))})"
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM chunks WHERE vector_id = ?", [(int(v),) for v in deletes])
+            self._conn.executemany(query, rows)
@@ -1,36 +1,70 @@
 import logging
-from rag.ingest import main as ingest_main
-from rag.store_faiss import build_faiss_index
-from rag.generator import TicketAnswerGenerator
+from rag.resources import get_registry
+from rag.tracing import span, trace
 
 logger = logging.getLogger(__name__)
 
-def build_index():
+def build_index(progress=None):
     """
     Orquesta la construcción completa del índice:
     1. Ingesta y procesamiento de tickets JSON
     2. Generación de embeddings
-    3. Creación/actualización del índice FAISS
+    3. Creación/actualización del índice FAISS (en un directorio de versión nuevo)
+    4. Cambio en caliente de los retrievers vivos a la versión publicada
+    progress(etapa, fracción) recibe el avance total (ver rag.index_builder).
     """
+    # FAISS, numpy y el embedder se importan recién cuando se construye el índice
+    from rag.ingest import ingest_files
+    from rag.store_faiss import build_faiss_index
+
+    progress = progress or (lambda stage, fraction: None)
+
+    def index_progress(stage, fraction):
+        # El build del índice ocupa el tramo 0.2-0.95 del avance total
+        progress(stage, 0.2 + 0.75 * fraction)
+
     logger.info("Iniciando construcción del índice...")
-    ingest_main()              # Procesa los JSON en data/raw/
-    build_faiss_index()        # Crea o actualiza el índice FAISS
+    with trace("build_index"):
+        progress("ingest", 0.0)
+        with span("ingest") as s:
+            report = ingest_files()    # Procesa los JSON en data/raw/
+            s.set(files=len(report["files"]), tickets=report["tickets"], chunks=report["chunks"])
+        build_faiss_index(progress=index_progress)  # Crea o actualiza el índice FAISS
+        progress("refresh_index", 0.95)
+        with span("refresh_index"):
+            get_registry().refresh_index()  # Recarga el índice en los retrievers vivos
+    progress("done", 1.0)
     logger.info("Índice construido exitosamente.")
 
 
-def answer_query(query: str):
+def answer_query(query: str, filters: dict = None, answer_mode: str = None): # type: ignore
     """
     Ejecuta el flujo completo de recuperación y generación:
-    - Busca los chunks relevantes
+    - Busca los chunks relevantes (opcionalmente filtrados por proyecto, categoría, estado o fecha)
     - Genera una respuesta natural
     """
     logger.info(f"Consultando RAG con: {query}")
-    generator = TicketAnswerGenerator()
-    answer = generator.generate_answer(query)
+    with trace("answer_query"):
+        # Modelos e índice se cargan una vez por proceso y quedan en memoria
+        with span("load_resources"):
+            generator = get_registry().get_generator()
+        answer = generator.generate_answer(query, filters=filters, answer_mode=answer_mode)
     logger.info("Respuesta generada.")
     return answer
 
 
+def stream_query(query: str, filters: dict = None, cancel_event=None, answer_mode: str = None): # type: ignore
+    """
+    Versión streaming de answer_query: devuelve un iterador de eventos
+    (tickets recuperados, fragmentos de respuesta y métricas finales).
+    """
+    logger.info(f"Consultando RAG (streaming) con: {query}")
+    with trace("answer_query", stream=True):
+        with span("load_resources"):
+            generator = get_registry().get_generator()
+        yield from generator.stream_answer(query, filters=filters, cancel_event=cancel_event, answer_mode=answer_mode)
+
+
 if __name__ == "__main__":
     # Ejemplo rápido para probar
     q = input("Ingresá tu pregunta: ")
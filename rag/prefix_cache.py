@@ -0,0 +1,149 @@
+import copy
+import time
+import json
+import argparse
+import threading
+import torch
+from typing import Dict, List
+from transformers import DynamicCache
+from rag.utils import setup_logger
+
+logger = setup_logger("prefix_cache")
+
+# Marcador para ubicar dónde empieza la parte variable del mensaje de usuario
+_MARKER = "@@VARIABLE@@"
+
+
+class PrefixKVCache:
+    """
+    KV cache precalculado del prefijo constante del chat template
+    (system prompt + comienzo del mensaje de usuario), una vez por modelo cargado.
+    Cada generación recibe una copia y el modelo solo hace prefill del resto del prompt.
+    Si la tokenización de un prompt no empieza exactamente con el prefijo, se usa el
+    camino sin caché, así la salida es la misma que sin esta optimización.
+    """
+
+    def __init__(self, model, tokenizer, system_prompt: str, user_prefix: str = "", device: str = "cpu"):
+        self.model = model
+        self.device = device
+        self._lock = threading.Lock()
+
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"{user_prefix}{_MARKER}"},
+        ]
+        text = tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+        prefix_text = text.split(_MARKER)[0]
+        ids = tokenizer(prefix_text, add_special_tokens=False, return_tensors="pt")["input_ids"]
+        # El último token puede fusionarse con el texto siguiente: se deja fuera del prefijo
+        self.prefix_ids = ids[:, :-1].to(device)
+        self.length = self.prefix_ids.shape[-1]
+
+        start = time.perf_counter()
+        with torch.no_grad():
+            cache = DynamicCache()
+            model(input_ids=self.prefix_ids, past_key_values=cache, use_cache=True)
+        self._cache = cache
+        logger.info(f"KV cache del prefijo precalculado: {self.length} tokens en {time.perf_counter() - start:.2f}s")
+
+    def matches(self, input_ids: torch.Tensor) -> bool:
+        """
+        True si el prompt (batch de 1) empieza con el prefijo cacheado y tiene algo más.
+        """
+        return (
+            input_ids.shape[0] == 1
+            and input_ids.shape[-1] > self.length
+            and torch.equal(input_ids[0, :self.length], self.prefix_ids[0])
+        )
+
+    def copy(self):
+        """
+        Copia independiente del caché (generate lo extiende en el lugar).
+        """
+        with self._lock:
+            return copy.deepcopy(self._cache)
+
+    def generate_kwargs(self, input_ids: torch.Tensor) -> Dict:
+        """
+        Argumentos extra para model.generate: el caché del prefijo si aplica.
+        """
+        if self.matches(input_ids):
+            return {"past_key_values": self.copy()}
+        return {}
+
+
+def benchmark_prefix_cache(generator, queries: List[str], top_k: int = 3, check_tokens: int = 32) -> Dict:
+    """
+    Mide el prefill de cada consulta con y sin el KV cache del prefijo (CPU o GPU,
+    según el generador) y verifica con decodificación greedy que la salida sea idéntica.
+    """
+    prefix = generator.prefix_cache
+    if prefix is None:
+        raise RuntimeError("El generador no tiene prefix cache habilitado.")
+
+    rows = []
+    for query in queries:
+        docs = generator.retriever.search(query, top_k=top_k)
+        if not docs:
+            continue
+        inputs = generator.tokenizer.apply_chat_template(
+            generator.build_prompt(query, docs),
+            add_generation_prompt=True, tokenize=True, return_dict=True, return_tensors="pt",
+        ).to(generator.device)
+        input_ids = inputs["input_ids"]
+        if not prefix.matches(input_ids):
+            logger.warning(f"El prompt de '{query}' no comparte el prefijo cacheado, se omite.")
+            continue
+
+        with torch.no_grad():
+            start = time.perf_counter()
+            generator.model(input_ids=input_ids, use_cache=True)
+            full_s = time.perf_counter() - start
+
+            start = time.perf_counter()
+            cache = prefix.copy()
+            generator.model(input_ids=input_ids[:, prefix.length:], past_key_values=cache, use_cache=True)
+            cached_s = time.perf_counter() - start
+
+            greedy = dict(max_new_tokens=check_tokens, do_sample=False)
+            plain = generator.model.generate(**inputs, **greedy)
+            reused = generator.model.generate(**inputs, past_key_values=prefix.copy(), **greedy)
+
+        rows.append({
+            "query": query,
+            "prompt_tokens": int(input_ids.shape[-1]),
+            "prefix_tokens": prefix.length,
+            "prefill_ms": full_s * 1000,
+            "prefill_cached_ms": cached_s * 1000,
+            "saved_ms": (full_s - cached_s) * 1000,
+            "identical_output": bool(torch.equal(plain, reused)),
+        })
+
+    summary = {}
+    if rows:
+        summary = {
+            "queries": len(rows),
+            "mean_saved_ms": sum(r["saved_ms"] for r in rows) / len(rows),
+            "mean_prefill_ms": sum(r["prefill_ms"] for r in rows) / len(rows),
+            "all_identical": all(r["identical_output"] for r in rows),
+        }
+    return {"summary": summary, "rows": rows}
+
+
+def main():
+    from rag.resources import get_registry
+
+    parser = argparse.ArgumentParser(description="Benchmark del KV cache del prefijo del prompt")
+    parser.add_argument("queries", nargs="+", help="Consultas de prueba")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    report = benchmark_prefix_cache(get_registry().get_generator(), args.queries)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+from rag.utils import setup_logger, rss_bytes
+
+logger = setup_logger("resources")
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+GENERATION_MODEL = "Qwen/Qwen2.5-0.5B-Instruct"
+# RAG_PARALLEL_LOAD=0 carga embedder, índice y LLM uno detrás del otro
+PARALLEL_LOAD = os.getenv("RAG_PARALLEL_LOAD", "1") != "0"
+
+
+class ResourceRegistry:
+    """
+    Registro de recursos pesados compartidos por todo el proceso:
+    LLM, embedder y retriever FAISS se cargan una sola vez y se reutilizan
+    entre consultas (y entre reruns de Streamlit, que comparten el proceso).
+    Cuando build_index publica una versión nueva solo se recarga el índice.
+    La primera consulta carga en paralelo lo que le falte (ver _load_parallel).
+    """
+
+    def __init__(
+        self,
+        index_path: str = "index/faiss/tickets.index",
+        metadata_path: str = "index/faiss/metadata.sqlite",
+        embedding_model: str = EMBEDDING_MODEL,
+        generation_model: str = GENERATION_MODEL,
+        cache_answers: bool = True,
+        backend: str = "auto",
+        num_threads: int = None, # type: ignore
+        parallel_load: bool = PARALLEL_LOAD,
+    ):
+        self.index_path = index_path
+        self.metadata_path = metadata_path
+        self.embedding_model = embedding_model
+        self.generation_model = generation_model
+        self.cache_answers = cache_answers
+        self.backend = backend
+        self.num_threads = num_threads
+        self.parallel_load = parallel_load
+
+        self._lock = threading.RLock()
+        self._embedder = None
+        self._retriever = None
+        self._generator = None
+        self._stats: Dict[str, Dict] = {}
+
+    def _timed_load(self, component: str, loader):
+        """
+        Ejecuta un loader midiendo tiempo y memoria residente que agrega.
+        """
+        rss_before = rss_bytes()
+        start = time.perf_counter()
+        obj = loader()
+        elapsed = time.perf_counter() - start
+        rss_after = rss_bytes()
+
+        rss_delta = None
+        if rss_before is not None and rss_after is not None:
+            rss_delta = rss_after - rss_before
+
+        stats = self._stats.setdefault(component, {"loads": 0})
+        stats.update({
+            "load_seconds": elapsed,
+            "rss_delta_bytes": rss_delta,
+            "loaded_at": time.time(),
+        })
+        stats["loads"] += 1
+        mb = f"{rss_delta / 2**20:.1f} MB" if rss_delta is not None else "n/d"
+        logger.info(f"[{component}] cargado en {elapsed:.2f}s (memoria: {mb})")
+        return obj
+
+    def get_embedder(self):
+        with self._lock:
+            if self._embedder is None:
+                from rag.embeddings import Embedder
+                self._embedder = self._timed_load(
+                    "embedder", lambda: Embedder(self.embedding_model)
+                )
+            return self._embedder
+
+    def get_retriever(self):
+        """
+        Devuelve el retriever compartido; si hay un índice publicado más nuevo
+        recarga solo el índice y los metadatos (el embedder se conserva).
+        """
+        with self._lock:
+            if self._retriever is None and self._embedder is None and self.parallel_load:
+                self._load_parallel(generator=False)
+            if self._retriever is None:
+                from rag.retriever import TicketRetriever
+                embedder = self.get_embedder()
+                self._retriever = self._timed_load(
+                    "retriever",
+                    lambda: TicketRetriever(
+                        index_path=self.index_path,
+                        metadata_path=self.metadata_path,
+                        embedder=embedder,
+                    ),
+                )
+            elif self._retriever.is_stale():
+                logger.info("Se detectó una nueva versión del índice, recargando...")
+                self._timed_load("retriever", self._retriever.load_index)
+            if self._retriever.embedder is None:
+                # Cargado en paralelo mientras fallaba el embedder
+                self._retriever.embedder = self.get_embedder()
+            return self._retriever
+
+    def get_generator(self):
+        with self._lock:
+            if self._generator is None and self.parallel_load:
+                self._load_parallel(generator=True)
+            retriever = self.get_retriever()
+            if self._generator is None:
+                self._generator = self._timed_load("generator", lambda: self._new_generator(retriever))
+            elif self._generator.retriever is None:
+                # Cargado en paralelo mientras fallaba el retriever (p. ej. sin índice construido)
+                self._generator.retriever = retriever
+            return self._generator
+
+    def _new_generator(self, retriever=None):
+        # Sin retriever (carga en paralelo) se le asigna el compartido al terminar
+        from rag.generator import TicketAnswerGenerator
+        return TicketAnswerGenerator(
+            model_name=self.generation_model,
+            retriever=retriever,
+            cache_answers=self.cache_answers,
+            backend=self.backend,
+            num_threads=self.num_threads,
+            load_retriever=retriever is not None,
+        )
+
+    def _load_parallel(self, generator: bool):
+        """
+        Carga a la vez lo que falte de embedder, índice (retriever con todos sus shards)
+        y LLM, cada uno en su hilo: pasan casi todo el tiempo importando, leyendo
+        archivos y en código nativo que libera el GIL. Se conectan entre sí al final.
+        Las deltas de memoria de cada componente se superponen al medirse en paralelo.
+        """
+        def load_embedder():
+            from rag.embeddings import Embedder
+            return Embedder(self.embedding_model)
+
+        def load_retriever():
+            from rag.retriever import TicketRetriever
+            retriever = TicketRetriever(
+                index_path=self.index_path, metadata_path=self.metadata_path, load_embedder=False,
+            )
+            retriever.index.preload()  # la primera búsqueda no espera la lectura de los shards
+            return retriever
+
+        start = time.perf_counter()
+        futures = {}
+        with ThreadPoolExecutor(max_workers=3, thread_name_prefix="load") as pool:
+            if self._embedder is None:
+                futures["embedder"] = pool.submit(self._timed_load, "embedder", load_embedder)
+            if self._retriever is None:
+                futures["retriever"] = pool.submit(self._timed_load, "retriever", load_retriever)
+            if generator and self._generator is None:
+                futures["generator"] = pool.submit(self._timed_load, "generator", lambda: self._new_generator())
+        # Lo que cargó bien se conserva aunque otro componente falle (p. ej. todavía no hay índice):
+        # si no, cada llamada volvería a cargar el embedder. El primer error se re-lanza al final
+        loaded, error = {}, None
+        for name, future in futures.items():
+            try:
+                loaded[name] = future.result()
+            except Exception as e:
+                logger.error(f"[{name}] no se pudo cargar: {e}")
+                error = error or e
+
+        self._embedder = loaded.get("embedder", self._embedder)
+        if "retriever" in loaded:
+            loaded["retriever"].embedder = self._embedder
+            self._retriever = loaded["retriever"]
+        if "generator" in loaded:
+            loaded["generator"].retriever = self._retriever
+            self._generator = loaded["generator"]
+        elapsed = time.perf_counter() - start
+        self._stats["parallel_load"] = {
+            "load_seconds": elapsed, "rss_delta_bytes": None, "components": sorted(loaded), "loaded_at": time.time(),
+        }
+        logger.info(f"[{', '.join(sorted(loaded))}] cargados en paralelo en {elapsed:.2f}s")
+        if error is not None:
+            raise error
+
+    def refresh_index(self):
+        """
+        Fuerza la comprobación de versión del índice (se llama tras build_index).
+        """
+        with self._lock:
+            if self._retriever is not None and self._retriever.is_stale():
+                self._timed_load("retriever", self._retriever.load_index)
+
+    def report(self) -> List[Dict]:
+        """
+        Tiempos de carga y memoria por componente.
+        """
+        with self._lock:
+            rows = []
+            for component, stats in self._stats.items():
+                row = {"component": component}
+                row.update(stats)
+                rows.append(row)
+            if self._retriever is not None:
+                for row in rows:
+                    if row["component"] == "retriever":
+                        row["index_version"] = self._retriever.version
+                        row["vectors"] = self._retriever.index.ntotal
+                        row["shards"] = len(self._retriever.index.shards)
+                        row["collapsed_duplicates"] = self._retriever.index.duplicates.get("collapsed", 0)
+            return rows
+
+    def shard_report(self) -> List[Dict]:
+        """
+        Shards del índice cargado con sus tiempos de búsqueda (vacío si no se cargó).
+        """
+        with self._lock:
+            if self._retriever is not None:
+                return self._retriever.shard_report()
+            return []
+
+    def answer_stats(self) -> Dict:
+        """
+        Respuestas por el camino extractivo y por el LLM (vacío si no se cargó el generador).
+        """
+        with self._lock:
+            if self._generator is not None:
+                return self._generator.answer_stats()
+            return {}
+
+    def cache_stats(self) -> Dict:
+        """
+        Aciertos/fallos de los cachés de consultas (para dimensionarlos).
+        """
+        with self._lock:
+            if self._generator is not None:
+                return self._generator.cache_stats()
+            if self._retriever is not None:
+                return self._retriever.cache_stats()
+            return {}
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> ResourceRegistry:
+    """
+    Registro único por proceso.
+    """
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            # Backend de inferencia y hilos configurables por entorno (nodos solo CPU)
+            threads = os.getenv("RAG_NUM_THREADS")
+            _registry = ResourceRegistry(
+                backend=os.getenv("RAG_BACKEND", "auto"),
+                num_threads=int(threads) if threads else None, # type: ignore
+            )
+        return _registry
@@ -1,60 +1,431 @@
 import os
+import threading
 import numpy as np
-import faiss
+from contextlib import contextmanager
 from typing import List, Tuple, Dict
 from rag.embeddings import Embedder
-from rag.utils import setup_logger
+from rag.cache import TTLCache, normalize_query
+from rag.filters import FilterIndex, filters_key
+from rag.lexical import LexicalIndex, classify_query, reciprocal_rank_fusion
+from rag.metadata_store import MetadataStore
+from rag.shards import MANIFEST, ShardedIndex
+from rag.tracing import span
+from rag.utils import setup_logger, read_index_version, read_current_index
 
 logger = setup_logger("retriever")
 
+
+class _IndexState:
+    """
+    Una versión cargada del índice: FAISS, metadatos, índice léxico y el FilterIndex
+    armado con esos mismos metadatos. El retriever la reemplaza entera con una sola
+    asignación; cada consulta la toma al empezar y la suelta al terminar, y las
+    conexiones SQLite se cierran cuando ya fue reemplazada y ninguna consulta la usa.
+    """
+
+    def __init__(self, index: ShardedIndex, store: MetadataStore, lexical: LexicalIndex, version):
+        self.index, self.store, self.lexical, self.version = index, store, lexical, version
+        self._filter_index = None
+        self._lock = threading.Lock()
+        self._users = 0
+        self._retired = False
+
+    @property
+    def filter_index(self) -> FilterIndex:
+        with self._lock:
+            if self._filter_index is None:
+                self._filter_index = FilterIndex(self.store)
+            return self._filter_index
+
+    def acquire(self) -> "_IndexState":
+        with self._lock:
+            self._users += 1
+        return self
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            close = self._retired and self._users == 0
+        if close:
+            self._close()
+
+    def retire(self):
+        with self._lock:
+            self._retired = True
+            close = self._users == 0
+        if close:
+            self._close()
+
+    def _close(self):
+        logger.info(f"Cerrando las conexiones de la versión {self.version} del índice.")
+        self.store.close()
+        if self.lexical is not None:
+            self.lexical.close()
+
+
 class TicketRetriever:
     """
-    Recuperador semántico basado en FAISS.
+    Recuperador híbrido: FAISS (semántico) + índice invertido BM25 (léxico),
+    fusionados por Reciprocal Rank Fusion. Las consultas que son un número de
+    ticket o un código de error se resuelven solo con el índice léxico.
     """
     def __init__(
         self,
         index_path: str = "index/faiss/tickets.index",
-        metadata_path: str = "index/faiss/metadatas.npy",
-        model_name: str = "sentence-transformers/all-MiniLM-L6-v2"
+        metadata_path: str = "index/faiss/metadata.sqlite",
+        model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+        embedder: Embedder = None, # type: ignore
+        query_cache_size: int = 2048,
+        results_cache_size: int = 1024,
+        cache_ttl: float = 3600,
+        lexical_path: str = None, # type: ignore
+        hybrid: bool = True,
+        load_embedder: bool = True,
     ):
-        if not os.path.exists(index_path):
-            raise FileNotFoundError(f"No se encontró el índice FAISS en {index_path}")
+        self.index_path = index_path
+        self.metadata_path = metadata_path
+        self.index_dir = os.path.dirname(index_path)
+        self.lexical_path = lexical_path or os.path.join(self.index_dir, "lexical.sqlite")
+        self.hybrid = hybrid
+        self._state: _IndexState = None # type: ignore
+        self._state_lock = threading.Lock()
+
+        # Cachés de consultas: embeddings (no dependen del índice) y top-k por versión
+        self.query_cache = TTLCache(maxsize=query_cache_size, ttl=cache_ttl)
+        self.results_cache = TTLCache(maxsize=results_cache_size, ttl=cache_ttl)
+
+        self.load_index()
+        # El embedder puede venir compartido (ver rag.resources) para no cargarlo dos veces;
+        # con load_embedder=False lo asigna después quien lo carga en paralelo
+        self.embedder = embedder or (Embedder(model_name) if load_embedder else None)
+
+    def load_index(self):
+        """
+        (Re)carga el índice FAISS y los metadatos desde disco, sin tocar el embedder.
+        Los archivos se leen del directorio de la versión publicada (CURRENT); las
+        búsquedas en curso siguen con la versión anterior hasta que terminan.
+        """
+        version, version_dir = read_current_index(self.index_dir)
+        index_path = os.path.join(version_dir, os.path.basename(self.index_path))
+        metadata_path = os.path.join(version_dir, os.path.basename(self.metadata_path))
+        lexical_path = os.path.join(version_dir, os.path.basename(self.lexical_path))
+
+        if not os.path.exists(os.path.join(version_dir, MANIFEST)) and not os.path.exists(index_path):
+            raise FileNotFoundError(f"No se encontró el índice FAISS en {version_dir}")
 
         if not os.path.exists(metadata_path):
             raise FileNotFoundError(f"No se encontró el archivo de metadatos en {metadata_path}")
 
         logger.info("Cargando índice FAISS y metadatos...")
-        self.index = faiss.read_index(index_path)
-        self.metadatas = np.load(metadata_path, allow_pickle=True)
-        self.embedder = Embedder(model_name)
+        # Un índice por shard (ver rag.shards); las versiones sin shards se cargan como uno solo
+        index = ShardedIndex.load(version_dir, os.path.basename(self.index_path))
+        # Los metadatos quedan en disco: solo se leen los de los top-k de cada búsqueda
+        store = MetadataStore(metadata_path, readonly=True)
+        if store.count() != index.ntotal:
+            logger.warning(f"El índice tiene {index.ntotal} vectores pero hay {store.count()} metadatos.")
+        lexical = None
+        if os.path.exists(lexical_path):
+            lexical = LexicalIndex(lexical_path, readonly=True)
+        else:
+            logger.warning(f"No se encontró el índice léxico en {lexical_path}, solo búsqueda semántica.")
+        # Cambio atómico de toda la versión (el FilterIndex se arma con el primer filtro de
+        # esta); la anterior se cierra cuando terminan las consultas que la tomaron
+        with self._state_lock:
+            previous, self._state = self._state, _IndexState(index, store, lexical, version)
+        # Los resultados cacheados pertenecen al índice anterior
+        self.results_cache.clear()
+        if previous is not None:
+            previous.retire()
+
+        logger.info(
+            f"Índice cargado: {index.ntotal} vectores disponibles "
+            f"({index.describe()}, versión {version})."
+        )
+
+    @contextmanager
+    def _use_state(self):
+        """
+        La versión cargada, sin que se cierren sus conexiones mientras dura la consulta.
+        """
+        with self._state_lock:
+            state = self._state.acquire()
+        try:
+            yield state
+        finally:
+            state.release()
+
+    # Vista de la versión cargada para quien no consulta (reportes, benchmark)
+    @property
+    def index(self) -> ShardedIndex:
+        return self._state.index
+
+    @property
+    def store(self) -> MetadataStore:
+        return self._state.store
+
+    @property
+    def lexical(self) -> LexicalIndex:
+        return self._state.lexical
 
-        logger.info(f"Índice cargado: {self.index.ntotal} vectores disponibles.")
+    @property
+    def version(self):
+        return self._state.version if self._state is not None else None
+
+    def is_stale(self) -> bool:
+        """
+        Indica si hay una versión del índice publicada más nueva que la cargada.
+        """
+        return read_index_version(self.index_dir) != self.version
+
+    def embed_query(self, query: str) -> np.ndarray:
+        """
+        Embedding (1, dim) de la consulta, cacheado por texto normalizado.
+        """
+        with span("embed_query") as s:
+            key = normalize_query(query)
+            query_vec = self.query_cache.get(key)
+            s.set(cache_hit=query_vec is not None)
+            if query_vec is None:
+                query_vec = self.embedder.encode_query(query).astype("float32")
+                self.query_cache.put(key, query_vec)
+        return query_vec
+
+    def filter_options(self) -> Dict[str, list]:
+        """
+        Valores disponibles de cada campo filtrable (para la UI).
+        """
+        with self._use_state() as state:
+            return state.filter_index.options()
 
-    def search(self, query: str, top_k: int = 5) -> List[Dict]:
+    def search(
+        self,
+        query: str,
+        top_k: int = 5,
+        nprobe: int = None, # type: ignore
+        ef_search: int = None, # type: ignore
+        filters: Dict = None, # type: ignore
+    ) -> List[Dict]:
         """
         Busca los chunks más similares a la consulta.
         Retorna una lista de resultados con score y metadatos.
+        nprobe (IVF) y ef_search (HNSW) permiten ajustar precisión/latencia por consulta.
+        filters restringe la búsqueda dentro de FAISS, p. ej.
+        {"project": "Slots", "status": ["resolved", "closed"], "created_from": "2025-01-01"}.
         """
         logger.info(f"Buscando: '{query}'")
 
-        # Generar embedding del texto de consulta
-        query_vec = self.embedder.encode(query).astype("float32")
+        with span("retrieve", top_k=top_k) as s, self._use_state() as state:
+            cache_key = (state.version, normalize_query(query), top_k, nprobe, ef_search, filters_key(filters))
+            cached = self.results_cache.get(cache_key)
+            if cached is not None:
+                s.set(cache_hit=True, results=len(cached))
+                logger.info(f"Se recuperaron {len(cached)} resultados (caché).")
+                return [dict(r) for r in cached]
+
+            # IDs de ticket y códigos de error: solo índice léxico, sin pasar por el embedder
+            results = self._fast_path(state, query, top_k, filters)
+            if results is None:
+                # Generar embedding del texto de consulta
+                query_vec = self.embed_query(query)
+
+                distances, indices = self._faiss_search(state, query_vec, self._candidates(state, top_k), nprobe, ef_search, filters)
+                results = self._fuse(state, query, indices[0], distances[0], top_k, filters)
+
+            self.results_cache.put(cache_key, results)
+            s.set(cache_hit=False, results=len(results), path=results[0]["retrieval"] if results else None)
+            logger.info(f"Se recuperaron {len(results)} resultados.")
+
+        return [dict(r) for r in results]
+
+    def search_batch(
+        self,
+        queries: List[str],
+        top_k: int = 5,
+        nprobe: int = None, # type: ignore
+        ef_search: int = None, # type: ignore
+        filters=None,
+    ) -> List:
+        """
+        Versión por lotes de search: codifica todas las consultas no cacheadas en un
+        solo batch del embedder y hace una única búsqueda FAISS por grupo de filtros.
+        filters puede ser un dict común o una lista con un filtro por consulta.
+        Devuelve una entrada por consulta: la lista de resultados, o la excepción
+        si esa consulta falló (los errores no afectan al resto del lote).
+        """
+        if not isinstance(filters, list):
+            filters = [filters] * len(queries)
+        if len(filters) != len(queries):
+            raise ValueError("filters debe tener un elemento por consulta")
+
+        with self._use_state() as state:
+            return self._search_batch(state, queries, top_k, nprobe, ef_search, filters)
+
+    def _search_batch(self, state: _IndexState, queries: List[str], top_k: int, nprobe, ef_search, filters: List) -> List:
+        outputs: List = [None] * len(queries)
+        pending = []
+        for i, (query, flt) in enumerate(zip(queries, filters)):
+            try:
+                if not query or not query.strip():
+                    raise ValueError("La consulta está vacía.")
+                key = (state.version, normalize_query(query), top_k, nprobe, ef_search, filters_key(flt))
+                cached = self.results_cache.get(key)
+                if cached is None:
+                    cached = self._fast_path(state, query, top_k, flt)
+                    if cached is not None:
+                        self.results_cache.put(key, cached)
+                if cached is not None:
+                    outputs[i] = [dict(r) for r in cached]
+                else:
+                    pending.append((i, key))
+            except Exception as e:
+                outputs[i] = e
+
+        if pending:
+            with span("retrieve_batch", queries=len(queries), pending=len(pending)):
+                # Embeddings: caché por consulta + un único encode para las faltantes
+                vecs = {}
+                missing = []
+                for i, _ in pending:
+                    vec = self.query_cache.get(normalize_query(queries[i]))
+                    if vec is None:
+                        missing.append(i)
+                    else:
+                        vecs[i] = vec
+                if missing:
+                    encoded = self.embedder.encode([queries[i] for i in missing]).astype("float32")
+                    for i, vec in zip(missing, encoded):
+                        vecs[i] = vec.reshape(1, -1)
+                        self.query_cache.put(normalize_query(queries[i]), vecs[i])
+
+                # Una búsqueda FAISS por grupo de filtros, con la matriz de consultas completa
+                groups: Dict = {}
+                for i, key in pending:
+                    groups.setdefault(key[-1], []).append((i, key))
+                for members in groups.values():
+                    flt = filters[members[0][0]]
+                    try:
+                        matrix = np.vstack([vecs[i] for i, _ in members])
+                        distances, indices = self._faiss_search(state, matrix, self._candidates(state, top_k), nprobe, ef_search, flt)
+                    except Exception as e:
+                        for i, _ in members:
+                            outputs[i] = e
+                        continue
+                    for row, (i, key) in enumerate(members):
+                        try:
+                            results = self._fuse(state, queries[i], indices[row], distances[row], top_k, flt)
+                            self.results_cache.put(key, results)
+                            outputs[i] = [dict(r) for r in results]
+                        except Exception as e:
+                            outputs[i] = e
+
+        logger.info(f"Búsqueda por lotes: {len(queries)} consultas ({len(pending)} sin caché).")
+        return outputs
+
+    def _faiss_search(self, state: _IndexState, query_vecs: np.ndarray, top_k: int, nprobe, ef_search, filters):
+        """
+        Búsqueda FAISS de una matriz de consultas, con el filtro aplicado dentro de FAISS
+        mediante un IDSelector (sin sobre-pedir ni post-filtrar). Se busca en paralelo
+        solo en los shards que admite el filtro y se fusionan sus top-k.
+        """
+        sel, n_allowed = state.filter_index.selector(filters) if filters_key(filters) else (None, None)
+        if n_allowed == 0:
+            logger.info("Ningún chunk cumple el filtro.")
+            empty = np.full((len(query_vecs), top_k), -1, dtype="int64")
+            return np.zeros(empty.shape, dtype="float32"), empty
+
+        index = state.index
+        with span("faiss_search", queries=len(query_vecs), candidates=top_k, filtered=sel is not None) as s:
+            # IVF/HNSW pueden quedarse cortos con filtros muy selectivos: ShardedIndex amplía la búsqueda
+            distances, indices = index.search(
+                query_vecs, top_k, nprobe=nprobe, ef_search=ef_search, sel=sel, n_allowed=n_allowed, filters=filters,
+            )
+            s.set(shards=len(index.matching(filters)))
+        return distances, indices
+
+    def _candidates(self, state: _IndexState, top_k: int) -> int:
+        # Con fusión se piden más candidatos a cada índice que los que se devuelven
+        return max(top_k * 4, 20) if self.hybrid and state.lexical is not None else top_k
+
+    def _lexical_hits(self, state: _IndexState, query: str, n: int, filters) -> List[Tuple[int, float]]:
+        with span("lexical_search") as s:
+            hits = state.lexical.search(query, n if not filters_key(filters) else n * 10)
+            if filters_key(filters):
+                # Un representante de casi duplicados cuenta si algún miembro cumple el filtro
+                resolved = state.filter_index.resolve([vid for vid, _ in hits], filters)
+                hits = [(vid, score) for vid, (_, score) in zip(resolved, hits) if vid >= 0]
+            s.set(hits=len(hits[:n]))
+        return hits[:n]
+
+    def _fast_path(self, state: _IndexState, query: str, top_k: int, filters) -> List[Dict]:
+        """
+        Resultados sin embeddings para consultas de búsqueda exacta, o None si no aplica
+        (o si no encontró nada y conviene la búsqueda normal).
+        """
+        kind, value = classify_query(query)
+        if kind == "ticket":
+            ids = state.store.ticket_vector_ids(value)
+            if ids and filters_key(filters):
+                allowed = state.filter_index.allowed_set(filters)
+                ids = [vid for vid in ids if vid in allowed]
+            if ids:
+                logger.info(f"Consulta por número de ticket {value}: sin embeddings.")
+                return self._hydrate(state, ids[:top_k], [1.0] * len(ids[:top_k]), retrieval="ticket_id")
+        if kind is None or state.lexical is None:
+            return None # type: ignore
+        hits = self._lexical_hits(state, query, top_k, filters)
+        if not hits:
+            return None # type: ignore
+        logger.info(f"Consulta de código exacto: {len(hits)} resultados del índice léxico.")
+        return self._hydrate(state, [vid for vid, _ in hits], [score for _, score in hits], retrieval="lexical")
 
-        # Hacer búsqueda FAISS
-        distances, indices = self.index.search(query_vec, top_k)
-        indices = indices.flatten()
-        distances = distances.flatten()
+    def _fuse(self, state: _IndexState, query: str, indices, distances, top_k: int, filters) -> List[Dict]:
+        """
+        Fusiona el ranking de FAISS con el de BM25 (RRF). Sin índice léxico, solo FAISS.
+        Con filtro, cada representante de casi duplicados se devuelve como el chunk que lo cumple.
+        El orden es el de la fusión (rrf_score), pero score sigue siendo el coseno denso:
+        lo usan la UI y el modo extractivo. Un hit solo léxico, fuera de los candidatos
+        de FAISS, no tiene coseno calculado y queda con 0.0.
+        """
+        indices = state.filter_index.resolve(indices, filters) if filters_key(filters) else indices
+        if not self.hybrid or state.lexical is None:
+            return self._hydrate(state, indices[:top_k], distances[:top_k])
+        dense = [int(i) for i in indices if i >= 0]
+        lexical = [vid for vid, _ in self._lexical_hits(state, query, len(indices), filters)]
+        fused = reciprocal_rank_fusion([dense, lexical])[:top_k]
+        cosines = {int(i): float(d) for i, d in zip(indices, distances) if i >= 0}
+        return self._hydrate(
+            state, [vid for vid, _ in fused], [cosines.get(vid, 0.0) for vid, _ in fused],
+            retrieval="hybrid", rrf_scores=[score for _, score in fused],
+        )
 
+    def _hydrate(self, state: _IndexState, indices, distances, retrieval: str = "dense", rrf_scores=None) -> List[Dict]:
+        """
+        Convierte IDs de FAISS en resultados con metadatos y score (lee solo estos IDs).
+        """
+        with span("hydrate", results=len(indices)):
+            metas = state.store.get_many([idx for idx in indices if idx >= 0])
         results = []
-        for idx, score in zip(indices, distances):
-            if idx < len(self.metadatas):
-                meta = self.metadatas[idx]  # <- FIX: ya es un dict
+        for pos, (idx, score) in enumerate(zip(indices, distances)):
+            meta = metas.get(int(idx))
+            if meta is not None:
                 meta["score"] = float(score)
+                meta["retrieval"] = retrieval
+                if rrf_scores is not None:
+                    meta["rrf_score"] = float(rrf_scores[pos])
                 results.append(meta)
+        return results
 
-        logger.info(f"Se recuperaron {len(results)} resultados.")
+    def shard_report(self) -> List[Dict]:
+        """
+        Distribución de los shards de la versión cargada y tiempos de búsqueda de cada uno.
+        """
+        return self.index.layout()
 
-        return results
+    def cache_stats(self) -> Dict:
+        return {
+            "query_embeddings": self.query_cache.stats(),
+            "results": self.results_cache.stats(),
+        }
 
 if __name__ == "__main__":
     retriever = TicketRetriever()
@@ -0,0 +1,360 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from aiohttp import web
+from rag.index_builder import get_index_builder
+from rag.resources import get_registry
+from rag.tracing import metrics, trace
+from rag.utils import setup_logger
+
+logger = setup_logger("server")
+
+
+class Overloaded(Exception):
+    """
+    La cola o el pool de generación están llenos: el cliente debe reintentar.
+    """
+
+
+def _dumps(data) -> str:
+    # Fechas (p. ej. created_at) y otros tipos no JSON se serializan como texto
+    return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class SearchBatcher:
+    """
+    Agrupa las búsquedas que llegan concurrentemente en micro-lotes: espera hasta
+    max_wait_ms (o max_batch consultas) y hace un único search_batch, que codifica
+    todas las consultas en un batch del embedder y busca la matriz completa en FAISS.
+    Los lotes se ejecutan de a uno en un hilo dedicado.
+    """
+
+    def __init__(self, registry, max_batch: int = 16, max_wait_ms: float = 5.0, max_queue: int = 256):
+        self.registry = registry
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search")
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"batches": 0, "queries": 0, "largest_batch": 0, "rejected": 0}
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        self._executor.shutdown(wait=False)
+
+    def submit(self, query: str, top_k: int, filters: Optional[Dict]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((query, top_k, filters, future))
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            raise Overloaded("Cola de búsquedas llena")
+        return future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # Las que ya vencieron (timeout del cliente) no se buscan
+            batch = [item for item in batch if not item[3].done()]
+            groups: Dict[int, List] = {}
+            for item in batch:
+                groups.setdefault(item[1], []).append(item)
+            for top_k, items in groups.items():
+                self.stats["batches"] += 1
+                self.stats["queries"] += len(items)
+                self.stats["largest_batch"] = max(self.stats["largest_batch"], len(items))
+                try:
+                    outputs = await loop.run_in_executor(
+                        self._executor, self._search, [i[0] for i in items], top_k, [i[2] for i in items]
+                    )
+                except Exception as e:
+                    outputs = [e] * len(items)
+                for (_, _, _, future), output in zip(items, outputs):
+                    if future.done():
+                        continue
+                    if isinstance(output, Exception):
+                        future.set_exception(output)
+                    else:
+                        future.set_result(output)
+
+    def _search(self, queries: List[str], top_k: int, filters: List) -> List:
+        with trace("search_batch", queries=len(queries)):
+            retriever = self.registry.get_retriever()
+            return retriever.search_batch(queries, top_k=top_k, filters=filters)
+
+
+class RAGServer:
+    """
+    Servicio HTTP asyncio sobre el retriever y el generador del proceso:
+    - búsquedas en micro-lotes (SearchBatcher)
+    - generación en un pool acotado de hilos, con límite de pedidos pendientes
+    - backpressure: 503 con Retry-After si la cola o el pool están llenos
+    - timeout por pedido: 504 (y se cancela la generación en curso)
+    Cada respuesta se serializa por pedido, así ningún cliente comparte dicts con otro.
+    """
+
+    def __init__(
+        self,
+        registry=None,
+        max_batch: int = 16,
+        max_wait_ms: float = 5.0,
+        max_queue: int = 256,
+        generation_workers: int = 1,
+        max_pending_generations: int = 8,
+        request_timeout: float = 120.0,
+    ):
+        self.registry = registry or get_registry()
+        self.batcher_config = dict(max_batch=max_batch, max_wait_ms=max_wait_ms, max_queue=max_queue)
+        self.batcher: Optional[SearchBatcher] = None
+        self.generation_pool = ThreadPoolExecutor(max_workers=generation_workers, thread_name_prefix="generation")
+        self.max_pending_generations = max_pending_generations
+        self.pending_generations = 0
+        self.request_timeout = request_timeout
+        self.stats = {"requests": 0, "timeouts": 0, "overloaded": 0, "errors": 0}
+
+    # ---------- ciclo de vida ----------
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._errors])
+        app.router.add_get("/health", self.health)
+        app.router.add_get("/stats", self.get_stats)
+        app.router.add_get("/metrics", self.get_metrics)
+        app.router.add_get("/traces/last", self.last_trace)
+        app.router.add_get("/filters", self.filters)
+        app.router.add_post("/search", self.search)
+        app.router.add_post("/answer", self.answer)
+        app.router.add_post("/index/build", self.build_index)
+        app.router.add_get("/index/status", self.index_status)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+    async def _on_startup(self, app):
+        self.batcher = SearchBatcher(self.registry, **self.batcher_config)
+        self.batcher.start()
+
+    async def _on_cleanup(self, app):
+        await self.batcher.stop() # type: ignore
+        self.generation_pool.shutdown(wait=False)
+
+    @web.middleware
+    async def _errors(self, request, handler):
+        self.stats["requests"] += 1
+        try:
+            return await handler(request)
+        except Overloaded as e:
+            self.stats["overloaded"] += 1
+            return web.json_response({"error": str(e)}, status=503, headers={"Retry-After": "1"})
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            return web.json_response({"error": "Tiempo de espera agotado"}, status=504)
+        except (ValueError, FileNotFoundError) as e:
+            return web.json_response({"error": str(e)}, status=400)
+        except web.HTTPException:
+            raise
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.exception(f"Error atendiendo {request.path}")
+            return web.json_response({"error": str(e)}, status=500)
+
+    # ---------- helpers ----------
+
+    async def _params(self, request) -> Dict:
+        try:
+            body = await request.json()
+        except json.JSONDecodeError:
+            raise ValueError("El cuerpo debe ser JSON")
+        query = (body.get("query") or "").strip()
+        if not query:
+            raise ValueError("La consulta está vacía.")
+        from rag.extractive import check_answer_mode
+        return {
+            "query": query,
+            "top_k": int(body.get("top_k", 3)),
+            "max_new_tokens": int(body.get("max_new_tokens", 200)),
+            "filters": body.get("filters") or None,
+            "stream": bool(body.get("stream", False)),
+            "answer_mode": check_answer_mode(body["answer_mode"]) if body.get("answer_mode") else None,
+        }
+
+    async def _search(self, params: Dict, timeout: float) -> List[Dict]:
+        future = self.batcher.submit(params["query"], params["top_k"], params["filters"]) # type: ignore
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise
+
+    def _reserve_generation(self):
+        if self.pending_generations >= self.max_pending_generations:
+            raise Overloaded("Demasiadas generaciones en curso")
+        self.pending_generations += 1
+
+    def _release_generation(self, _future=None):
+        self.pending_generations -= 1
+
+    # ---------- endpoints ----------
+
+    async def health(self, request):
+        return web.json_response({"status": "ok"})
+
+    async def get_stats(self, request):
+        # Los reportes del registro toman su lock, que queda tomado durante una carga: fuera del event loop
+        loop = asyncio.get_running_loop()
+        registry_stats = await loop.run_in_executor(None, lambda: {
+            "resources": self.registry.report(),
+            "caches": self.registry.cache_stats(),
+            "shards": self.registry.shard_report(),
+            "answers": self.registry.answer_stats(),
+        })
+        data = {
+            "server": dict(self.stats, pending_generations=self.pending_generations),
+            "search_batches": dict(self.batcher.stats, queued=self.batcher.queue.qsize()), # type: ignore
+            **registry_stats,
+        }
+        return web.Response(text=_dumps(data), content_type="application/json")
+
+    async def get_metrics(self, request):
+        # Formato de exposición de Prometheus (text/plain version 0.0.4)
+        text = metrics.prometheus_text()
+        text += f"rag_server_pending_generations {self.pending_generations}\n"
+        text += f"rag_server_search_queue {self.batcher.queue.qsize()}\n" # type: ignore
+        for name, value in self.stats.items():
+            text += f'rag_server_total{{event="{name}"}} {value}\n'
+        return web.Response(text=text, content_type="text/plain", charset="utf-8")
+
+    async def last_trace(self, request):
+        name = request.query.get("name", "answer_query")
+        return web.Response(text=_dumps(metrics.last_trace(name)), content_type="application/json")
+
+    async def filters(self, request):
+        loop = asyncio.get_running_loop()
+        options = await loop.run_in_executor(None, lambda: self.registry.get_retriever().filter_options())
+        return web.Response(text=_dumps(options), content_type="application/json")
+
+    async def search(self, request):
+        params = await self._params(request)
+        results = await self._search(params, self.request_timeout)
+        return web.Response(text=_dumps({"results": results}), content_type="application/json")
+
+    async def answer(self, request):
+        params = await self._params(request)
+        deadline = time.monotonic() + self.request_timeout
+        self._reserve_generation()
+        try:
+            docs = await self._search(params, self.request_timeout)
+        except BaseException:
+            self._release_generation()
+            raise
+
+        loop = asyncio.get_running_loop()
+        events: asyncio.Queue = asyncio.Queue()
+        cancel_event = threading.Event()
+
+        def _produce():
+            # Corre en el pool de generación; los eventos se pasan al event loop
+            try:
+                with trace("answer_query", stream=params["stream"]):
+                    generator = self.registry.get_generator()
+                    for event in generator.stream_answer(
+                        params["query"], top_k=params["top_k"], max_new_tokens=params["max_new_tokens"],
+                        filters=params["filters"], cancel_event=cancel_event, docs=docs,
+                        answer_mode=params["answer_mode"],
+                    ):
+                        loop.call_soon_threadsafe(events.put_nowait, event)
+            except Exception as e:
+                loop.call_soon_threadsafe(events.put_nowait, {"type": "error", "error": str(e)})
+            finally:
+                loop.call_soon_threadsafe(events.put_nowait, None)
+
+        future = loop.run_in_executor(self.generation_pool, _produce)
+        future.add_done_callback(self._release_generation)
+
+        async def _next_event():
+            return await asyncio.wait_for(events.get(), max(deadline - time.monotonic(), 0))
+
+        if not params["stream"]:
+            result: Dict = {"docs": docs}
+            try:
+                while (event := await _next_event()) is not None:
+                    if event["type"] == "done":
+                        result.update(answer=event["answer"], stats=event.get("stats"))
+                    elif event["type"] == "error":
+                        raise RuntimeError(event["error"])
+            finally:
+                cancel_event.set()
+            return web.Response(text=_dumps(result), content_type="application/json")
+
+        # Streaming NDJSON: un evento por línea (docs, token..., done)
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        try:
+            while (event := await _next_event()) is not None:
+                await response.write((_dumps(event) + "\n").encode("utf-8"))
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            await response.write((_dumps({"type": "error", "error": "Tiempo de espera agotado"}) + "\n").encode("utf-8"))
+        finally:
+            # Cliente desconectado, timeout o fin normal: no seguir decodificando
+            cancel_event.set()
+        await response.write_eof()
+        return response
+
+    async def build_index(self, request):
+        # La construcción corre en segundo plano; el avance se consulta en /index/status
+        builder = get_index_builder()
+        if not builder.start():
+            return web.json_response(
+                {"error": "Ya hay una construcción del índice en curso", **builder.status()}, status=409,
+            )
+        return web.json_response(builder.status(), status=202)
+
+    async def index_status(self, request):
+        return web.json_response(get_index_builder().status())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor HTTP del RAG de tickets")
+    parser.add_argument("--host", default=os.getenv("RAG_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("RAG_PORT", "8000")))
+    parser.add_argument("--max-batch", type=int, default=16)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument("--max-queue", type=int, default=256)
+    parser.add_argument("--generation-workers", type=int, default=1)
+    parser.add_argument("--max-pending-generations", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    server = RAGServer(
+        max_batch=args.max_batch,
+        max_wait_ms=args.max_wait_ms,
+        max_queue=args.max_queue,
+        generation_workers=args.generation_workers,
+        max_pending_generations=args.max_pending_generations,
+        request_timeout=args.timeout,
+    )
+    web.run_app(server.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+import os
+import re
+import json
+import time
+import hashlib
+import argparse
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+from rag.filters import _timestamp
+from rag.index_factory import exhaustive_params, index_kind, index_size_bytes, search_params
+from rag.tracing import record_span
+from rag.utils import setup_logger, current_index_dir
+from rag.vector_storage import LAZY_INDEX, read_index
+
+logger = setup_logger("shards")
+
+# Criterio de partición del índice: "project", "year" (de created_at) o "none" (un solo shard)
+SHARD_BY_OPTIONS = ("project", "year", "none")
+DEFAULT_SHARD_BY = os.getenv("RAG_SHARD_BY", "project")
+# Hilos para buscar shards en paralelo (FAISS libera el GIL durante la búsqueda)
+SHARD_WORKERS = int(os.getenv("RAG_SHARD_WORKERS", "0")) or min(8, os.cpu_count() or 1)
+
+MANIFEST = "shards.json"
+# Nombre del shard de los chunks sin valor para el campo de partición
+NO_VALUE = "_sin_valor"
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _executor() -> ThreadPoolExecutor:
+    # Pool compartido por todas las versiones cargadas (un cambio de versión no crea hilos)
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=SHARD_WORKERS, thread_name_prefix="shard-search")
+        return _pool
+
+
+def shard_value(meta: Dict, shard_by: str) -> Optional[str]:
+    """
+    Valor del campo de partición de un chunk (None si no lo tiene).
+    """
+    if shard_by == "project":
+        return meta.get("project")
+    if shard_by == "year":
+        created_at = meta.get("created_at")
+        return str(created_at)[:4] if created_at else None
+    if shard_by == "none":
+        return "all"
+    raise ValueError(f"Partición desconocida: {shard_by} (opciones: {', '.join(SHARD_BY_OPTIONS)})")
+
+
+def shard_name(value: Optional[str]) -> str:
+    return NO_VALUE if value is None else str(value)
+
+
+def shard_file(name: str) -> str:
+    """
+    Archivo del shard: nombre legible + hash (proyectos con espacios o barras no chocan).
+    """
+    slug = re.sub(r"[^\w\-]+", "_", name)[:40]
+    return f"shard_{slug}_{hashlib.sha1(name.encode('utf-8')).hexdigest()[:8]}.index"
+
+
+def ids_digest(ids) -> str:
+    """
+    Huella del conjunto de IDs de un shard: si no cambia (y no hay contenido nuevo)
+    el shard de la versión anterior se reutiliza tal cual.
+    """
+    return hashlib.sha1(np.sort(np.asarray(ids, dtype="int64")).tobytes()).hexdigest()
+
+
+def _year(value, end_of_day: bool = False) -> int:
+    return datetime.fromtimestamp(_timestamp(value, end_of_day=end_of_day)).year
+
+
+def shard_matches(shard_by: str, value: Optional[str], filters: Optional[Dict]) -> bool:
+    """
+    Indica si un shard puede tener chunks que cumplan el filtro (si no, no se busca en él).
+    """
+    if not filters or shard_by == "none":
+        return True
+    if shard_by == "project":
+        wanted = filters.get("project")
+        if wanted in (None, "", [], ()):
+            return True
+        wanted = wanted if isinstance(wanted, (list, tuple, set)) else [wanted]
+        return value is not None and value in {str(w) for w in wanted}
+    # year: el rango de fechas descarta años completos
+    date_from, date_to = filters.get("created_from"), filters.get("created_to")
+    if date_from in (None, "") and date_to in (None, ""):
+        return True
+    if value is None:
+        return False  # sin fecha nunca cumple un filtro de fechas
+    year = int(value)
+    if date_from not in (None, "") and year < _year(date_from):
+        return False
+    if date_to not in (None, "") and year > _year(date_to, end_of_day=True):
+        return False
+    return True
+
+
+def merge_topk(distances: List[np.ndarray], indices: List[np.ndarray], top_k: int):
+    """
+    Merge exacto de los top-k de cada shard: los k mejores scores (producto interno,
+    mayor es mejor) entre todos. Los huecos (-1) quedan al final.
+    """
+    all_d = np.hstack(distances)
+    all_i = np.hstack(indices)
+    all_d = np.where(all_i >= 0, all_d, -np.inf).astype("float32")
+    order = np.argsort(-all_d, axis=1, kind="stable")[:, :top_k]
+    return np.take_along_axis(all_d, order, axis=1), np.take_along_axis(all_i, order, axis=1)
+
+
+class ShardedIndex:
+    """
+    Índice FAISS particionado: un índice por shard (proyecto, año o uno solo), que se
+    buscan en paralelo y se fusionan con un merge exacto de los top-k.
+    Con la misma interfaz de búsqueda que un índice FAISS: search(x, k) -> (D, I).
+    Cada shard se lee (mapeado en memoria, ver rag.vector_storage) recién en su primera
+    búsqueda; hasta entonces alcanza con lo que dice shards.json.
+    """
+
+    def __init__(self, shards: Dict[str, Dict], shard_by: str = "none", version_dir: str = "."):
+        # shards: {nombre: {"file": archivo, "value": valor del campo, "vectors": n, "kind": tipo, ...}}
+        self.shards = shards
+        self.shard_by = shard_by
+        self.version_dir = version_dir
+        # Resumen de los casi duplicados colapsados en el build (ver rag.dedup)
+        self.duplicates: Dict = {}
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self.timings = {name: {"searches": 0, "total_ms": 0.0, "max_ms": 0.0, "load_ms": None} for name in shards}
+
+    @classmethod
+    def load(cls, version_dir: str, index_name: str = "tickets.index", lazy: bool = LAZY_INDEX) -> "ShardedIndex":
+        """
+        Abre los shards de una versión según su shards.json. Una versión anterior a los
+        shards (un solo tickets.index) se abre como un único shard.
+        """
+        manifest_path = os.path.join(version_dir, MANIFEST)
+        if not os.path.exists(manifest_path):
+            sharded = cls({"all": {"value": "all", "file": index_name}}, shard_by="none", version_dir=version_dir)
+        else:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            sharded = cls(dict(manifest["shards"]), shard_by=manifest["shard_by"], version_dir=version_dir)
+            sharded.duplicates = manifest.get("duplicates") or {}
+        if not lazy:
+            sharded.preload()
+        return sharded
+
+    def shard_index(self, name: str):
+        """
+        Índice FAISS de un shard, leído de disco la primera vez que se usa.
+        """
+        shard = self.shards[name]
+        index = shard.get("index")
+        if index is None:
+            with self._load_lock:
+                index = shard.get("index")
+                if index is None:
+                    start = time.perf_counter()
+                    index = read_index(os.path.join(self.version_dir, shard["file"]))
+                    seconds = time.perf_counter() - start
+                    record_span("load_shard", seconds, start=start, shard=name)
+                    self.timings[name]["load_ms"] = seconds * 1000
+                    shard["index"] = index
+        return index
+
+    def preload(self):
+        for name in self.shards:
+            self.shard_index(name)
+
+    @property
+    def ntotal(self) -> int:
+        return sum(
+            int(s["vectors"]) if "vectors" in s else int(self.shard_index(name).ntotal)
+            for name, s in self.shards.items()
+        )
+
+    def kinds(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for name, shard in self.shards.items():
+            kind = shard.get("kind") or index_kind(self.shard_index(name))
+            counts[kind] = counts.get(kind, 0) + 1
+        return counts
+
+    def describe(self) -> str:
+        kinds = ", ".join(f"{n} {k}" for k, n in sorted(self.kinds().items()))
+        return f"{len(self.shards)} shards por {self.shard_by}: {kinds}"
+
+    def size_bytes(self) -> int:
+        return sum(index_size_bytes(self.shard_index(name)) for name in self.shards)
+
+    def matching(self, filters: Optional[Dict]) -> List[str]:
+        """
+        Shards en los que hay que buscar para un filtro (el resto se saltea).
+        """
+        return [name for name, s in self.shards.items() if shard_matches(self.shard_by, s.get("value"), filters)]
+
+    def _search_shard(self, name: str, query_vecs: np.ndarray, top_k: int, params_for):
+        index = self.shard_index(name)
+        start = time.perf_counter()
+        distances, indices = index.search(query_vecs, top_k, params=params_for(index))
+        return name, start, time.perf_counter() - start, distances, indices
+
+    def _fan_out(self, names: List[str], query_vecs: np.ndarray, top_k: int, params_for):
+        if len(names) == 1:
+            parts = [self._search_shard(names[0], query_vecs, top_k, params_for)]
+        else:
+            futures = [_executor().submit(self._search_shard, n, query_vecs, top_k, params_for) for n in names]
+            parts = [f.result() for f in futures]
+
+        for name, start, seconds, _, _ in parts:
+            # Los spans se registran desde este hilo (la traza activa no viaja al pool)
+            record_span("shard_search", seconds, start=start, shard=name, queries=len(query_vecs))
+            with self._lock:
+                stats = self.timings[name]
+                stats["searches"] += 1
+                stats["total_ms"] += seconds * 1000
+                stats["max_ms"] = max(stats["max_ms"], seconds * 1000)
+        return merge_topk([p[3] for p in parts], [p[4] for p in parts], top_k)
+
+    def search(
+        self,
+        query_vecs: np.ndarray,
+        top_k: int,
+        nprobe: int = None, # type: ignore
+        ef_search: int = None, # type: ignore
+        sel=None,
+        n_allowed: int = None, # type: ignore
+        filters: Dict = None, # type: ignore
+    ):
+        """
+        Busca en los shards que admite el filtro y fusiona sus top-k.
+        sel es el IDSelector del filtro (ver rag.filters); con n_allowed se amplía la
+        búsqueda de las consultas que quedaron cortas en shards IVF/HNSW.
+        """
+        names = self.matching(filters)
+        if not names:
+            empty = np.full((len(query_vecs), top_k), -1, dtype="int64")
+            return np.full(empty.shape, -np.inf, dtype="float32"), empty
+
+        distances, indices = self._fan_out(
+            names, query_vecs, top_k,
+            lambda index: search_params(index, nprobe=nprobe, ef_search=ef_search, sel=sel),
+        )
+        if sel is not None and n_allowed is not None:
+            short = np.where((indices >= 0).sum(axis=1) < min(top_k, n_allowed))[0]
+            approx = [n for n in names if exhaustive_params(self.shard_index(n), top_k, sel=sel) is not None]
+            if len(short) and approx:
+                wide_d, wide_i = self._fan_out(
+                    names, query_vecs[short], top_k,
+                    lambda index: exhaustive_params(index, top_k, sel=sel) or search_params(index, sel=sel),
+                )
+                distances[short], indices[short] = wide_d, wide_i
+        return distances, indices
+
+    def layout(self) -> List[Dict]:
+        """
+        Un registro por shard: vectores, tipo, almacenamiento, si ya se cargó y tiempos
+        de carga y de búsqueda.
+        """
+        rows = []
+        with self._lock:
+            for name, shard in self.shards.items():
+                stats = self.timings[name]
+                index = shard.get("index")
+                rows.append({
+                    "shard": name,
+                    "file": shard.get("file"),
+                    "vectors": int(shard["vectors"]) if "vectors" in shard else (index.ntotal if index else None),
+                    "kind": shard.get("kind") or (index_kind(index) if index else None),
+                    "storage": shard.get("storage", "float32"),
+                    "loaded": index is not None,
+                    "load_ms": stats["load_ms"],
+                    "searches": stats["searches"],
+                    "mean_ms": stats["total_ms"] / stats["searches"] if stats["searches"] else None,
+                    "max_ms": stats["max_ms"],
+                })
+        return sorted(rows, key=lambda r: -(r["vectors"] or 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distribución de los shards del índice y tiempo de búsqueda por shard")
+    parser.add_argument("--index-dir", default="index/faiss")
+    parser.add_argument("--queries", type=int, default=100, help="Consultas de prueba tomadas de embeddings.npy")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--output", default=None, help="Ruta opcional para guardar el reporte en JSON")
+    args = parser.parse_args()
+
+    version_dir = current_index_dir(args.index_dir)
+    sharded = ShardedIndex.load(version_dir)
+    embeddings = np.load(os.path.join(version_dir, "embeddings.npy"), mmap_mode="r")
+    if len(embeddings) and args.queries:
+        rng = np.random.default_rng(0)
+        sample = np.sort(rng.choice(len(embeddings), size=min(args.queries, len(embeddings)), replace=False))
+        queries = np.ascontiguousarray(embeddings[sample], dtype="float32")
+        for row in range(len(queries)):
+            sharded.search(queries[row:row + 1], args.k)
+
+    report = sharded.layout()
+    print(f"\n{sharded.describe()} ({sharded.ntotal} vectores)")
+    print(f"{'shard':<30}{'vectores':>10}{'tipo':>10}{'media ms':>10}{'máx ms':>10}")
+    for row in report:
+        mean = f"{row['mean_ms']:.3f}" if row["mean_ms"] is not None else "-"
+        print(f"{row['shard'][:29]:<30}{row['vectors']:>10}{row['kind']:>10}{mean:>10}{row['max_ms']:>10.3f}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"shard_by": sharded.shard_by, "shards": report}, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
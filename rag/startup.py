@@ -0,0 +1,117 @@
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+from rag.utils import setup_logger
+
+logger = setup_logger("startup")
+
+# Dependencias pesadas: se informa cuáles arrastra cada módulo al importarse
+HEAVY_MODULES = ("numpy", "faiss", "torch", "transformers", "sentence_transformers", "aiohttp", "streamlit")
+# Puntos de entrada del paquete (lo que importan la UI, el servidor y los jobs)
+ENTRY_MODULES = (
+    "rag.client", "rag.resources", "rag.pipelines", "rag.ingest", "rag.index_builder",
+    "rag.server", "rag.retriever", "rag.store_faiss", "rag.generator",
+)
+
+
+def _measure_import(module: str) -> Dict:
+    # Corre en un proceso nuevo (spawn): el import es en frío y no depende de los anteriores
+    before = set(sys.modules)
+    start = time.perf_counter()
+    try:
+        importlib.import_module(module)
+    except ImportError as e:
+        return {"module": module, "error": str(e)}
+    elapsed = time.perf_counter() - start
+    pulled = [m for m in HEAVY_MODULES if m in sys.modules and m not in before and m != module]
+    return {"module": module, "import_seconds": elapsed, "pulls": pulled}
+
+
+def _measure_query_path(parallel: bool) -> Dict:
+    # Arranque en frío del camino de consulta: registro + embedder + índice + LLM
+    os.environ["RAG_PARALLEL_LOAD"] = "1" if parallel else "0"
+    start = time.perf_counter()
+    from rag.resources import get_registry
+    registry = get_registry()
+    registry.get_generator()
+    elapsed = time.perf_counter() - start
+    return {"parallel": parallel, "seconds": elapsed, "components": registry.report()}
+
+
+def _in_fresh_process(fn, *args):
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+        return pool.submit(fn, *args).result()
+
+
+def profile_startup(modules: List[str] = None, load: bool = True) -> Dict: # type: ignore
+    """
+    Tiempo de import de cada módulo (y qué dependencias pesadas arrastra) y tiempo
+    de carga de cada componente del camino de consulta, secuencial y en paralelo.
+    Cada medición corre en un intérprete nuevo.
+    """
+    modules = modules or list(ENTRY_MODULES + HEAVY_MODULES)
+    report: Dict = {"imports": [], "query_path": {}}
+    for module in modules:
+        row = _in_fresh_process(_measure_import, module)
+        report["imports"].append(row)
+        logger.info(f"import {module}: {row.get('import_seconds', float('nan')):.2f}s")
+    if load:
+        for parallel in (False, True):
+            mode = "parallel" if parallel else "sequential"
+            try:
+                report["query_path"][mode] = _in_fresh_process(_measure_query_path, parallel)
+            except Exception as e:
+                logger.error(f"No se pudo medir la carga {mode}: {e}")
+                report["query_path"][mode] = {"error": str(e)}
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Perfil de arranque en frío: imports y carga de modelos por componente")
+    parser.add_argument("--modules", default=",".join(ENTRY_MODULES + HEAVY_MODULES))
+    parser.add_argument("--no-load", action="store_true", help="Solo imports (sin cargar modelos ni índice)")
+    parser.add_argument("--budget", type=float, default=None, help="Segundos máximos para el arranque del camino de consulta")
+    parser.add_argument("--output", default=None, help="Ruta opcional para guardar el reporte en JSON")
+    args = parser.parse_args()
+
+    report = profile_startup(args.modules.split(","), load=not args.no_load)
+
+    print(f"\n{'módulo':<28}{'import s':>10}  arrastra")
+    for row in report["imports"]:
+        if "error" in row:
+            print(f"{row['module']:<28}{'error':>10}  {row['error']}")
+            continue
+        print(f"{row['module']:<28}{row['import_seconds']:>10.2f}  {', '.join(row['pulls']) or '-'}")
+
+    for mode, data in report["query_path"].items():
+        if "error" in data:
+            print(f"\nCamino de consulta ({mode}): error: {data['error']}")
+            continue
+        print(f"\nCamino de consulta ({mode}): {data['seconds']:.2f}s")
+        for row in data["components"]:
+            print(f"  {row['component']:<16}{row['load_seconds']:>8.2f}s")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if args.budget is not None:
+        cold_start = report["query_path"].get("parallel", {}).get("seconds")
+        if cold_start is None:
+            print("\nNo se pudo medir el arranque para compararlo con el presupuesto.")
+            sys.exit(1)
+        ok = cold_start <= args.budget
+        print(f"\nArranque en frío {cold_start:.2f}s / presupuesto {args.budget:.2f}s: {'OK' if ok else 'EXCEDIDO'}")
+        if not ok:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,69 +1,444 @@
 import os
 import json
+import shutil
+import hashlib
 import numpy as np
 import faiss
-from rag.embeddings import Embedder
-from rag.utils import setup_logger, ensure_dirs
+from typing import Callable, Dict, List
+from rag.embeddings import EMBED_WORKERS, Embedder
+from rag.embedding_cache import EmbeddingCache, content_hash, encoder_signature
+from rag.dedup import (
+    DEDUP_THRESHOLD, collapse_near_duplicates, groups_digest, load_dedup_state, save_dedup_state,
+)
+from rag.index_factory import auto_index_kind, make_index, supports_removal
+from rag.lexical import LexicalIndex
+from rag.metadata_store import MetadataStore
+from rag.shards import MANIFEST, DEFAULT_SHARD_BY, ShardedIndex, ids_digest, shard_file, shard_name, shard_value
+from rag.tracing import span
+from rag.vector_storage import VECTOR_STORAGE, check_storage, embedding_dtype, load_embeddings, save_embeddings
+from rag.utils import (
+    setup_logger, ensure_dirs, write_index_version, new_index_version, index_version_dir, read_current_index,
+)
 
 logger = setup_logger("faiss_store")
 
+# Archivos de cada versión del índice (y del formato anterior, sueltos en index_dir)
+INDEX_FILES = (MANIFEST, "metadata.sqlite", "lexical.sqlite", "embeddings.npy", "vector_ids.npy")
+LEGACY_FILES = INDEX_FILES + ("tickets.index", "VERSION", "metadatas.npy")
+
+
+def vector_id(ticket_id, chunk_id) -> int:
+    """
+    ID estable (int63) de un chunk dentro del índice FAISS, derivado de (ticket_id, chunk_id).
+    """
+    digest = hashlib.sha1(f"{ticket_id}:{chunk_id}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little") & 0x7FFFFFFFFFFFFFFF
+
+
+def load_latest_chunks(processed_path: str) -> Dict[int, Dict]:
+    """
+    Lee tickets_processed.jsonl y se queda con la última versión de cada ticket.
+    El archivo se escribe en modo append, así que un ticket re-ingestado aparece
+    de nuevo empezando por chunk_id 0: esa aparición reemplaza a la anterior.
+    Una marca de borrado (ver rag.ingest.delete_tickets) quita el ticket.
+    Devuelve {vector_id: metadata} ya con content_hash.
+    """
+    latest: Dict[str, List[Dict]] = {}
+    with open(processed_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            key = str(record["ticket_id"])
+            if record.get("deleted"):
+                latest.pop(key, None)
+                continue
+            if record["chunk_id"] == 0 or key not in latest:
+                latest[key] = []
+            latest[key].append(record)
+
+    chunks = {}
+    for records in latest.values():
+        for record in records:
+            vid = vector_id(record["ticket_id"], record["chunk_id"])
+            chunks[vid] = {
+                "vector_id": vid,
+                "ticket_id": record["ticket_id"],
+                "chunk_id": record["chunk_id"],
+                "content": record["content"],
+                "content_hash": content_hash(record["content"]),
+                "start_word": record.get("start_word"),
+                "end_word": record.get("end_word"),
+                "project": record.get("project"),
+                "category": record.get("category"),
+                "status": record.get("status"),
+                "created_at": record.get("created_at")
+            }
+    return chunks
+
+
+def _load_existing(index_dir: str):
+    """
+    Carga el estado incremental actual: shards.json (None en versiones de un solo
+    tickets.index), {vector_id: content_hash} del store de metadatos y embeddings
+    alineados con vector_ids.npy. Los índices de cada shard se leen solo si cambian.
+    Devuelve (None, {}, None, None) si falta algo y hay que reconstruir.
+    """
+    paths = {name: os.path.join(index_dir, name) for name in
+             ("metadata.sqlite", "embeddings.npy", "vector_ids.npy")}
+    manifest_path = os.path.join(index_dir, MANIFEST)
+    legacy_path = os.path.join(index_dir, "tickets.index")
+    if not all(os.path.exists(p) for p in paths.values()) or not (
+            os.path.exists(manifest_path) or os.path.exists(legacy_path)):
+        return None, {}, None, None
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        n_vectors = sum(info["vectors"] for info in manifest["shards"].values())
+    else:
+        manifest = {"shard_by": None, "shards": {}}
+        n_vectors = faiss.read_index(legacy_path).ntotal
+    store = MetadataStore(paths["metadata.sqlite"], readonly=True)
+    hashes = store.content_hashes()
+    store.close()
+    embeddings = load_embeddings(paths["embeddings.npy"]).astype("float32")
+    ids = np.load(paths["vector_ids.npy"])
+    if not (n_vectors == len(hashes) == len(embeddings) == len(ids)):
+        logger.warning("Índice, metadatos y embeddings desalineados, se reconstruye completo.")
+        return None, {}, None, None
+    return manifest, hashes, embeddings, ids
+
+
+def validate_index_dir(version_dir: str, index: ShardedIndex = None, probes: int = 8) -> Dict: # type: ignore
+    """
+    Verifica una versión recién construida antes de publicarla: todos los archivos
+    presentes y alineados, y algunos vectores guardados se encuentran a sí mismos.
+    """
+    missing = [name for name in INDEX_FILES if not os.path.exists(os.path.join(version_dir, name))]
+    if missing:
+        raise RuntimeError(f"Faltan archivos en {version_dir}: {missing}")
+
+    index = index or ShardedIndex.load(version_dir)
+    store = MetadataStore(os.path.join(version_dir, "metadata.sqlite"), readonly=True)
+    n_meta = store.count()
+    store.close()
+    lexical = LexicalIndex(os.path.join(version_dir, "lexical.sqlite"), readonly=True)
+    n_lexical = lexical.count()
+    lexical.close()
+    embeddings = load_embeddings(os.path.join(version_dir, "embeddings.npy"), mmap=True)
+    ids = np.load(os.path.join(version_dir, "vector_ids.npy"))
+    counts = {"vectors": index.ntotal, "metadata": n_meta, "lexical": n_lexical, "embeddings": len(embeddings), "ids": len(ids)}
+    if len(set(counts.values())) != 1:
+        raise RuntimeError(f"Versión desalineada en {version_dir}: {counts}")
+
+    sample = np.unique(np.linspace(0, len(ids) - 1, num=min(probes, len(ids)), dtype="int64"))
+    _, found = index.search(np.asarray(embeddings[sample], dtype="float32"), 10)
+    self_recall = float(np.mean([ids[i] in row for i, row in zip(sample, found)]))
+    if self_recall < 0.5:
+        raise RuntimeError(f"La versión en {version_dir} no encuentra sus propios vectores (recall {self_recall:.2f})")
+    return {**counts, "self_recall": self_recall}
+
+
+def _link_or_copy(src: str, dst: str):
+    # Las versiones publicadas no se modifican: un shard sin cambios se comparte por hard link
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def gc_index_versions(index_dir: str = "index/faiss", keep: int = 2) -> List[str]:
+    """
+    Borra las versiones anteriores a la publicada salvo las keep - 1 más recientes
+    (un lector que todavía esté usando la anterior no se queda sin archivos), y los
+    archivos sueltos del formato anterior. Las versiones más nuevas que la publicada
+    pueden ser un build en curso y no se tocan. Lo que no se puede borrar (p. ej.
+    archivos abiertos en Windows) se reintenta en el próximo GC.
+    """
+    if not os.path.exists(os.path.join(index_dir, "CURRENT")):
+        return []
+    current, _ = read_current_index(index_dir)
+    versions_dir = os.path.join(index_dir, "versions")
+
+    older = sorted(v for v in os.listdir(versions_dir) if v < current)
+    removed = []
+    for version in older[:max(len(older) - (keep - 1), 0)]:
+        shutil.rmtree(index_version_dir(index_dir, version), ignore_errors=True)
+        removed.append(version)
+    for name in LEGACY_FILES:
+        try:
+            os.remove(os.path.join(index_dir, name))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"No se pudo borrar {name} del formato anterior: {e}")
+    if removed:
+        logger.info(f"Versiones del índice eliminadas: {removed}")
+    return removed
+
+
 def build_faiss_index(
     processed_path: str = "data/processed/tickets_processed.jsonl",
-    index_dir: str = "index/faiss"
+    index_dir: str = "index/faiss",
+    incremental: bool = True,
+    index_type: str = "auto",
+    embedder: Embedder = None, # type: ignore
+    progress: Callable[[str, float], None] = None, # type: ignore
+    keep_versions: int = 2,
+    shard_by: str = DEFAULT_SHARD_BY,
+    storage: str = VECTOR_STORAGE,
+    dedup_threshold: float = DEDUP_THRESHOLD,
 ):
     """
     Lee los chunks procesados, genera embeddings y crea el índice FAISS.
+    En modo incremental solo se codifican y agregan los chunks nuevos o modificados;
+    los de tickets actualizados o eliminados se reemplazan o se quitan del índice.
+    index_type: "auto", "flat", "ivf_flat", "ivf_pq" o "hnsw" (ver rag.index_factory);
+    con "auto" cada shard elige el tipo según su propio tamaño.
+    embedder permite reutilizar uno ya cargado (o un modelo distinto, p. ej. en benchmarks).
+
+    El índice se parte en shards por shard_by ("project", "year" o "none", ver
+    rag.shards). Cada shard se actualiza por separado: los que no cambiaron se
+    reutilizan de la versión anterior sin leerlos.
+    storage ("float32", "float16" o "sq8", ver rag.vector_storage) fija la precisión
+    de los vectores en el índice, en embeddings.npy y en el caché de embeddings.
+    Los chunks casi idénticos de tickets distintos (Jaccard >= dedup_threshold, ver
+    rag.dedup) se indexan una sola vez; el representante guarda los tickets colapsados.
+
+    Cada build escribe un directorio nuevo index_dir/versions/<versión> (las versiones
+    publicadas nunca se modifican), lo valida y recién entonces mueve CURRENT hacia él.
+    progress(etapa, fracción) informa el avance (ver rag.index_builder).
     """
     ensure_dirs()
     os.makedirs(index_dir, exist_ok=True)
+    check_storage(storage)
+    progress = progress or (lambda stage, fraction: None)
 
     if not os.path.exists(processed_path):
         logger.error(f"No se encontró el archivo {processed_path}.")
         return
 
-    # Leer todos los chunks
-    texts, metadatas = [], []
+    # Leer la última versión de cada chunk
     logger.info(f"Leyendo chunks desde {processed_path}...")
-    with open(processed_path, "r", encoding="utf-8") as f:
-        for line in f:
-            record = json.loads(line)
-            texts.append(record["content"])
-            metadatas.append({
-                "ticket_id": record["ticket_id"],
-                "chunk_id": record["chunk_id"],
-                "content": record["content"], 
-                "project": record.get("project"),
-                "category": record.get("category"),
-                "status": record.get("status"),
-                "created_at": record.get("created_at")
-            })
+    progress("load_chunks", 0.0)
+    with span("load_chunks") as s:
+        desired = load_latest_chunks(processed_path)
+        s.set(chunks=len(desired))
+
+    # Estado de partida: la versión publicada (o los archivos sueltos del formato anterior)
+    _, source_dir = read_current_index(index_dir)
+    manifest, existing, embeddings, ids = (None, {}, None, None)
+    if incremental:
+        manifest, existing, embeddings, ids = _load_existing(source_dir)
+    has_state = manifest is not None
+
+    # Casi duplicados: solo se codifica e indexa un chunk por grupo. Las firmas del build
+    # anterior se reutilizan y, con el mismo umbral y partición, también sus grupos
+    with span("dedup", threshold=dedup_threshold) as s:
+        total_chunks = len(desired)
+        previous = load_dedup_state(source_dir) if has_state and dedup_threshold > 0 else {}
+        previous["reuse_groups"] = (
+            has_state and manifest["shard_by"] == shard_by # type: ignore
+            and manifest.get("duplicates", {}).get("threshold") == dedup_threshold # type: ignore
+        )
+        desired, duplicates, dedup_state = collapse_near_duplicates(
+            desired, dedup_threshold, previous=previous, partition=lambda meta: shard_value(meta, shard_by),
+        )
+        dedup_info = {
+            "threshold": dedup_threshold,
+            "groups": len(duplicates),
+            "collapsed": total_chunks - len(desired),
+            "digest": groups_digest(duplicates),
+        }
+        s.set(groups=dedup_info["groups"], collapsed=dedup_info["collapsed"])
 
-    if not texts:
+    if not desired:
         logger.warning("No se encontraron chunks para procesar.")
         return
 
-    # Crear embeddings
-    embedder = Embedder()
-    logger.info(f"Generando embeddings para {len(texts)} chunks...")
-    embeddings = embedder.encode(texts).astype("float32")
+    # Diferencias contra el índice actual
+    to_remove = [
+        vid for vid, h in existing.items()
+        if vid not in desired or desired[vid]["content_hash"] != h
+    ]
+    to_add = [
+        vid for vid, m in desired.items()
+        if vid not in existing or existing[vid] != m["content_hash"]
+    ]
+    logger.info(
+        f"Delta: {len(to_add)} chunks a agregar, {len(to_remove)} a quitar, "
+        f"{len(desired) - len(to_add)} sin cambios."
+    )
+
+    # Plan por shard: IDs finales, tipo de índice y si se puede reutilizar el de la versión anterior
+    shard_of = {}
+    plan: Dict[str, Dict] = {}
+    for vid, meta in desired.items():
+        value = shard_value(meta, shard_by)
+        name = shard_name(value)
+        shard_of[vid] = name
+        plan.setdefault(name, {"value": value, "ids": []})["ids"].append(vid)
+    old_shards = manifest["shards"] if has_state and manifest["shard_by"] == shard_by else {} # type: ignore
+    added = set(to_add)
+    for name, shard in plan.items():
+        shard["kind"] = auto_index_kind(len(shard["ids"])) if index_type == "auto" else index_type
+        shard["ids_hash"] = ids_digest(shard["ids"])
+        old = old_shards.get(name)
+        # Un shard con otro tipo o guardado con otra precisión se reconstruye
+        shard["same_layout"] = (
+            old is not None and old["kind"] == shard["kind"] and old.get("storage", "float32") == storage
+        )
+        shard["reuse"] = (
+            shard["same_layout"] and old["ids_hash"] == shard["ids_hash"] and not added.intersection(shard["ids"]) # type: ignore
+        )
+
+    # Sin índice léxico (o sin estado previo) se carga completo; si no, recibe el mismo delta
+    lexical_full = not has_state or not os.path.exists(os.path.join(source_dir, "lexical.sqlite"))
+    same_duplicates = (manifest or {}).get("duplicates", {}).get("digest", groups_digest({})) == dedup_info["digest"]
+    if (has_state and not to_add and not to_remove and not lexical_full and same_duplicates
+            and set(plan) == set(old_shards) and all(shard["reuse"] for shard in plan.values())):
+        logger.info("El índice ya está actualizado, no se publica una versión nueva.")
+        return ShardedIndex.load(source_dir)
+
+    # Crear embeddings (solo los que no están en el caché persistente de este encoder)
+    new_metas = [desired[vid] for vid in to_add]
+    new_vecs = None
+    if new_metas:
+        progress("encode", 0.2)
+        # Un embedder propio del build puede repartir los lotes entre procesos (RAG_EMBED_WORKERS)
+        own_embedder = embedder is None
+        embedder = embedder or Embedder(num_workers=EMBED_WORKERS)
+        cache = EmbeddingCache(
+            os.path.join(index_dir, "embedding_cache.npz"), dtype=embedding_dtype(storage),
+            signature=encoder_signature(embedder),
+        )
+        with span("encode", chunks=len(new_metas)) as s:
+            cached = sum(1 for m in new_metas if cache.get(m["content_hash"]) is not None)
+            try:
+                new_vecs = cache.get_or_encode(
+                    [m["content_hash"] for m in new_metas],
+                    [m["content"] for m in new_metas],
+                    embedder,
+                )
+            finally:
+                if own_embedder:
+                    embedder.close()
+            cache.save(live=(m["content_hash"] for m in desired.values()))
+            s.set(cache_hits=cached, encoded=len(new_metas) - cached)
+
+    # Embeddings alineados con sus IDs: se conservan los sin cambios y se agregan los nuevos
+    if embeddings is None:
+        embeddings = np.zeros((0, new_vecs.shape[1]), dtype="float32") # type: ignore
+        ids = np.zeros(0, dtype="int64")
+    keep = ~np.isin(ids, np.array(to_remove, dtype="int64")) # type: ignore
+    embeddings, ids = embeddings[keep], ids[keep] # type: ignore
+    if new_vecs is not None:
+        embeddings = np.vstack([embeddings, new_vecs]).astype("float32")
+        ids = np.concatenate([ids, np.array(to_add, dtype="int64")])
+
+    version = new_index_version()
+    target_dir = index_version_dir(index_dir, version)
+    os.makedirs(target_dir)
+    try:
+        progress("index_update", 0.6)
+        with span("index_update", added=len(to_add), removed=len(to_remove), shards=len(plan)) as s:
+            codes = {name: i for i, name in enumerate(plan)}
+            row_shard = np.fromiter((codes[shard_of[int(v)]] for v in ids), dtype="int32", count=len(ids)) # type: ignore
+            add_rows: Dict[str, List[int]] = {}
+            for row, vid in enumerate(to_add):
+                add_rows.setdefault(shard_of[vid], []).append(row)
+            counts = {"reused": 0, "updated": 0, "rebuilt": 0}
+            manifest_out = {"shard_by": shard_by, "shards": {}, "duplicates": dedup_info}
+            for name, shard in plan.items():
+                file_name = shard_file(name)
+                old = old_shards.get(name)
+                if shard["reuse"]:
+                    _link_or_copy(os.path.join(source_dir, old["file"]), os.path.join(target_dir, file_name)) # type: ignore
+                    counts["reused"] += 1
+                else:
+                    index = None
+                    if shard["same_layout"]:
+                        index = faiss.read_index(os.path.join(source_dir, old["file"])) # type: ignore
+                        if to_remove and not supports_removal(index):
+                            index = None
+                        else:
+                            if to_remove:
+                                index.remove_ids(np.array(to_remove, dtype="int64"))
+                            if name in add_rows:
+                                rows = add_rows[name]
+                                index.add_with_ids(new_vecs[rows], np.array([to_add[r] for r in rows], dtype="int64")) # type: ignore
+                            # Chunks que cambiaron de shard sin cambiar de contenido: se reconstruye
+                            if index.ntotal != len(shard["ids"]):
+                                index = None
+                    if index is None:
+                        # Construcción completa a partir de los embeddings ya calculados (no se re-codifica nada)
+                        mask = row_shard == codes[name]
+                        index = make_index(shard["kind"], embeddings[mask], ids[mask], storage=storage) # type: ignore
+                        counts["rebuilt"] += 1
+                    else:
+                        counts["updated"] += 1
+                    faiss.write_index(index, os.path.join(target_dir, file_name))
+                manifest_out["shards"][name] = {
+                    "value": shard["value"], "file": file_name, "vectors": len(shard["ids"]),
+                    "kind": shard["kind"], "storage": storage, "ids_hash": shard["ids_hash"],
+                }
+            s.set(vectors=len(ids), **counts) # type: ignore
+        logger.info(
+            f"Shards por {shard_by}: {len(plan)} ({counts['reused']} reutilizados, "
+            f"{counts['updated']} actualizados, {counts['rebuilt']} reconstruidos)."
+        )
+
+        progress("persist", 0.75)
+        with span("persist"):
+            with open(os.path.join(target_dir, MANIFEST), "w", encoding="utf-8") as f:
+                json.dump(manifest_out, f, indent=2, ensure_ascii=False)
+            # Metadatos y léxico: copia de la versión anterior + delta (la anterior no se toca)
+            for name, full in (("metadata.sqlite", not has_state), ("lexical.sqlite", lexical_full)):
+                if not full:
+                    shutil.copyfile(os.path.join(source_dir, name), os.path.join(target_dir, name))
+            store = MetadataStore(os.path.join(target_dir, "metadata.sqlite"))
+            store.apply_delta(new_metas, to_remove)
+            store.replace_duplicates(duplicates)
+            store.close()
+            if dedup_state is not None:
+                save_dedup_state(target_dir, dedup_state)
+            lexical = LexicalIndex(os.path.join(target_dir, "lexical.sqlite"))
+            if lexical_full:
+                lexical.apply_delta(list(desired.values()), [])
+            else:
+                lexical.apply_delta(new_metas, to_remove)
+            lexical.close()
+
+            # Guardar los embeddings como .npy (con sus IDs, para entrenar/reconstruir índices)
+            save_embeddings(os.path.join(target_dir, "embeddings.npy"), embeddings, storage)
+            np.save(os.path.join(target_dir, "vector_ids.npy"), ids)
 
-    dim = embeddings.shape[1]
-    logger.info(f"Creando índice FAISS (dim={dim})...")
-    index = faiss.IndexFlatIP(dim)
-    index.add(embeddings)  # type: ignore
+        progress("validate", 0.9)
+        with span("validate") as s:
+            sharded = ShardedIndex.load(target_dir)
+            s.set(**validate_index_dir(target_dir, sharded))
+    except Exception:
+        # Una versión a medias o inválida nunca se publica
+        shutil.rmtree(target_dir, ignore_errors=True)
+        raise
 
-    # Guardar índice y metadatos
-    faiss.write_index(index, os.path.join(index_dir, "tickets.index"))
-    np.save(os.path.join(index_dir, "metadatas.npy"), np.array(metadatas, dtype=object))
+    # Publicar la nueva versión para que los procesos vivos recarguen el índice
+    progress("publish", 0.95)
+    write_index_version(index_dir, version)
+    gc_index_versions(index_dir, keep=keep_versions)
+    progress("done", 1.0)
 
-    # Guardar los embeddings como .npy
-    np.save(os.path.join(index_dir, "embeddings.npy"), embeddings)
-    
-    logger.info(f"Índice FAISS creado y guardado en {index_dir}")
-    logger.info(f"Cantidad de vectores indexados: {index.ntotal}")
-    logger.info(f"Embeddings guardados en {index_dir}/embeddings.npy")
-    return index
+    logger.info(f"Índice FAISS creado y guardado en {target_dir}")
+    logger.info(f"Cantidad de vectores indexados: {sharded.ntotal} ({sharded.describe()})")
+    if dedup_info["collapsed"]:
+        logger.info(
+            f"Casi duplicados: {dedup_info['collapsed']} chunks de {total_chunks} apuntan a "
+            f"{dedup_info['groups']} representantes ({dedup_info['collapsed'] / total_chunks:.1%} menos vectores)."
+        )
+    logger.info(f"Versión de índice publicada: {version}")
+    return sharded
 
 
 if __name__ == "__main__":
-    build_faiss_index()
\ No newline at end of file
+    build_faiss_index()
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+from rag.utils import setup_logger
+
+logger = setup_logger("tracing")
+
+# RAG_TRACING=0 desactiva la instrumentación: span() devuelve un objeto vacío sin medir nada
+ENABLED = os.getenv("RAG_TRACING", "1") != "0"
+# RAG_TRACE_LOG=0 deja de loguear cada traza como una línea JSON
+LOG_TRACES = os.getenv("RAG_TRACE_LOG", "1") != "0"
+
+# Límites (segundos) de los buckets del histograma de duración por etapa
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float("inf"))
+
+_current: contextvars.ContextVar = contextvars.ContextVar("rag_trace", default=None)
+
+
+class _NoopSpan:
+    """
+    Span vacío cuando la instrumentación está desactivada (o no hay traza activa).
+    """
+
+    def set(self, **attrs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class Span:
+    def __init__(self, trace: "Trace", name: str, attrs: Dict):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.start = 0.0
+        self.seconds = 0.0
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+        return self
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.trace.add(self)
+        return False
+
+
+class Trace:
+    """
+    Spans de una operación (una consulta o un build del índice).
+    """
+
+    def __init__(self, name: str, attrs: Dict):
+        self.name = name
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.attrs = attrs
+        self.spans: List[Span] = []
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self) -> Dict:
+        return {
+            "trace": self.name,
+            "trace_id": self.trace_id,
+            "started_at": self.started_at,
+            "duration_ms": self.seconds * 1000,
+            **self.attrs,
+            "spans": [
+                {"name": s.name, "offset_ms": (s.start - self.start) * 1000, "duration_ms": s.seconds * 1000, **s.attrs}
+                for s in sorted(self.spans, key=lambda s: s.start)
+            ],
+        }
+
+
+class Metrics:
+    """
+    Histograma de duración por etapa y contadores de los atributos numéricos de
+    los spans (tokens, vectores, aciertos de caché), en formato Prometheus.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations: Dict[str, Dict] = {}
+        self.counters: Dict[tuple, float] = {}
+        self.last_traces: Dict[str, Dict] = {}
+
+    def observe(self, trace: Trace):
+        with self._lock:
+            for span in trace.spans + [trace]: # type: ignore
+                stage = span.name
+                hist = self.durations.setdefault(stage, {"count": 0, "sum": 0.0, "buckets": [0] * len(BUCKETS)})
+                hist["count"] += 1
+                hist["sum"] += span.seconds
+                for i, bound in enumerate(BUCKETS):
+                    if span.seconds <= bound:
+                        hist["buckets"][i] += 1
+                for attr, value in span.attrs.items():
+                    if isinstance(value, bool):
+                        value = int(value)
+                    if isinstance(value, (int, float)):
+                        key = (stage, attr)
+                        self.counters[key] = self.counters.get(key, 0) + value
+            self.last_traces[trace.name] = trace.to_dict()
+
+    def last_trace(self, name: str = "answer_query") -> Optional[Dict]:
+        with self._lock:
+            return self.last_traces.get(name)
+
+    def prometheus_text(self) -> str:
+        lines = [
+            "# HELP rag_stage_duration_seconds Duración de cada etapa del pipeline",
+            "# TYPE rag_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            for stage, hist in sorted(self.durations.items()):
+                # Los buckets ya son acumulativos: cada observación suma en todos los bound >= duración
+                for bound, count in zip(BUCKETS, hist["buckets"]):
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'rag_stage_duration_seconds_bucket{{stage="{stage}",le="{le}"}} {count}')
+                lines.append(f'rag_stage_duration_seconds_sum{{stage="{stage}"}} {hist["sum"]}')
+                lines.append(f'rag_stage_duration_seconds_count{{stage="{stage}"}} {hist["count"]}')
+            lines += [
+                "# HELP rag_stage_attribute_total Suma de los atributos numéricos de cada etapa",
+                "# TYPE rag_stage_attribute_total counter",
+            ]
+            for (stage, attr), value in sorted(self.counters.items()):
+                lines.append(f'rag_stage_attribute_total{{stage="{stage}",attr="{attr}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {
+                "durations": {s: {"count": h["count"], "sum_s": h["sum"]} for s, h in self.durations.items()},
+                "counters": {f"{s}.{a}": v for (s, a), v in self.counters.items()},
+            }
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def trace(name: str, **attrs):
+    """
+    Abre una traza (p. ej. "answer_query"); los span() de este contexto se le agregan.
+    Al cerrar se alimentan las métricas y se loguea como una línea JSON.
+    """
+    if not ENABLED:
+        yield _NOOP
+        return
+    current = Trace(name, attrs)
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        current.seconds = time.perf_counter() - current.start
+        try:
+            _current.reset(token)
+        except ValueError:
+            # Generador cerrado desde otro contexto (p. ej. rerun de Streamlit)
+            _current.set(None)
+        metrics.observe(current)
+        if LOG_TRACES:
+            logger.info(json.dumps(current.to_dict(), ensure_ascii=False, default=str))
+
+
+def span(name: str, **attrs):
+    """
+    Mide una etapa dentro de la traza activa. Sin traza o desactivado no hace nada.
+    """
+    if not ENABLED:
+        return _NOOP
+    current = _current.get()
+    if current is None:
+        return _NOOP
+    return Span(current, name, attrs)
+
+
+def record_span(name: str, seconds: float, start: float = None, **attrs): # type: ignore
+    """
+    Agrega una etapa medida por otro medio (p. ej. prefill/decode del monitor de generación).
+    start es el perf_counter() de inicio; si falta se asume que terminó recién.
+    """
+    if not ENABLED:
+        return
+    current = _current.get()
+    if current is None:
+        return
+    s = Span(current, name, attrs)
+    s.start = start if start is not None else time.perf_counter() - seconds
+    s.seconds = seconds
+    current.add(s)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get() if ENABLED else None
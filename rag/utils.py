@@ -1,5 +1,6 @@
 import logging
 import os
+import time
 
 def setup_logger(name: str = "rag"):
     logger = logging.getLogger(name)
@@ -14,4 +15,72 @@ def setup_logger(name: str = "rag"):
 def ensure_dirs():
     # Crea las carpetas necesarias para que el sistema funcione
     for path in ["data/raw", "data/processed", "index/faiss"]:
-        os.makedirs(path, exist_ok=True)
\ No newline at end of file
+        os.makedirs(path, exist_ok=True)
+
+def new_index_version() -> str:
+    """
+    Nombre de una versión nueva del índice (ordenable por fecha de creación).
+    """
+    return str(time.time_ns())
+
+def index_version_dir(index_dir: str, version: str) -> str:
+    return os.path.join(index_dir, "versions", version)
+
+def write_index_version(index_dir: str = "index/faiss", version: str = None) -> str: # type: ignore
+    """
+    Publica una versión del índice apuntando CURRENT a index_dir/versions/<version>
+    (reemplazo atómico: los lectores ven la versión anterior completa o la nueva completa).
+    """
+    version = version or new_index_version()
+    tmp_path = os.path.join(index_dir, "CURRENT.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp_path, os.path.join(index_dir, "CURRENT"))
+    return version
+
+def read_index_version(index_dir: str = "index/faiss"):
+    """
+    Devuelve la versión publicada del índice, o None si todavía no existe.
+    Sin CURRENT (índices anteriores a los directorios versionados) se usa el archivo
+    VERSION o el mtime del índice.
+    """
+    for name in ("CURRENT", "VERSION"):
+        version_path = os.path.join(index_dir, name)
+        if os.path.exists(version_path):
+            with open(version_path, "r", encoding="utf-8") as f:
+                return f.read().strip()
+    index_path = os.path.join(index_dir, "tickets.index")
+    if os.path.exists(index_path):
+        return str(os.stat(index_path).st_mtime_ns)
+    return None
+
+def read_current_index(index_dir: str = "index/faiss"):
+    """
+    (versión publicada, directorio con sus archivos), leídos juntos de una sola lectura
+    de CURRENT. En el formato anterior el directorio es index_dir.
+    """
+    current_path = os.path.join(index_dir, "CURRENT")
+    try:
+        with open(current_path, "r", encoding="utf-8") as f:
+            version = f.read().strip()
+        return version, index_version_dir(index_dir, version)
+    except FileNotFoundError:
+        return read_index_version(index_dir), index_dir
+
+def current_index_dir(index_dir: str = "index/faiss") -> str:
+    return read_current_index(index_dir)[1]
+
+def rss_bytes():
+    """
+    Memoria residente del proceso actual (None si no se puede medir).
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
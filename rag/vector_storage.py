@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+import faiss
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List
+from rag.utils import setup_logger, rss_bytes
+
+logger = setup_logger("vector_storage")
+
+# Precisión con que se guardan los vectores en el índice y en los embeddings en disco:
+# "float32" (exacto), "float16" (la mitad) o "sq8" (un byte por dimensión; los
+# embeddings.npy y el caché quedan en float16 para reentrenar sin acumular error)
+STORAGE_OPTIONS = ("float32", "float16", "sq8")
+VECTOR_STORAGE = os.getenv("RAG_VECTOR_STORAGE", "float32")
+# RAG_INDEX_MMAP=0 lee el índice completo a memoria privada en lugar de mapearlo
+INDEX_MMAP = os.getenv("RAG_INDEX_MMAP", "1") != "0"
+# RAG_LAZY_INDEX=0 carga todos los shards al abrir la versión en lugar de en la primera búsqueda
+LAZY_INDEX = os.getenv("RAG_LAZY_INDEX", "1") != "0"
+
+# Layouts que compara el reporte de memoria (el primero es el formato anterior)
+REPORT_LAYOUTS = {
+    "float32": ("float32", False),
+    "float32_mmap": ("float32", True),
+    "float16_mmap": ("float16", True),
+    "sq8_mmap": ("sq8", True),
+}
+
+
+def check_storage(storage: str) -> str:
+    if storage not in STORAGE_OPTIONS:
+        raise ValueError(f"Almacenamiento de vectores desconocido: {storage} (opciones: {', '.join(STORAGE_OPTIONS)})")
+    return storage
+
+
+def codec(storage: str) -> str:
+    """
+    Codificación de los vectores para faiss.index_factory ("Flat", "SQfp16" o "SQ8").
+    """
+    return {"float32": "Flat", "float16": "SQfp16", "sq8": "SQ8"}[check_storage(storage)]
+
+
+def embedding_dtype(storage: str) -> str:
+    return "float32" if check_storage(storage) == "float32" else "float16"
+
+
+def read_index(path: str, mmap: bool = INDEX_MMAP):
+    """
+    Lee un índice FAISS. Con mmap los vectores quedan en la caché de páginas del
+    sistema, compartidos entre todos los procesos que abren el mismo archivo.
+    Si la versión de FAISS no puede mapear ese tipo de índice se lee normal.
+    """
+    if mmap:
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError as e:
+            logger.warning(f"No se pudo mapear {path} ({e}); se lee a memoria.")
+    return faiss.read_index(path)
+
+
+def save_embeddings(path: str, embeddings: np.ndarray, storage: str = "float32"):
+    np.save(path, np.asarray(embeddings, dtype=embedding_dtype(storage)))
+
+
+def load_embeddings(path: str, mmap: bool = False) -> np.ndarray:
+    """
+    Embeddings guardados (float32 o float16). Con mmap no se copian a memoria:
+    quien los necesite en float32 los convierte por partes.
+    """
+    return np.load(path, mmap_mode="r" if mmap else None)
+
+
+def memory_breakdown() -> Dict:
+    """
+    Memoria residente del proceso, separando páginas privadas y compartidas
+    (las de un archivo mapeado por varios procesos cuentan una sola vez en el sistema).
+    """
+    stats: Dict = {"rss_bytes": rss_bytes()}
+    try:
+        with open("/proc/self/smaps_rollup", "r") as f:
+            fields = {line.split(":")[0]: int(line.split()[1]) * 1024 for line in f if line.split()[-1] == "kB"}
+        stats["private_bytes"] = fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)
+        stats["shared_bytes"] = fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0)
+    except (OSError, ValueError, IndexError):
+        pass
+    return stats
+
+
+def _measure_load(path: str, mmap: bool, n_queries: int, k: int) -> Dict:
+    # Corre en un proceso nuevo (spawn) para medir la carga sin memoria heredada
+    before = memory_breakdown()
+    start = time.perf_counter()
+    index = read_index(path, mmap=mmap)
+    load_seconds = time.perf_counter() - start
+    loaded = memory_breakdown()
+
+    rng = np.random.default_rng(1)
+    queries = rng.standard_normal((n_queries, index.d)).astype("float32")
+    faiss.normalize_L2(queries)
+    start = time.perf_counter()
+    index.search(queries, k)
+    search_seconds = time.perf_counter() - start
+    searched = memory_breakdown()
+
+    def delta(after: Dict, key: str):
+        if after.get(key) is None or before.get(key) is None:
+            return None
+        return after[key] - before[key]
+
+    return {
+        "load_seconds": load_seconds,
+        "rss_after_load_bytes": delta(loaded, "rss_bytes"),
+        "rss_after_search_bytes": delta(searched, "rss_bytes"),
+        "private_after_search_bytes": delta(searched, "private_bytes"),
+        "search_ms_per_query": search_seconds * 1000 / n_queries,
+    }
+
+
+def memory_report(
+    sizes: List[int],
+    dim: int = 384,
+    layouts: List[str] = None, # type: ignore
+    n_queries: int = 20,
+    k: int = 10,
+    workdir: str = None, # type: ignore
+) -> List[Dict]:
+    """
+    Tamaño en disco, tiempo de carga y memoria residente de un índice exacto (flat)
+    con cada layout, sobre vectores sintéticos normalizados de varios tamaños.
+    Cada carga se mide en un proceso nuevo.
+    """
+    from rag.index_factory import make_index
+
+    layouts = layouts or list(REPORT_LAYOUTS)
+    created = workdir is None
+    workdir = workdir or tempfile.mkdtemp(prefix="rag_mem_")
+    ctx = multiprocessing.get_context("spawn")
+    rows = []
+    try:
+        for n in sizes:
+            rng = np.random.default_rng(0)
+            vectors = rng.standard_normal((n, dim)).astype("float32")
+            faiss.normalize_L2(vectors)
+            for layout in layouts:
+                storage, mmap = REPORT_LAYOUTS[layout]
+                path = os.path.join(workdir, f"{layout}_{n}.index")
+                if not os.path.exists(path):
+                    faiss.write_index(make_index("flat", vectors, storage=storage), path)
+                emb_path = os.path.join(workdir, f"{storage}_{n}.npy")
+                save_embeddings(emb_path, vectors, storage)
+                with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                    measured = pool.submit(_measure_load, path, mmap, n_queries, k).result()
+                rows.append({
+                    "vectors": n,
+                    "layout": layout,
+                    "index_bytes": os.path.getsize(path),
+                    "embeddings_bytes": os.path.getsize(emb_path),
+                    **measured,
+                })
+                logger.info(f"{layout} con {n} vectores: {measured['load_seconds']:.3f}s de carga.")
+            del vectors
+    finally:
+        if created:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memoria residente y tiempo de carga del índice según cómo se guardan los vectores")
+    parser.add_argument("--sizes", default="10000,100000,300000")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--layouts", default=",".join(REPORT_LAYOUTS))
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--output", default=None, help="Ruta opcional para guardar el reporte en JSON")
+    args = parser.parse_args()
+
+    report = memory_report(
+        [int(n) for n in args.sizes.split(",")], dim=args.dim, layouts=args.layouts.split(","), n_queries=args.queries,
+    )
+
+    def mb(value):
+        return f"{value / 2**20:.1f}" if value is not None else "n/d"
+
+    print(f"\n{'vectores':>10}  {'layout':<14}{'índice MB':>10}{'emb MB':>10}{'carga s':>10}{'RSS MB':>10}{'privada MB':>12}{'ms/consulta':>13}")
+    for row in report:
+        print(
+            f"{row['vectors']:>10}  {row['layout']:<14}{mb(row['index_bytes']):>10}{mb(row['embeddings_bytes']):>10}"
+            f"{row['load_seconds']:>10.3f}{mb(row['rss_after_search_bytes']):>10}"
+            f"{mb(row['private_after_search_bytes']):>12}{row['search_ms_per_query']:>13.3f}"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
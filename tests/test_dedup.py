@@ -0,0 +1,70 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+
+from rag.dedup import MinHasher, chunk_signatures, collapse_near_duplicates, find_duplicates
+from rag.filters import FilterIndex
+from rag.metadata_store import MetadataStore
+
+PRINTER = (
+    "La impresora del tercer piso no imprime y muestra el error E-502 al enviar trabajos "
+    "desde cualquier equipo de la red, se reinició el spooler y el problema continúa igual"
+)
+
+
+def _chunk(vid, ticket_id, content, status="abierto", created_at="2024-01-10", category="Impresora"):
+    return {
+        "vector_id": vid, "ticket_id": ticket_id, "chunk_id": 0, "content": content,
+        "content_hash": str(hash(content)), "start_word": 0, "end_word": len(content.split()),
+        "project": "Soporte", "category": category, "status": status, "created_at": created_at,
+    }
+
+
+def _corpus():
+    rng = np.random.default_rng(0)
+    words = [f"palabra{i}" for i in range(500)]
+    chunks = {1: _chunk(1, 100, PRINTER, created_at="2023-05-01"), 2: _chunk(2, 200, PRINTER + " hoy", status="resuelto")}
+    for vid in range(3, 60):
+        chunks[vid] = _chunk(vid, 1000 + vid, " ".join(rng.choice(words, 40)))
+    return chunks
+
+
+def test_incremental_matches_full_build():
+    chunks = _corpus()
+    _, _, state = collapse_near_duplicates(chunks, 0.8)
+    assert state["groups"] == {1: [2]}
+
+    # Un ticket nuevo casi idéntico y otro distinto: solo se firman esos dos
+    chunks[60] = _chunk(60, 300, PRINTER + " otra vez", created_at="2024-02-01")
+    chunks[61] = _chunk(61, 301, "Pedido de alta de usuario en el sistema de facturación para el área de compras")
+    hasher = MinHasher()
+    signatures = chunk_signatures(chunks, hasher, state)
+    assert all(signatures[vid] is state["signatures"][vid] for vid in range(1, 60))
+
+    _, _, incremental = collapse_near_duplicates(chunks, 0.8, previous={**state, "reuse_groups": True})
+    assert {rep: sorted(m) for rep, m in incremental["groups"].items()} == {1: [2, 60]}
+    assert {rep: sorted(m) for rep, m in find_duplicates(chunks, 0.8).items()} == {1: [2, 60]}
+
+
+def test_members_keep_their_metadata(tmp_path):
+    chunks = _corpus()
+    kept, members, _ = collapse_near_duplicates(chunks, 0.8)
+    store = MetadataStore(str(tmp_path / "metadata.sqlite"))
+    store.apply_delta(list(kept.values()), [])
+    store.replace_duplicates(members)
+
+    # El miembro (ticket 200, resuelto) cumple el filtro aunque su representante (ticket 100) no
+    filters = {"status": "resuelto", "category": "Impresora"}
+    index = FilterIndex(store)
+    assert 1 in index.searchable_ids(filters)
+    assert index.resolve([1, 3], filters) == [2, -1]
+    assert index.resolve([1], {"created_to": "2023-12-31"}) == [1]
+
+    assert store.ticket_vector_ids("200") == [2]
+    meta = store.get_many([2])[2]
+    assert (meta["ticket_id"], meta["status"], meta["duplicate_of"]) == (200, "resuelto", 1)
+    assert meta["content"] == PRINTER
+    assert meta["duplicate_ticket_ids"] == [100]
+    assert store.get_many([1])[1]["duplicate_ticket_ids"] == [200]
+    store.close()
@@ -0,0 +1,75 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from rag.embedding_cache import EmbeddingCache, content_hash
+
+
+class CountingEmbedder:
+    def __init__(self, model_name="modelo-a", backend="fp32"):
+        self.model_name, self.backend, self.calls = model_name, backend, 0
+
+    def encode(self, texts):
+        self.calls += len(texts)
+        return np.ones((len(texts), 4), dtype="float32")
+
+
+def _signature(embedder):
+    return {"model": embedder.model_name, "backend": embedder.backend, "max_tokens": 254}
+
+
+def test_cache_invalidated_by_encoder_and_pruned(tmp_path):
+    path = str(tmp_path / "embedding_cache.npz")
+    texts = ["primer chunk", "segundo chunk"]
+    hashes = [content_hash(t) for t in texts]
+
+    embedder = CountingEmbedder()
+    cache = EmbeddingCache(path, signature=_signature(embedder))
+    cache.get_or_encode(hashes, texts, embedder)
+    cache.save(live=hashes)
+
+    # Mismo encoder: todo sale del caché
+    cache = EmbeddingCache(path, signature=_signature(embedder))
+    cache.get_or_encode(hashes, texts, embedder)
+    assert embedder.calls == 2
+
+    # Otro backend: el caché se descarta
+    int8 = CountingEmbedder(backend="int8")
+    cache = EmbeddingCache(path, signature=_signature(int8))
+    assert len(cache) == 0
+    cache.get_or_encode(hashes, texts, int8)
+    assert int8.calls == 2
+
+    # Al guardar solo quedan los chunks vigentes
+    cache.save(live=hashes[:1])
+    assert set(EmbeddingCache(path, signature=_signature(int8))._vectors) == {hashes[0]}
+
+
+def test_save_writes_only_new_entries(tmp_path):
+    path = str(tmp_path / "embedding_cache.npz")
+    embedder = CountingEmbedder()
+    texts = [f"chunk {i}" for i in range(8)]
+    hashes = [content_hash(t) for t in texts]
+
+    cache = EmbeddingCache(path, signature=_signature(embedder))
+    cache.get_or_encode(hashes[:6], texts[:6], embedder)
+    cache.save(live=hashes[:6])
+    base_mtime = (tmp_path / "embedding_cache.npz").stat().st_mtime_ns
+
+    # Un build incremental agrega un segmento con lo suyo y no reescribe el archivo base
+    cache = EmbeddingCache(path, signature=_signature(embedder))
+    cache.get_or_encode(hashes[6:], texts[6:], embedder)
+    cache.save(live=hashes)
+    segments = sorted(p.name for p in tmp_path.glob("embedding_cache.npz.seg-*.npz"))
+    assert segments == ["embedding_cache.npz.seg-00001.npz"]
+    assert (tmp_path / "embedding_cache.npz").stat().st_mtime_ns == base_mtime
+    with np.load(tmp_path / segments[0]) as data:
+        assert sorted(data["keys"].tolist()) == sorted(hashes[6:])
+    assert set(EmbeddingCache(path, signature=_signature(embedder))._vectors) == set(hashes)
+
+    # Muchas entradas de chunks borrados: se compacta en un solo archivo
+    cache = EmbeddingCache(path, signature=_signature(embedder))
+    cache.save(live=hashes[:4])
+    assert not list(tmp_path.glob("embedding_cache.npz.seg-*.npz"))
+    assert set(EmbeddingCache(path, signature=_signature(embedder))._vectors) == set(hashes[:4])
+    assert embedder.calls == 8
@@ -0,0 +1,96 @@
+import re
+import zlib
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("pydantic")
+
+from rag.chunkers import chunk_text
+from rag.extractive import NO_ANSWER, ExtractiveAnswerer, candidate_sentences
+from rag.schema import MantisNote, MantisTicket
+
+
+class HashingEmbedder:
+    # Bolsa de palabras normalizada: el coseno mide palabras compartidas
+    def encode(self, texts):
+        vectors = np.zeros((len(texts), 512), dtype="float32")
+        for row, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                vectors[row, zlib.crc32(word.encode("utf-8")) % 512] += 1
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-9)
+
+
+def _ticket():
+    return MantisTicket(
+        id=42,
+        summary="No imprime la impresora del tercer piso",
+        description="La impresora del tercer piso muestra el error E-502 al imprimir. Pasa desde todos los equipos de la red.",
+        notes=[MantisNote(id=1, text="Se reinstaló el driver de la impresora y el error E-502 desapareció.")],
+        project={"name": "Soporte"},
+        category={"name": "Impresora"},
+        status={"name": "resuelto"},
+        resolution={"name": "corregido"},
+    )
+
+
+def test_candidate_sentences_from_real_chunk():
+    # Los chunkers unen el texto con espacios: no quedan saltos de línea entre secciones
+    content = chunk_text(_ticket().canonical_text())[0]["content"]
+    assert "\n" not in content
+
+    sentences = candidate_sentences(content)
+    assert sentences == [
+        "La impresora del tercer piso muestra el error E-502 al imprimir.",
+        "Pasa desde todos los equipos de la red.",
+        "Se reinstaló el driver de la impresora y el error E-502 desapareció.",
+    ]
+
+
+def test_evaluate_real_chunk():
+    embedder = HashingEmbedder()
+    content = chunk_text(_ticket().canonical_text())[0]["content"]
+    docs = [
+        {"ticket_id": 42, "content": content},
+        {"ticket_id": 7, "content": "Título: Alta de usuario Descripción: Pedido de alta de usuario en el sistema de compras."},
+    ]
+    answerer = ExtractiveAnswerer(embedder, thresholds={"min_score": 0.3, "min_margin": 0.05})
+    evaluation = answerer.evaluate(embedder.encode(["cómo se solucionó el error E-502 de la impresora"])[0], docs)
+
+    assert evaluation["ticket_id"] == 42
+    assert evaluation["sentences"]
+    assert answerer.confident(evaluation)
+    answer = answerer.format_answer(evaluation)
+    assert "Se reinstaló el driver de la impresora" in answer
+    assert "[Ticket 42]" in answer
+    assert "Proyecto:" not in answer
+
+
+def test_no_sentences_answer_cites_tickets():
+    embedder = HashingEmbedder()
+    docs = [{"ticket_id": 5, "content": "Proyecto: Soporte | Categoría: Red Título: Sin red Estado actual: abierto"}]
+    answerer = ExtractiveAnswerer(embedder)
+    evaluation = answerer.evaluate(embedder.encode(["no hay red"])[0], docs)
+
+    assert evaluation["sentences"] == []
+    assert answerer.format_answer(evaluation) == f"{NO_ANSWER} [Ticket 5]"
+
+
+class FailingEmbedder:
+    def encode(self, texts):
+        raise AssertionError("prescreen no debe codificar")
+
+
+def test_prescreen_uses_retrieval_cosine():
+    answerer = ExtractiveAnswerer(FailingEmbedder(), thresholds={"min_score": 0.6, "min_margin": 0.05})
+    docs = [
+        {"ticket_id": 1, "score": 0.55, "retrieval": "hybrid"},
+        {"ticket_id": 1, "score": 0.50, "retrieval": "hybrid"},
+        {"ticket_id": 2, "score": 0.52, "retrieval": "hybrid"},
+    ]
+    screened = answerer.prescreen(docs)
+    assert screened["ticket_id"] == 1
+    assert screened["margin"] == pytest.approx(0.03)
+    assert not answerer.passes(screened)
+
+    # Sin coseno (búsqueda léxica o por número de ticket) no hay descarte barato
+    assert answerer.prescreen([{"ticket_id": 1, "score": 12.0, "retrieval": "lexical"}]) is None
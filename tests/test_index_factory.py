@@ -0,0 +1,38 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+faiss = pytest.importorskip("faiss")
+
+from rag.index_factory import INDEX_KINDS, exhaustive_params, make_index, supports_removal
+
+
+def _vectors(n: int, dim: int = 32, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((n, dim)).astype("float32")
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+@pytest.mark.parametrize("kind", INDEX_KINDS)
+def test_remove_add_self_search(kind):
+    # Mismo camino que build_faiss_index: actualización en el lugar si el índice lo admite,
+    # si no reconstrucción desde los embeddings
+    vectors = _vectors(3000)
+    ids = np.arange(len(vectors), dtype="int64") * 7 + 11
+    index = make_index(kind, vectors[:2500], ids[:2500])
+
+    removed = ids[:300]
+    keep = np.concatenate([np.arange(300, 2500), np.arange(2500, 3000)])
+    if supports_removal(index):
+        index.remove_ids(removed)
+        index.add_with_ids(vectors[2500:], ids[2500:])
+    else:
+        index = make_index(kind, vectors[keep], ids[keep])
+    assert index.ntotal == len(keep)
+
+    sample = keep[::25]
+    params = exhaustive_params(index, 10)
+    _, found = index.search(vectors[sample], 10, params=params) if params else index.search(vectors[sample], 10)
+    self_recall = np.mean([ids[i] in row for i, row in zip(sample, found)])
+    assert self_recall >= 0.9
+    assert not np.isin(found, removed).any()
@@ -0,0 +1,41 @@
+import json
+import pytest
+
+pytest.importorskip("pydantic")
+pytest.importorskip("tqdm")
+
+from rag.ingest import delete_tickets, iter_json_items
+
+TICKETS = [{"id": 1000 + i, "summary": "Ticket " + "x" * (i % 40), "notes": [{"id": i, "text": "ñ" * i}]} for i in range(200)]
+
+
+@pytest.mark.parametrize("data, expected", [
+    (TICKETS, TICKETS),
+    ({"page": 1, "issues": TICKETS, "total_count": 200}, TICKETS),
+    ({"issues": []}, []),
+    (TICKETS[3], [TICKETS[3]]),
+])
+@pytest.mark.parametrize("chunk_size", [7, 1 << 20])
+def test_iter_json_items_streams_exports(tmp_path, data, expected, chunk_size):
+    path = tmp_path / "export.json"
+    path.write_text("\ufeff" + json.dumps(data, indent=1, ensure_ascii=False), encoding="utf-8")
+    assert list(iter_json_items(str(path), chunk_size=chunk_size)) == expected
+
+
+def test_deleted_tickets_leave_the_latest_chunks(tmp_path):
+    store_faiss = pytest.importorskip("rag.store_faiss")
+    path = tmp_path / "tickets_processed.jsonl"
+    records = [{"ticket_id": t, "chunk_id": c, "content": f"ticket {t} chunk {c}"} for t in (1, 2) for c in (0, 1)]
+    path.write_text("".join(json.dumps(r) + "\n" for r in records), encoding="utf-8")
+    (tmp_path / "ingest_state.json").write_text(json.dumps({"1": "v1", "2": "v1"}), encoding="utf-8")
+
+    report = delete_tickets([2], output_dir=str(tmp_path))
+    assert report["deleted"] == 1 and report["unknown"] == []
+    assert {m["ticket_id"] for m in store_faiss.load_latest_chunks(str(path)).values()} == {1}
+    # Sin versión conocida, una nueva exportación del ticket vuelve a ingerirse
+    assert json.loads((tmp_path / "ingest_state.json").read_text(encoding="utf-8")) == {"1": "v1"}
+
+    # Re-ingerido después del borrado, el ticket vuelve
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"ticket_id": 2, "chunk_id": 0, "content": "ticket 2 de nuevo"}) + "\n")
+    assert {m["ticket_id"] for m in store_faiss.load_latest_chunks(str(path)).values()} == {1, 2}
@@ -0,0 +1,33 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+
+from rag.retriever import _IndexState
+
+
+class FakeConnection:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_retired_state_closes_after_last_query():
+    store, lexical = FakeConnection(), FakeConnection()
+    state = _IndexState(index=None, store=store, lexical=lexical, version="v1") # type: ignore
+
+    # Una consulta en curso retiene la versión reemplazada
+    state.acquire()
+    state.retire()
+    assert not store.closed and not lexical.closed
+
+    state.release()
+    assert store.closed and lexical.closed
+
+
+def test_idle_state_closes_on_retire():
+    store = FakeConnection()
+    state = _IndexState(index=None, store=store, lexical=None, version="v1") # type: ignore
+    state.retire()
+    assert store.closed